@@ -1,19 +1,20 @@
-import numpy as np
-import pandas as pd
 import rasterio as rio
 from rasterio.merge import merge
-import geopandas as gpd
-import cartopy.crs as ccrs
-import matplotlib.pyplot as plt
-import matplotlib.lines as mlines
-import matplotlib.patches as mpatches
-from matplotlib_scalebar.scalebar import ScaleBar
-from shapely.geometry import Point
-from shapely.ops import unary_union
+import matplotlib
+matplotlib.use('Agg')  # maps are saved to file, not shown, so they can be drawn off the GUI thread
 import PySimpleGUI as sg
-import bng
 from pathlib import Path
 from datetime import date
+from concurrent.futures import ThreadPoolExecutor
+import threading
+from basemap import build_basemap
+from enquiry import MAP_DPI, MAP_FORMATS, EnquiryCancelled, run_enquiry
+from enquiry_log import EnquiryLogger
+from export import EXPORT_FORMATS
+from gridref import GRID_DIGITS, gridref_to_osgb36
+from layers import LayerStore, selected_layers, selected_searches
+from resultcache import ResultCache
+from search_service import submit_enquiry
 
 
 # Create GUI layout elements and structure
@@ -40,8 +41,10 @@ column1 = [[sg.Text("Enquiry number:"), sg.InputText(default_text=tdyr, size=2,
            [sg.Text('-OR-')],
            [sg.Text("Shapefile"), sg.Input(size=30, key="-BDYFILE-", enable_events=True),
             sg.FileBrowse(file_types=(("Shapefile", "*.SHP"), ("MapInfo TAB", "*.TAB"),))],
+           [sg.Checkbox('Search each feature of the file separately', default=False, key="-PERFEATURE-")],
            [sg.Text('-AND-')],
-           [sg.Text("Search Radius (in metres)"), sg.Input(size=12, key="-RADIUS-", enable_events=True)],
+           [sg.Text("Search Radius (in metres)"), sg.Input(size=12, key="-RADIUS-", enable_events=True),
+            sg.Text("e.g. 2000, or 500,2000,5000 for distance bands")],
            [sg.Text("Please specify a search area", text_color='red', key="-DIALOGUE-", enable_events=True)]]
 
 # Specify values for second column of GUI
@@ -52,21 +55,29 @@ column2 = [[sg.Text('Select search parameters', font=("Helvetica", 15))],
            [sg.Checkbox('Invasives', default=False, key="-INV-", enable_events=True)],
            [sg.Checkbox('Sites', default=False, key="-SITES-", enable_events=True)],
            [sg.Checkbox('Species and Sites', default=False, key="-SITESSPP-", enable_events=True)],
+           [sg.Text('Results format'),
+            sg.Combo(EXPORT_FORMATS, default_value='xlsx', key="-FORMAT-", readonly=True)],
+           [sg.Text('Map format'),
+            sg.Combo(MAP_FORMATS, default_value='jpeg', key="-MAPFORMAT-", readonly=True),
+            sg.Text('DPI'), sg.Input(default_text=MAP_DPI, size=5, key="-MAPDPI-", enable_events=True)],
+           [sg.Text('Records from year'), sg.Input(size=5, key="-YEARFROM-", enable_events=True),
+            sg.Text('to'), sg.Input(size=5, key="-YEARTO-", enable_events=True),
+            sg.Text('blank for all years')],
+           [sg.Text('Grid reference digits'),
+            sg.Combo([''] + GRID_DIGITS, default_value='', key="-GRIDDIGITS-", readonly=True),
+            sg.Text('blank to keep the recorded grid references')],
            [sg.Text("Please specify search parameters", text_color='red', key="-SEARCHSTATUS-", enable_events=True)]]
 
 # Define the GUI layout
 layout = [[sg.Text('Ecological data enquiry tool', font=("Helvetica", 25))],
           [sg.Text('A tool for the production of ecological data searches', font=("helvetica", 12))],
           [sg.Text('Specify a search area and radius on the left and select the parameters for the search on the right.'
-                   ' The tool will produce a JPEG map and excel spreadsheets of the results and save them '
+                   ' The tool will produce a map for each search and an excel workbook of the results and save them '
                    'in the specified folder.',
                    size=(100, 3), font=("helvetica", 12))],
           [sg.Column(column1), sg.VSeparator(), sg.Column(column2)],
-          [sg.Button('Proceed', key="-PROCEED-"), sg.CloseButton('Cancel', key="-CANCEL-")]]
-
-# Build the GUI window
-window = sg.Window("Data Search Enquiry", layout, margins=(50, 50))
-
+          [sg.Button('Proceed', key="-PROCEED-"), sg.Button('Cancel enquiry', key="-STOP-"),
+           sg.CloseButton('Close', key="-CANCEL-")]]
 
 # Declare functions from within the GUI
 # noinspection PyUnboundLocalVariable
@@ -74,7 +85,8 @@ def rastermosaic():
     """
     Returns a mosaic of raster tiles to form the basemap for the map plot. Only required to run once to produce
     the basemap, once this is produced the function is no longer required. Left in the program for reference
-    and for use if required again.
+    and for use if required again. Superseded by build_basemap, which builds a virtual mosaic of the tiles
+    without merging them in memory.
 
     Returns:
         output_path: Location and name of the created raster mosaic
@@ -110,653 +122,210 @@ def rastermosaic():
     return output_path
 
 
-def searcharea_frompoint(xin, yin, buffer_radius):
-
+def enquiry_thread(enquiry, cancel):
     """
-    Creates a point and buffer based on the user inputted grid reference. Point_x and point_y require pure
-    EPSG:27700 easting and northing, values. Buffer_area value is in metres
+    Runs an enquiry on the enquiry thread, so the GUI stays responsive while the searches, map and spreadsheets are
+    produced. Progress is reported back to the GUI as window events.
 
     Parameters:
-        xin: easting values as int or flt
+        enquiry: dictionary of the enquiry details, see run_enquiry
 
-        yin: northing values as int or flt
-
-        buffer_radius: required buffer is required in metres, value as either int or flt
-
-    Returns:
-        userfeat: Geoseries of the user inputted point
-
-        userbuffer: Geoseries of a user specified buffer around the user defined point
-
-        bufferGeom: Shapely geometry of the user defined buffer
-
-        input_handles: The style information for the point and buffer to add to map legend
+        cancel: threading.Event which is set when the user cancels the enquiry
     """
 
-    userpoint = Point(xin, yin)  # shapely geometry
-    bufferGeom = userpoint.buffer(buffer_radius, resolution=50)  # shapely geometry for running search
-
-    # Convert to geoseries for mapping in matplotlib
-    userfeat = gpd.GeoSeries(Point(xin, yin)).set_crs(epsg=27700, inplace=True)
-    userbuffer = gpd.GeoSeries(userfeat.buffer(buffer_radius, resolution=50)).set_crs(epsg=27700, inplace=True)
-
-    # Plot the point and buffer
-    userbuffer.plot(ax=ax, color='none', edgecolor='red')
-    userfeat.plot(ax=ax, marker='*', color='red', markersize=20)
-
-    # Create handles for legend
-    userpoint_handle = mlines.Line2D([], [], linestyle='None', marker='*', color='red', label='User point')
-    userbuffer_handle = mpatches.Patch(facecolor='None', edgecolor='red', label='Search buffer')
-
-    # Combine legend items
-    input_handles = [userpoint_handle, userbuffer_handle]
-
-    return userfeat, userbuffer, bufferGeom, input_handles
-
-
-def searcharea_frompoly(user_polypath, buffer_radius):
-    """
-    Creates a buffer based on the user inputted polygon.
-
-    buffer_area value is required in metres, value as either int or flt.
-
-    Parameters:
-        user_polypath: the filepath to the selected polygon
-
-        buffer_radius: required buffer is required in metres, value as either int or flt
-
-    Returns:
-        userfile: A Geodataframe of the file the user selects
-
-        userbuffer: Geoseries of a user specified buffer around the user defined point
-
-        bufferGeom: Shapely geometry of the user defined buffer
-
-        input_handles: The style information for the point and buffer to add to map legend
-
-
-    """
-
-    userfile = gpd.read_file(user_polypath)  # import user selected file
-    union = unary_union(userfile.geometry)
-    userbuffer = gpd.GeoSeries(userfile.buffer(buffer_radius))  # buffer user file with user input buffer (for plotting)
-    bufferGeom = union.buffer(buffer_radius)  # Create shapely geometry to carry out intersects
-
-    userfile.plot(ax=ax, edgecolor='blue', color='none', hatch='//')
-    userbuffer.plot(ax=ax, color='none', edgecolor='red', linewidth=1.5)
-
-    userpoly_handle = mpatches.Patch(facecolor='None', hatch='//', edgecolor='blue',
-                                     label='Search area')
-
-    userbuffer_handle = mpatches.Patch(facecolor='None', edgecolor='red',
-                                       label='Search buffer')
-
-    input_handles = [userpoly_handle, userbuffer_handle]
-
-    return userfile, userbuffer, bufferGeom, input_handles
-
-
-def searchSpecies():
-    """
-    Carries out a protected species search based on the users input parameters. No input arguments are specified
-    as the inputs are read directly from variables within the main script.
-
-    Returns:
-        sppSearch: Geodataframe containing the results of an intersection between a dataframe containing protected
-        species data and the buffer geometry created from the searcharea_frompoint or searcharea_frompoly functions.
-        This is used for plotting on the map
-
-        sppConcat: Concatenated results of protected species 100m+ and 1km precision data searches
-
-        sppOutput: Concatenated results of protected species 100m+ and 1km precision data searches with
-        extraneous columns removed.
-
-    """
-
-    df = specieslayer
-    df1km = species1kmlayer
-    # Run search on spp records <= 100m precision
-    sppSearch = df[df.intersects(buffer_feature, align=True)]
-
-    # Run 1km data species search
-    spp1kmSearch = df1km[df1km.intersects(buffer_feature, align=True)]
-
-    # Concatenate the 1km and <=100m species records search results
-    sppConcat = pd.concat([sppSearch, spp1kmSearch])
-
-    # Remove extraneous columns for GDPR
-    sppOutput = sppConcat[['SciName', 'CommonName', 'InformalGr', 'Location', 'LocDetail', 'GridRef', 'Grid1km',
-                           'Date', 'Year', 'Source', 'SampleMeth', 'SexStage', 'RecType', 'EuProt',
-                           'UKProt', 'PrincipalS', 'RareSpp', 'StatInvasi', 'StaffsINNS', 'RecordStat', 'Confidenti',
-                           'Easting', 'Northing', 'Precision']]
-
-    return sppSearch, sppConcat, sppOutput
-
-
-def sppstyle():
-    """
-    Styles and plots the results of the protected species search on a map axis, creates label handles which match
-    the species styles.
-    No input arguments are specified as the inputs are read directly from variables within the main script.
-
-    Returns:
-        spptypes: a list of Geodataframe plots, plotting species search results
-
-        spplegend: a list of legend handles matching the style of the axis plots (proxy artist)
-
-    """
-
-    mammal = sppSearch[(sppSearch['InformalGr'] == 'mammal') & ~(sppSearch['CommonName'] == 'Otter')
-                       & ~(sppSearch['CommonName'] == 'Water Vole') & ~(sppSearch['CommonName'] == 'Eurasian Badger')]\
-        .plot(ax=ax, marker='^', color='none', edgecolor='red', linewidth=2)
-
-    otter = sppSearch[sppSearch['CommonName'] == 'Otter']\
-        .plot(ax=ax, marker='^', color='red', edgecolor='black')
-
-    wv = sppSearch[sppSearch['CommonName'] == 'Water Vole']\
-        .plot(ax=ax, marker='s', color='green', edgecolor='black')
-
-    bats = sppSearch[sppSearch['InformalGr'] == 'mammal - bat']\
-        .plot(ax=ax, marker='v', color='deepskyblue', edgecolor='black')
-
-    birds = sppSearch[sppSearch['InformalGr'] == 'bird']\
-        .plot(ax=ax, marker='o', color='None', edgecolor='yellow', linewidth=2)
-
-    amrep = sppSearch[(sppSearch['InformalGr'] == 'amphibian') & (sppSearch['InformalGr'] == 'reptile')
-                      & ~(sppSearch['CommonName'] == 'Great Crested Newt')]\
-        .plot(ax=ax, marker='s', color='none', edgecolor='deepskyblue', linewidth=2)
-
-    gcn = sppSearch[sppSearch['CommonName'] == 'Great Crested Newt']\
-        .plot(ax=ax, marker='o', color='yellow', edgecolor='black')
-
-    crayfish = sppSearch[sppSearch['CommonName'] == 'White-clawed Freshwater Crayfish']\
-        .plot(ax=ax, marker='P', color='deepskyblue', edgecolor='black')
-
-    plants = sppSearch[(sppSearch['InformalGr'] == 'flowering plant') & ~(sppSearch['CommonName'] == 'Bluebell')]\
-        .plot(ax=ax, marker='v', color='none', edgecolor='green', linewidth=2)
-
-    bluebell = sppSearch[sppSearch['CommonName'] == 'Bluebell']\
-        .plot(ax=ax, marker='o', color='green', edgecolor='black')
-
-    # Create proxy artist entries to create legend list
-    mammal_handle = mlines.Line2D([], [], marker='^', color='None', markeredgecolor='red', markeredgewidth=2,
-                                  linestyle='None', label='Mammal')
-
-    otter_handle = mlines.Line2D([], [], marker='^', color='red', markeredgecolor='black',
-                                 linestyle='None', label='Otter')
-
-    wv_handle = mlines.Line2D([], [], marker='s', color='green', markeredgecolor='black',
-                              linestyle='None', label='Water Vole')
-
-    bats_handle = mlines.Line2D([], [], marker='v', color='deepskyblue', markeredgecolor='black',
-                                linestyle='None', label='Bats')
-
-    birds_handle = mlines.Line2D([], [], marker='o', color='None', markeredgecolor='yellow', markeredgewidth=2,
-                                 linestyle='None', label='Birds')
-
-    amrep_handle = mlines.Line2D([], [], marker='s', color='none', markeredgecolor='deepskyblue',
-                                 linestyle='None', markeredgewidth=2, label='Amphibians and Reptiles')
-
-    gcn_handle = mlines.Line2D([], [], marker='o', color='yellow', markeredgecolor='black',
-                               linestyle='None', label='Great Crested Newt')
-
-    crayfish_handle = mlines.Line2D([], [], marker='P', color='deepskyblue', markeredgecolor='black',
-                                    linestyle='None', label='White-Clawed Crayfish')
-
-    plants_handle = mlines.Line2D([], [], marker='v', color='none', markeredgecolor='green',
-                                  linestyle='None', markeredgewidth=2, label='Plant')
-
-    bluebell_handle = mlines.Line2D([], [], marker='o', color='green', markeredgecolor='black',
-                                    linestyle='None', label='Bluebell')
-
-    spptypes = [mammal, otter, wv, bats, birds, amrep, gcn, crayfish, plants, bluebell]  # lep, other
-
-    spplegend = [mammal_handle, otter_handle, wv_handle, bats_handle, birds_handle, amrep_handle, gcn_handle,
-                 crayfish_handle, plants_handle, bluebell_handle]
-
-
-# TODO: add in way of catching zero result species + 'other' species
+    def progress(message):
+        window.write_event_value("-PROGRESS-", 'Enquiry ' + enquiry['enqno'] + ': ' + message)
 
-    return spptypes, spplegend
-
-
-def searchBats():
-    """
-    Carries out a bat species search based on the users input parameters. No input arguments are specified
-    as the inputs are read directly from variables within the main script.
-
-    Returns:
-        batSearch:Geodataframe containing the results of an intersection between a dataframe containing protected
-        species data and the buffer geometry created from the searcharea_frompoint or searcharea_frompoly functions,
-        filtered to contain only bat records.
-
-        batOutput:  Concatenated results of bat species 100m+ and 1km precision data searches
-
-        bats_handle: Concatenated results of bat species 100m+ and 1km precision data searches with
-        extraneous columns removed.
-
-    """
-    df = specieslayer
-    df1km = species1kmlayer
-    # Run search on spp records <= 100m precision
-    batrecs = df[df['InformalGr'] == 'mammal - bat']  # Filter where value from informal group column = bats
-    batSearch = batrecs[batrecs.intersects(buffer_feature, align=True)]
-
-    # Run 1km data species search
-    batrecs1km = df1km[df1km['InformalGr'] == 'mammal - bat']  # Filter where value from informal group column = bats
-    batsearch1km = batrecs1km[batrecs1km.intersects(buffer_feature, align=True)]
-
-    # Concatenate the 1km and <=100m species records search results
-    batConcat = pd.concat([batSearch, batsearch1km])
-
-    # Remove extraneous columns for GDPR
-    batOutput = batConcat[['SciName', 'CommonName', 'InformalGr', 'Location', 'LocDetail', 'GridRef', 'Grid1km',
-                           'Date', 'Year', 'Source', 'SampleMeth', 'SexStage', 'RecType', 'EuProt', 'UKProt',
-                           'PrincipalS', 'RareSpp', 'StatInvasi', 'StaffsINNS', 'RecordStat', 'Confidenti',
-                           'Easting', 'Northing', 'Precision']]
-
-
-    bats_handle = mlines.Line2D([], [], marker='v', color='deepskyblue', markeredgecolor='black',
-                                linestyle='None', label='Bats')
-
-    bats_handle = [bats_handle]
-
-    return batSearch, batOutput, bats_handle
-
-
-def searchGCNs():
-    """
-    Carries out a Great Crested Newt (GCN) species search based on the users input parameters.
-    No input arguments are specified as the inputs are read directly from variables within the main script.
-
-    Returns:
-        gcnSearch:Geodataframe containing the results of an intersection between a dataframe containing protected
-        species data and the buffer geometry created from the searcharea_frompoint or searcharea_frompoly functions,
-        filtered to contain only GCN records.
-
-        gcnOutput:  Concatenated results of gcn species 100m+ and 1km precision data searches
-
-        gcn_handle: Concatenated results of gcn species 100m+ and 1km precision data searches with
-        extraneous columns removed.
-
-    """
-    df = specieslayer
-    df1km = species1kmlayer
-
-    # Run search on spp records <= 100m precision
-    gcnrecs = df[df['CommonName'] == 'Great Crested Newt']   # Filter where value from Common Name column = GCN
-    gcnSearch = gcnrecs[gcnrecs.intersects(buffer_feature, align=True)]
-
-    # Run 1km data species search
-    gcnrecs1km = df1km[df1km['CommonName'] == 'Great Crested Newt']  # Filter where value from Common Name column = GCN
-    gcnsearch1km = gcnrecs1km[gcnrecs1km.intersects(buffer_feature, align=True)]
-
-    # Concatenate the 1km and <=100m species records search results
-    gcnConcat = pd.concat([gcnSearch, gcnsearch1km])
-
-    # Remove extraneous columns for GDPR
-    gcnOutput = gcnConcat[['SciName', 'CommonName', 'InformalGr', 'Location', 'LocDetail', 'GridRef', 'Grid1km',
-                           'Date', 'Year', 'Source', 'SampleMeth', 'SexStage', 'RecType', 'EuProt', 'UKProt',
-                           'PrincipalS', 'RareSpp', 'StatInvasi', 'StaffsINNS', 'RecordStat', 'Confidenti',
-                           'Easting', 'Northing', 'Precision']]
-
-    gcn_handle = mlines.Line2D([], [], marker='o', color='yellow', markeredgecolor='black',
-                               linestyle='None', label='Great Crested Newt')
-
-    gcn_handle = [gcn_handle]
-
-    return gcnSearch, gcnOutput, gcn_handle
-
-
-def searchInvasive():
-    """
-    Carries out a Great Crested Newt (GCN) species search based on the users input parameters.
-    No input arguments are specified as the inputs are read directly from variables within the main script.
-
-    Returns:
-        invSearch:Geodataframe containing the results of an intersection between a dataframe containing protected
-        species data and the buffer geometry created from the searcharea_frompoint or searcharea_frompoly functions,
-        filtered to contain only invasive species records.
-
-        invOutput:  Concatenated results of invasive species 100m+ and 1km precision data searches
-
-    """
-
-    df = invasivespecies
-    df1km = invasivespecies1km
-    # Run search on invasive species records <= 100m precision
-    invSearch = df[df.intersects(buffer_feature, align=True)]
-
-    # Run 1km data invasive species search
-    inv1kmSearch = df1km[df1km.intersects(buffer_feature, align=True)]
-
-    # Concatenate the 1km and <=100m invasive species records search results
-    invConcat = pd.concat([sppSearch, inv1kmSearch])
-
-    # Prepare output for excel export
-    invOutput = invConcat[['SciName', 'CommonName', 'InformalGr', 'Location', 'LocDetail', 'GridRef', 'Grid1km',
-                           'Date', 'Year', 'Source', 'SampleMeth', 'SexStage', 'RecType', 'EuProt', 'UKProt',
-                           'PrincipalS', 'RareSpp', 'StatInvasi', 'StaffsINNS', 'RecordStat', 'Confidenti',
-                           'Easting', 'Northing', 'Precision']]
-
-    return invSearch, invOutput
-
-
-def searchSites():
-    """
-    Carries out a Nature Conservation Site search based on the users input parameters.
-    No input arguments are specified as the inputs are read directly from variables within the main script.
-
-    Returns:
-        sbiIntersect: Geodataframe containing the list of Site of Biological Importance (SBI) intersecting the
-        users buffer radius.
-
-        basIntersect: Geodataframe containing the list of Biodiversity Alert Sites (BAS) intersecting the
-        users buffer radius.
-
-        site_handles: a list of legend handles matching the style of the search plots (proxy artist)
-
-        sitesOutput: Concatenation of sbiIntersect and basIntersect
-
-
-    """
-
-    # Search for sites which intersect the buffer area
-    sbiIntersect = sbilayer[sbilayer.intersects(buffer_feature, align=True)]
-    basIntersect = baslayer[baslayer.intersects(buffer_feature, align=True)]
-
-    # Concatenate the two search results
-    sitesConcat = pd.concat([sbiIntersect, basIntersect])
-
-    # Remove extraneous columns for GDPR
-    sitesOutput = sitesConcat[['SiteID', 'SiteName', 'Status', 'Year', 'Abstract']]
-
-    # Plot the sites on the map
-    sbiIntersect.plot(ax=ax, color='None', hatch='.....', edgecolor='green')
-    basIntersect.plot(ax=ax, color='None', hatch='.....', edgecolor='deepskyblue')
-
-    #  Add site labels (https://stackoverflow.com/questions/38899190/geopandas-label-polygons)
-    sbiIntersect.apply(lambda x: ax.annotate(text=x['SiteID'], size=8, color='green', weight='bold',
-                                             xy=x.geometry.centroid.coords[0], ha='center'), axis=1)
-
-    basIntersect.apply(lambda x: ax.annotate(text=x['SiteID'], size=8, color='deepskyblue', weight='bold',
-                                             xy=x.geometry.centroid.coords[0], ha='center'), axis=1)
-
-    # create legend items
-    sbi_handle = mpatches.Patch(facecolor='None', hatch='.....', edgecolor='green',
-                                label='Site of Biological Importance')
-    bas_handle = mpatches.Patch(facecolor='None', hatch='.....', edgecolor='deepskyblue',
-                                label='Biodiversity Alert Site')
-
-    # list legend items to plot
-    site_handles = [sbi_handle, bas_handle]
-
-    return sbiIntersect, basIntersect, site_handles, sitesOutput
+    try:
+        if SERVICE_URL is not None:  # run on the shared search service, which has the layers loaded already
+            if cancel.is_set():
+                raise EnquiryCancelled('enquiry {} cancelled'.format(enquiry['enqno']))
+            progress('Running on the search service')
+            submit_enquiry(SERVICE_URL, enquiry)
+        else:
+            run_enquiry(enquiry, layerstore, basemap_build.result(), progress=progress, cancel=cancel,
+                        log=enquiry_log)
+        window.write_event_value("-ENQUIRYDONE-", enquiry['enqno'])
+    except EnquiryCancelled:
+        window.write_event_value("-ENQUIRYCANCELLED-", enquiry['enqno'])
+    except Exception as error:  # report the error to the user rather than losing it on the enquiry thread
+        window.write_event_value("-ENQUIRYFAILED-", 'Enquiry ' + enquiry['enqno'] + ' failed: ' + str(error))
 
 
-def load_basemap(filepath):
-    """
-    Loads a raster basemap into the axis plot.
+# Each enquiry is logged to output/logs/enquiries.log with the time, memory use and row counts of each stage.
+# Set PROFILE_THRESHOLD to a time in seconds to save a cProfile profile of any enquiry slower than this.
+PROFILE_THRESHOLD = None
 
-    Parameters:
-        filepath: location of the raster dataset
+# Set ON_DEMAND_LAYERS to True for master layers too large to hold in memory, only the records near each enquiry
+# are then read (the layers are tiled once, the first time they are needed).
+ON_DEMAND_LAYERS = False
+# Set SERVICE_URL to the address of a running search service (see search_service.py), e.g. 'http://127.0.0.1:8765',
+# to run the enquiries on the service instead, no layers are then loaded by the GUI.
+SERVICE_URL = None
 
-    Returns:
-        bmxmin: x-axis minimum extent values from basemap
 
-        bmymin: y-axis minimum extent values from basemap
+# The GUI is only started when the script is run, not when the map worker processes (see map_pool) import it
+if __name__ == '__main__':
+    # Build the GUI window
+    window = sg.Window("Data Search Enquiry", layout, margins=(50, 50))
 
-        bmxmax: x-axis maximum extent values from basemap
+    enquiry_log = EnquiryLogger(profile_threshold=PROFILE_THRESHOLD)
 
-        bmymax: y-axis maximum extent values from basemap
+    # Enquiries are run one at a time on the enquiry thread, further enquiries are queued while one is running
+    enquiry_runner = ThreadPoolExecutor(max_workers=1, thread_name_prefix='enquiry')
+    running_enquiries = {}  # Future of each queued or running enquiry: its cancel event
 
-        dispimg: the basemap image
+    # Load files to search from
+    # Layers are loaded on a background thread when the search types that need them are ticked, so only the layers
+    # required for an enquiry are loaded. Loaded layers are kept (and indexed) for later enquiries.
+    # Search results are cached on disk, so rerunning a site (e.g. for another search type) skips the search.
+    layerstore = LayerStore(result_cache=ResultCache(), on_demand=ON_DEMAND_LAYERS)
 
-    """
-    with rio.open(filepath) as dataset:
-        img = dataset.read()
-        bmxmin, bmymin, bmxmax, bmymax = dataset.bounds
+    # Build (or update) the virtual mosaic of the basemap tiles in the background, only new or replaced tiles are read
+    basemap_build = layerstore.submit(build_basemap, 'SampleData/basemaps/')
 
-    dispimg = img.copy().astype(np.float32)
-    dispimg = dispimg.transpose([1, 2, 0])
 
-    return bmxmin, bmymin, bmxmax, bmymax, dispimg
+    ##### GUI event loop #####
 
+    while True:  # Create an  initial infinite loop which the GUI runs inside.
+        event, values = window.read()  # Read the layout detailed above and display as a window, track events and values
 
+        # Window close loop
+        if event == sg.WIN_CLOSED or event == "-CANCEL-":  # Close window if user presses X or close
+            print('User cancelled')
+            for cancel in running_enquiries.values():  # stop any running or queued enquiries
+                cancel.set()
+            enquiry_runner.shutdown(wait=False)
+            break
 
-# Setup CRS of the axis
-myCRS = ccrs.epsg(27700)  # Set project CRS to British National Grid, matches the CRS of datafiles
+        # Update the search status with the progress of the enquiry thread
+        if event == "-PROGRESS-":
+            window["-SEARCHSTATUS-"].update(values[event], text_color='green')
+            continue
 
-# Load files to search from
-specieslayer = gpd.read_file('SampleData/SHP/ProtSpp_font_point.shp')  # load species 100m+ layer
-species1kmlayer = gpd.read_file('SampleData/SHP/ProtSpp1km_region.shp')  # load pecies 1km layer
-sbilayer = gpd.read_file('SampleData/SHP/SBI_region.shp')  # load SBI layer
-baslayer = gpd.read_file('SampleData/SHP/BAS_region.shp')  # load BAS layer
-invasivespecies = gpd.read_file('SampleData/SHP/InvasiveSpp_font_point.shp')  # load invasive species 100m+ layer
-invasivespecies1km = gpd.read_file('SampleData/SHP/InvasiveSpp1km_region.shp')  # load invasive species 1km layer
+        if event == "-ENQUIRYDONE-":
+            window["-SEARCHSTATUS-"].update('Enquiry ' + values[event] + ' completed', text_color='green')
+            continue
 
-# load basemap
-# return extent values from load_basemap function
-bmxmin, bmymin, bmxmax, bmymax, basemap = load_basemap('output/mosaic.tif')
-# plot basemap using extents
-basemap_kwargs = {'extent': [bmxmin, bmxmax, bmymin, bmymax], 'transform': myCRS}
+        if event == "-ENQUIRYCANCELLED-":
+            window["-SEARCHSTATUS-"].update('Enquiry ' + values[event] + ' cancelled', text_color='red')
+            continue
 
+        if event == "-ENQUIRYFAILED-":
+            window["-SEARCHSTATUS-"].update(values[event], text_color='red')
+            sg.popup(values[event])
+            continue
 
+        # Cancel the running enquiry, and any enquiries queued behind it
+        if event == "-STOP-":
+            for cancel in running_enquiries.values():
+                cancel.set()
+            window["-SEARCHSTATUS-"].update('Cancelling enquiry', text_color='red')
+            continue
 
-##### GUI event loop #####
+        # Start loading the layers needed by the ticked search types in the background
+        if SERVICE_URL is None:
+            layerstore.request(selected_layers(selected_searches(values)))
+
+        # Check to see if the buffer radius is an integer (or a list of integers, separated by commas, for a distance
+        # banded search) to prevent early error termination
+        if values["-RADIUS-"]:  # Check to see is the user has entered radius info
+            text = values["-RADIUS-"]
+            try:
+                value = [int(r) for r in text.split(',') if r.strip()]  # check to see if values are Int
+                if not value:
+                    raise ValueError('no radius')
+            except:
+                sg.popup('buffer must be an integer value, or integer values separated by commas')  # popup window
+                continue
+
+        # Ensure the map resolution is a whole number of dots per inch
+        if values["-MAPDPI-"] and not values["-MAPDPI-"].isdigit():
+            sg.popup('map DPI must be an integer value')  # popup window
+            continue
 
-while True:  # Create an  initial infinite loop which the GUI runs inside.
-    event, values = window.read()  # Read the layout detailed above and display as a window, track events and values
-    print(values)  # Prints the selected values to the console for debugging and error checking
+        # Ensure the record years are whole years
+        if (values["-YEARFROM-"] and not values["-YEARFROM-"].isdigit()) or \
+                (values["-YEARTO-"] and not values["-YEARTO-"].isdigit()):
+            sg.popup('record years must be whole years, e.g. 2014')  # popup window
+            continue
 
-    # Window close loop
-    if event == sg.WIN_CLOSED or event == "-CANCEL-":  # Close window if user presses X or cancel
-        print('User cancelled')
-        break
+        # Ensure enquiry number field is populated
+        if values["-ENQNO-"] == '' and event == "-PROCEED-":  # Check to see if user has populated enquiry number field
+            sg.popup('enquiry number required')  # popup window - prompt user to enter enquiry number
+            continue
 
-    # Check to see if the buffer radius is an integer to prevent early error termination
-    if values["-RADIUS-"]:  # Check to see is the user has entered radius info
-        text = values["-RADIUS-"]
-        try:
-            value = int(text)  # check to see if value is Int
-            print(f'Integer: {value}')  # print radius value to console for checking
-        except:
-            print("Not Integer")
-            sg.popup('buffer must be an integer value')  # popup window - radius field requires an int value
+        # Ensure Site Name field is populated
+        if values["-SITENAME-"] == '' and event == "-PROCEED-":  # Check to see if user has populated Site Name field
+            sg.popup('site name required')  # popup window - prompt user to enter site name
             continue
 
-    # Ensure enquiry number field is populated
-    if values["-ENQNO-"] == '' and event == "-PROCEED-":  # Check to see if user has populated enquiry number field
-        sg.popup('enquiry number required')  # popup window - prompt user to enter enquiry number
-        continue
-
-    # Ensure Site Name field is populated
-    if values["-SITENAME-"] == '' and event == "-PROCEED-":  # Check to see if user has populated Site Name field
-        sg.popup('site name required')  # popup window - prompt user to enter site name
-        continue
-
-    # Ensure the output save location field is populated
-    if values["-OUTFOLDER-"] == '' and event == "-PROCEED-":  # Check to see if user has populated Site Name field
-        sg.popup('output location required')  # popup window - prompt user to specify save location
-        continue
-
-    # First produce map plot and map furniture if the user clicks proceed
-    if event == "-PROCEED-":  # Only produce layout when user clicks proceed
-        # create empy axis
-        cm = 1/2.54  # convert inches to cm to create A4 plot size
-        # Create figure & plot
-        fig, ax = plt.subplots(1, 1, figsize=(21*cm, 29.7*cm), subplot_kw=dict(projection=myCRS))
-        ax.imshow(basemap, **basemap_kwargs, cmap='gray')  # add basemap with grayscale colourmap
-        ax.add_artist(ScaleBar(1))  # Add scalebar
-        # Add gridlines - NOTE: currently epsg:27700 axis labels not supported in cartopy 0.18.
-        gridlines = ax.gridlines(draw_labels=True)
-        gridlines.right_labels = False
-        gridlines.bottom_labels = False
-
-        # Create north arrow
-        # (source: https://stackoverflow.com/questions/58088841/how-to-add-a-north-arrow-on-a-geopandas-map)
-        x, y, arrow_length = 0.03, 0.98, 0.05  # specify arrow size & location
-        ax.annotate('N', xy=(x, y), xytext=(x, y - arrow_length),
-                    arrowprops=dict(facecolor='black', width=5, headwidth=15),
-                    ha='center', va='center', fontsize=15,
-                    xycoords=ax.transAxes)
-        plt.tight_layout()  # tight layout to put elements closer together on figure.
-
-    # Create buffer from user specified point
-    if values["-EASTING-"] and values["-NORTHING-"] and values["-RADIUS-"]:  # Only proceed if these values are
-        # selected
-        window["-DIALOGUE-"].update('Point and buffer selected', text_color='green')
-        buffer_radius = float(values["-RADIUS-"])  # transform user buffer radius values into float
-        easting = float(values["-EASTING-"])  # transform user easting values into float
-        northing = float(values["-NORTHING-"])  # transform user easting values into float
-
-        if event == "-PROCEED-":
-            # call function to produce buffer from easting/northing
-            point, userbuffer, buffer_feature, input_handles = searcharea_frompoint(easting, northing, buffer_radius)
-            xmin, ymin, xmax, ymax = buffer_feature.bounds  # get bounds of the buffer
-            # set the extent of the frame on the buffer with a 200m buffer to edge of axis
-            ax.set_extent([(xmin-200), (xmax+200), (ymin-200), (ymax+200)], crs=myCRS)
-
-    # Create buffer from BNG grid reference
-    elif values["-GRIDREF-"] and values["-RADIUS-"]:  # Only proceed if these values are selected
-        window["-DIALOGUE-"].update('Point and buffer selected', text_color='green')
-        buffer_radius = float(values["-RADIUS-"])  # transform user buffer radius values into float
-        gridref = str(values["-GRIDREF-"])  # transform user Grid Ref into float
-        if len(gridref) % 2 == 1:  # Handle errors with invalid grid reference lengths
-            sg.popup('not a valid grid reference length')
+        # Ensure the output save location field is populated
+        if values["-OUTFOLDER-"] == '' and event == "-PROCEED-":  # Check to see if user has populated Site Name field
+            sg.popup('output location required')  # popup window - prompt user to specify save location
             continue
-        else:
-            gridref = bng.to_osgb36(gridref)  # convert the grid ref to easting & northing values
-            easting = gridref[0]  # get easting from grid ref
-            northing = gridref[1]  # get northing from grid ref
-
-        if event == "-PROCEED-":
-            # call function to create buffer from easting/northing
-            point, userbuffer, buffer_feature, input_handles = searcharea_frompoint(easting, northing, buffer_radius)
-            xmin, ymin, xmax, ymax = buffer_feature.bounds  # get bounds of the buffer
-            # set the extent of the frame on the buffer with a 200m buffer to edge of axis
-            ax.set_extent([(xmin-200), (xmax+200), (ymin-200), (ymax+200)], crs=myCRS)
-
-    # Create buffer from user specified polygon
-    elif values["-BDYFILE-"] and values["-RADIUS-"]:
-        window["-DIALOGUE-"].update('polygon and buffer selected', text_color='green')  # update dialogue
-        buffer_radius = float(values["-RADIUS-"])  # transform user buffer radius values into float
-
-        if event == "-PROCEED-":
-            # call function to produce buffer from user polygon
-            userpoly, userbuffer, buffer_feature, input_handles = \
-                    searcharea_frompoly(values["-BDYFILE-"], buffer_radius)
-            xmin, ymin, xmax, ymax = buffer_feature.bounds   # get bounds of the buffer
-            # set the extent of the frame, give a 200m buffer to avoid being tight to edge of buffer feature
-            ax.set_extent([(xmin-200), (xmax+200), (ymin-200), (ymax+200)], crs=myCRS)
-
-    else:  # Reset prompt to ask user for search area
-        window["-DIALOGUE-"].update('Please specify a search area', text_color='red')
-
-    # Search for all protected species in user created buffer
-    if values["-SPP-"] and event == "-PROCEED-":
-        sppSearch, sppConcat, sppOutput = searchSpecies()  # Call species search function
-        spptypes, spplabels = sppstyle()  # Call species style function
-        handles = input_handles + spplabels  # Combine user features and species handles
-        leg = fig.legend(handles=handles, loc='lower center', bbox_to_anchor=(0.5, 0),
-                         title='Legend', title_fontsize=14, ncol=4, fontsize=10, frameon=True, framealpha=1)
-        plt.suptitle(values["-SITENAME-"] + ' species map', fontsize=16)
-        # Save output to excel file in user specified folder
-        sppOutput.to_excel(values["-OUTFOLDER-"] + '/' + values["-ENQNO-"] + '_SpeciesSearchResults.xlsx')
-        # Update window to tell user search was completed
-        window["-SEARCHSTATUS-"].update('Species search completed')
-
-    elif values["-SPP-"]:
-        window["-SEARCHSTATUS-"].update('Species search selected', text_color='green')
-
-    # Search for GCN only
-    if values["-GCN-"] and event == "-PROCEED-":
-        gcnSearch, gcnOutput, gcn_labels = searchGCNs()  # Call GCN search function
-        handles = input_handles + gcn_labels  # Combine user features and GCN handles
-        gcnSearch.plot(ax=ax, marker='o', color='yellow', edgecolor='black')  # Plot GCN search data to map
-        # Create legend
-        leg = fig.legend(handles=handles, loc='upper center', bbox_to_anchor=(0.5, -0.05), title='Legend',
-                         title_fontsize=14, ncol=3, fontsize=10, frameon=True, framealpha=1)
-        plt.suptitle(values["-SITENAME-"] + ' Great Crested Newt map')  # map title
-        # Save output to excel file in user specified folder
-        gcnOutput.to_excel(values["-OUTFOLDER-"] + '/' + values["-ENQNO-"] + '_GCNSearchResults.xlsx')
-        # Update window to tell user search was completed
-        window["-SEARCHSTATUS-"].update('Species search completed', text_color='green')  # Update dialogue message
-
-    elif values["-GCN-"]:
-        window["-SEARCHSTATUS-"].update('GCN search selected', text_color='green')
-
-    # Search for Bats only
-    if values["-BATS-"] and event == "-PROCEED-":
-        batSearch, batOutput, bat_labels = searchBats()  # Call bats search function
-        handles = input_handles + bat_labels  # Combine user features and bats handles
-        batSearch.plot(ax=ax, marker='^', color='deepskyblue', edgecolor='black')  # Plot bats search data to map
-        # Create legend
-        leg = fig.legend(handles=bat_labels, title='Legend', title_fontsize=14, ncol=3,
-                         fontsize=10, loc='lower center', frameon=True, framealpha=1)
-        plt.suptitle(values["-SITENAME-"] + ' bats map')
-        # Save output to excel file in user specified folder
-        batOutput.to_excel(values["-OUTFOLDER-"] + '/' + values["-ENQNO-"] + '_BatsSearchResults.xlsx')
-        # Update window to tell user search was completed
-        window["-SEARCHSTATUS-"].update('Species search completed', text_color='green')
-
-    elif values["-BATS-"]:
-        window["-SEARCHSTATUS-"].update('Bat search selected', text_color='green')
-
-    # Search for invasive species only - note these are not supposed to plot to map
-    if values["-INV-"] and event == "-PROCEED-":
-        invSearch, invOutput = searchInvasive()
-        # invSearch.plot(ax=ax, marker='.', color='black')
-        # Save output to excel file in user specified folder
-        invOutput.to_excel(values["-OUTFOLDER-"] + '/' + values["-ENQNO-"] + '_InvasiveSearchResults.xlsx')
-        # Update window to tell user search was completed
-        window["-SEARCHSTATUS-"].update('Species search completed', text_color='green')
-
-    elif values["-INV-"]:
-        window["-SEARCHSTATUS-"].update('Bat search selected', text_color='green')
-
-    # Search for sites only
-    if values["-SITES-"] and event == "-PROCEED-":
-        sbiIntersect, basIntersect, site_labels, sitesOutput = searchSites()  # Call sites search function
-        handles = input_handles + site_labels  # Combine user features and sites handles
-        leg = fig.legend(handles=handles, title='Legend', title_fontsize=14, ncol=3,
-                         fontsize=10, loc='lower center', frameon=True, framealpha=1)
-        plt.suptitle(values["-SITENAME-"] + ' nature conservation sites map')
-        # Save output to excel file in user specified folder
-        sitesOutput.to_excel(values["-OUTFOLDER-"] + '/' + values["-ENQNO-"] + '_SitesSearchResults.xlsx')
-        # Update window to tell user search was completed
-        window["-SEARCHSTATUS-"].update('Species search completed', text_color='green')
-
-    elif values["-SITES-"]:
-        window["-SEARCHSTATUS-"].update('Sites only search selected', text_color='green')
-
-    # Search for sites and species
-    if values["-SITESSPP-"] and event == "-PROCEED-":
-        sppSearch, sppConcat, sppOutput = searchSpecies()  # run spp search
-        spptypes, spplabels = sppstyle()  # plot spp, style and return labels
-        sbiIntersect, basIntersect, sites_labels, sitesOutput = searchSites()  # sites search, plot, return handles
-        handles = input_handles + sites_labels + spplabels  # Create list of spp and sites handles
-        # Create legend
-        leg = fig.legend(handles=handles, title='Legend', title_fontsize=14, ncol=3,
-                         fontsize=10, loc='lower center', frameon=True, framealpha=1)
-        plt.suptitle(values["-SITENAME-"] + ' protected species and nature conservation sites map')
-
-        # Save output to excel file in user specified folder
-        sppOutput.to_excel(values["-OUTFOLDER-"] + '/' + values["-ENQNO-"] + '_SpeciesSearchResults.xlsx')
-        # Save output to excel file in user specified folder
-        sitesOutput.to_excel(values["-OUTFOLDER-"] + '/' + values["-ENQNO-"] + '_SitesSearchResults.xlsx')
-        # Update window to tell user search was completed
-        window["-SEARCHSTATUS-"].update('Sites and species search completed', text_color='green')
-
-    elif values["-SITESSPP-"]:
-        window["-SEARCHSTATUS-"].update('Sites and species search selected', text_color='green')
-
-    valuelist = [values]  # Create a list of all checkboxes in the GUI
-
-    if valuelist == [None]:
-        # update GUI dialogue if no values detected
-        window["-SEARCHSTATUS-"].update('Please specify search parameters', text_color='red')
-
-    # Save the completed map to user specified folder
-    if event == "-PROCEED-":
-        fig.savefig(values["-OUTFOLDER-"] + '/' + values["-ENQNO-"] + 'map.jpeg', bbox_inches='tight', dpi=300)
+
+        # Check the search area
+        search_area = False
+        if values["-EASTING-"] and values["-NORTHING-"] and values["-RADIUS-"]:  # Only proceed if these values are
+            # selected
+            window["-DIALOGUE-"].update('Point and buffer selected', text_color='green')
+            search_area = True
+
+        elif values["-GRIDREF-"] and values["-RADIUS-"]:  # Only proceed if these values are selected
+            window["-DIALOGUE-"].update('Point and buffer selected', text_color='green')
+            error = gridref_to_osgb36(values["-GRIDREF-"])[2][0]  # Handle errors with invalid grid references
+            if error is not None and event == "-PROCEED-":  # not while the grid reference is being typed
+                sg.popup('not a valid grid reference: ' + error)
+                continue
+            search_area = True
+
+        elif values["-BDYFILE-"] and values["-RADIUS-"]:
+            window["-DIALOGUE-"].update('polygon and buffer selected', text_color='green')  # update dialogue
+            search_area = True
+
+        else:  # Reset prompt to ask user for search area
+            window["-DIALOGUE-"].update('Please specify a search area', text_color='red')
+
+        # Update the search status with the selected searches
+        if values["-SPP-"]:
+            window["-SEARCHSTATUS-"].update('Species search selected', text_color='green')
+        if values["-GCN-"]:
+            window["-SEARCHSTATUS-"].update('GCN search selected', text_color='green')
+        if values["-BATS-"]:
+            window["-SEARCHSTATUS-"].update('Bat search selected', text_color='green')
+        if values["-INV-"]:
+            window["-SEARCHSTATUS-"].update('Invasive species search selected', text_color='green')
+        if values["-SITES-"]:
+            window["-SEARCHSTATUS-"].update('Sites only search selected', text_color='green')
+        if values["-SITESSPP-"]:
+            window["-SEARCHSTATUS-"].update('Sites and species search selected', text_color='green')
+
+        if not selected_searches(values):
+            # update GUI dialogue if no values detected
+            window["-SEARCHSTATUS-"].update('Please specify search parameters', text_color='red')
+
+        # Run the enquiry (map, searches and spreadsheets) when the user clicks proceed
+        if event == "-PROCEED-" and search_area:
+            enquiry = {'enqno': values["-ENQNO-"],
+                       'sitename': values["-SITENAME-"],
+                       'outfolder': values["-OUTFOLDER-"],
+                       'easting': values["-EASTING-"],
+                       'northing': values["-NORTHING-"],
+                       'gridref': values["-GRIDREF-"],
+                       'bdyfile': values["-BDYFILE-"],
+                       'per_feature': values["-PERFEATURE-"],
+                       'radius': values["-RADIUS-"],
+                       'searches': selected_searches(values),
+                       'format': values["-FORMAT-"],
+                       'map_format': values["-MAPFORMAT-"],
+                       'map_dpi': values["-MAPDPI-"],
+                       'gridref_digits': values["-GRIDDIGITS-"],
+                       'year_from': values["-YEARFROM-"],
+                       'year_to': values["-YEARTO-"]}
+
+            # Run the enquiry on the enquiry thread, the window is updated as each stage is completed
+            running_enquiries = {future: cancel for future, cancel in running_enquiries.items() if not future.done()}
+            cancel = threading.Event()
+            running_enquiries[enquiry_runner.submit(enquiry_thread, enquiry, cancel)] = cancel
+            window["-SEARCHSTATUS-"].update('Enquiry ' + enquiry['enqno'] + ' queued', text_color='green')
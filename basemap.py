@@ -0,0 +1,234 @@
+import json
+import os
+import xml.etree.ElementTree as ET
+from pathlib import Path
+
+import numpy as np
+import rasterio as rio
+from rasterio.enums import Resampling
+from rasterio.shutil import copy as rio_copy
+from rasterio.windows import Window, from_bounds, intersect
+
+
+# GDAL data type names used in the VRT for each numpy dtype
+VRT_DTYPES = {'uint8': 'Byte', 'int8': 'Int8', 'uint16': 'UInt16', 'int16': 'Int16', 'uint32': 'UInt32',
+              'int32': 'Int32', 'float32': 'Float32', 'float64': 'Float64'}
+
+# Overview levels built for each tile, so zoomed out maps read a reduced copy of the tile
+OVERVIEW_LEVELS = [2, 4, 8, 16]
+
+
+def tile_signature(tile):
+    """
+    Returns the modified time and size of a basemap tile, used to tell if the tile has been added or replaced.
+
+    Parameters:
+        tile: Path of the tile
+
+    Returns:
+        signature: list of [modified time in ns, size in bytes]
+    """
+
+    return [tile.stat().st_mtime_ns, tile.stat().st_size]
+
+
+def read_tile_info(tile, overviews=True):
+    """
+    Reads the header of a basemap tile (no pixel values are read) and, if required, builds overviews for the tile.
+    Overviews are written to an external .ovr file next to the tile so the tile itself is left unchanged. Where the
+    .ovr file cannot be written (e.g. tiles on a read-only share) the tile is used without overviews.
+
+    Parameters:
+        tile: Path of the tile
+
+        overviews: build overviews for the tile if it does not already have them
+
+    Returns:
+        info: dictionary of the tile information needed to add the tile to the VRT
+    """
+
+    if overviews:
+        try:
+            with rio.Env(TIFF_USE_OVR=True), rio.open(tile, 'r+') as dataset:
+                if not dataset.overviews(1):
+                    dataset.build_overviews(OVERVIEW_LEVELS, Resampling.average)
+        except Exception:  # the tile can't be opened for update (GDAL raises several error types for this)
+            pass
+
+    with rio.open(tile) as dataset:
+        info = {'signature': tile_signature(tile),
+                'bounds': list(dataset.bounds),
+                'width': dataset.width,
+                'height': dataset.height,
+                'res': list(dataset.res),
+                'count': dataset.count,
+                'dtype': dataset.dtypes[0],
+                'nodata': dataset.nodata,
+                'block': list(dataset.block_shapes[0]),
+                'crs': dataset.crs.to_wkt() if dataset.crs else None}
+
+    return info
+
+
+def write_vrt(tiles, vrt_path):
+    """
+    Writes a virtual mosaic (VRT) referencing each basemap tile. Only the tile headers are needed to write the VRT,
+    the tiles are read when the basemap is displayed, and only the tiles covering the map extent are read.
+
+    Parameters:
+        tiles: dictionary of tile path: tile information from read_tile_info
+
+        vrt_path: Path of the VRT to write
+    """
+
+    infos = list(tiles.values())
+    xres, yres = infos[0]['res']  # the mosaic uses the resolution of the first tile
+    xmin = min(info['bounds'][0] for info in infos)
+    ymin = min(info['bounds'][1] for info in infos)
+    xmax = max(info['bounds'][2] for info in infos)
+    ymax = max(info['bounds'][3] for info in infos)
+    width = int(round((xmax - xmin) / xres))
+    height = int(round((ymax - ymin) / yres))
+
+    vrt = ET.Element('VRTDataset', rasterXSize=str(width), rasterYSize=str(height))
+    ET.SubElement(vrt, 'SRS').text = infos[0]['crs'] or 'EPSG:27700'
+    ET.SubElement(vrt, 'GeoTransform').text = ', '.join(str(v) for v in [xmin, xres, 0.0, ymax, 0.0, -yres])
+
+    for band in range(1, infos[0]['count'] + 1):
+        vrtband = ET.SubElement(vrt, 'VRTRasterBand', dataType=VRT_DTYPES[infos[0]['dtype']], band=str(band))
+        if infos[0]['nodata'] is not None:
+            ET.SubElement(vrtband, 'NoDataValue').text = str(infos[0]['nodata'])
+
+        for tile, info in tiles.items():
+            source = ET.SubElement(vrtband, 'SimpleSource')
+            filename = os.path.relpath(tile, vrt_path.parent)
+            ET.SubElement(source, 'SourceFilename', relativeToVRT='1').text = Path(filename).as_posix()
+            ET.SubElement(source, 'SourceBand').text = str(band)
+            ET.SubElement(source, 'SourceProperties', RasterXSize=str(info['width']),
+                          RasterYSize=str(info['height']), DataType=VRT_DTYPES[info['dtype']],
+                          BlockXSize=str(info['block'][1]), BlockYSize=str(info['block'][0]))
+            ET.SubElement(source, 'SrcRect', xOff='0', yOff='0', xSize=str(info['width']),
+                          ySize=str(info['height']))
+            # position of the tile in the mosaic, in mosaic pixels
+            ET.SubElement(source, 'DstRect',
+                          xOff=str(int(round((info['bounds'][0] - xmin) / xres))),
+                          yOff=str(int(round((ymax - info['bounds'][3]) / yres))),
+                          xSize=str(int(round((info['bounds'][2] - info['bounds'][0]) / xres))),
+                          ySize=str(int(round((info['bounds'][3] - info['bounds'][1]) / yres))))
+
+    ET.ElementTree(vrt).write(vrt_path)
+
+
+def build_basemap(tile_dir='SampleData/basemaps/', vrt_path='output/basemap.vrt', cog_path=None, overviews=True):
+    """
+    Builds the basemap for the map plot as a virtual mosaic (VRT) of the raster tiles, replacing the merged
+    mosaic.tif produced by rastermosaic. The tiles are never loaded into memory, only their headers are read.
+
+    The VRT is updated incrementally: a manifest of the tiles in the VRT is kept next to it, and only tiles which
+    have been added or replaced since the last build are opened (and have overviews built). If no tiles have
+    changed the existing VRT is used.
+
+    Optionally the VRT can also be written out as a tiled Cloud-Optimized GeoTIFF (COG) with internal overviews,
+    e.g. to copy the basemap to another machine. GDAL streams the VRT into the COG block by block.
+
+    Parameters:
+        tile_dir: folder containing the basemap tifs
+
+        vrt_path: location of the VRT to create
+
+        cog_path: location of a COG to create from the VRT, not created if not given
+
+        overviews: build overviews for new or replaced tiles
+
+    Returns:
+        output_path: Location and name of the basemap (the COG if cog_path is given, otherwise the VRT)
+    """
+
+    vrt_path = Path(vrt_path)
+    vrt_path.parent.mkdir(parents=True, exist_ok=True)  # create output directory
+    manifest_path = vrt_path.with_suffix('.json')  # tiles included in the VRT
+
+    manifest = {}
+    if manifest_path.exists() and vrt_path.exists():
+        manifest = json.loads(manifest_path.read_text())
+
+    tile_paths = sorted(p for p in Path(tile_dir).iterdir() if p.suffix.lower() in ['.tif', '.tiff'])
+
+    tiles = {}
+    for tile in tile_paths:
+        info = manifest.get(str(tile))
+        if info is None or info['signature'] != tile_signature(tile):  # new or replaced tile
+            info = read_tile_info(tile, overviews=overviews)
+            info['signature'] = tile_signature(tile)
+        tiles[str(tile)] = info
+
+    changed = tiles != manifest
+    if changed:
+        write_vrt(tiles, vrt_path)
+        manifest_path.write_text(json.dumps(tiles))
+
+    if cog_path is None:
+        return str(vrt_path)
+
+    if changed or not Path(cog_path).exists():
+        rio_copy(str(vrt_path), str(cog_path), driver='COG', compress='DEFLATE', overview_resampling='AVERAGE')
+
+    return str(cog_path)
+
+
+def load_basemap(filepath, bounds=None, out_size=None):
+    """
+    Loads a raster basemap into the axis plot.
+
+    If bounds are given only the window of the raster covering the bounds is read, rather than the whole basemap.
+    If out_size is also given the window is decimated as it is read so it is no larger than the number of pixels
+    it will be displayed at on the saved map, so memory and load time depend on the map size and not the size of
+    the basemap. For a VRT or COG basemap only the tiles and overview level needed are read.
+
+    Parameters:
+        filepath: location of the raster dataset
+
+        bounds: (xmin, ymin, xmax, ymax) extent of the map in EPSG:27700, reads the whole basemap if not given
+
+        out_size: (width, height) in pixels the map extent is displayed at, e.g. figure size in inches * dpi
+
+    Returns:
+        bmxmin: x-axis minimum extent values from basemap
+
+        bmymin: y-axis minimum extent values from basemap
+
+        bmxmax: x-axis maximum extent values from basemap
+
+        bmymax: y-axis maximum extent values from basemap
+
+        dispimg: the basemap image, None if the bounds do not overlap the basemap
+
+    """
+    with rio.open(filepath) as dataset:
+        if bounds is None:
+            img = dataset.read()
+            bmxmin, bmymin, bmxmax, bmymax = dataset.bounds
+
+        else:
+            # Window of the basemap covering the map extent, clipped to the edge of the basemap
+            window = from_bounds(*bounds, transform=dataset.transform)
+            extent = Window(0, 0, dataset.width, dataset.height)
+            if not intersect(window, extent):  # the map is outside the basemap, there is nothing to read
+                return bounds[0], bounds[1], bounds[2], bounds[3], None
+            window = window.intersection(extent).round_offsets().round_lengths()
+            if window.width < 1 or window.height < 1:  # the map only touches the edge of the basemap
+                return bounds[0], bounds[1], bounds[2], bounds[3], None
+            bmxmin, bmymin, bmxmax, bmymax = dataset.window_bounds(window)
+
+            out_shape = (dataset.count, window.height, window.width)
+            if out_size is not None:
+                # Only read as many pixels as will be shown on the saved map
+                factor = max(1, min(window.width / out_size[0], window.height / out_size[1]))
+                out_shape = (dataset.count, int(np.ceil(window.height / factor)), int(np.ceil(window.width / factor)))
+
+            img = dataset.read(window=window, out_shape=out_shape, resampling=Resampling.average)
+
+    dispimg = img.astype(np.float32, copy=False)
+    dispimg = dispimg.transpose([1, 2, 0])
+
+    return bmxmin, bmymin, bmxmax, bmymax, dispimg
@@ -0,0 +1,230 @@
+"""
+Headless batch enquiry runner.
+
+Runs many data search enquiries from a CSV or JSON manifest without the GUI, using the same search, map and
+spreadsheet process as the GUI (run_enquiry). Enquiries are shared between a pool of worker processes, each worker
+loads the search layers once and reuses them for every enquiry it runs.
+
+Manifest columns (CSV) / keys (JSON list of objects):
+    enqno, sitename, easting, northing -OR- gridref -OR- bdyfile, radius, searches, outfolder
+    and optionally format, map_format, map_dpi, per_feature, gridref_digits, year_from and year_to (see run_enquiry)
+
+searches lists the searches to run, from species, bats, gcn, invasive, sites and sitesspp. In a CSV these are
+separated by semicolons, e.g. "species;sites".
+
+Usage:
+    python batch_enquiry.py manifest.csv --workers 4
+"""
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import matplotlib
+matplotlib.use('Agg')  # no GUI is used to draw the maps
+
+import pandas as pd
+from basemap import build_basemap
+from enquiry import run_enquiry
+from enquiry_log import LOG_PATH, EnquiryLogger
+from gridref import gridref_to_osgb36
+from layers import DATED_LAYERS, LAYER_COLUMNS, LAYER_FILES, SEARCH_LAYERS, LayerStore, selected_layers, tile_layer
+from resultcache import ResultCache
+
+
+# Search layers, basemap and enquiry logger of each worker process, set by init_worker
+worker_layers = None
+worker_basemap = None
+worker_log = None
+
+
+def read_manifest(manifest_path, outfolder=None):
+    """
+    Reads a CSV or JSON manifest of enquiries.
+
+    Parameters:
+        manifest_path: filepath of the manifest (.csv or .json)
+
+        outfolder: output folder for enquiries which do not specify one
+
+    Returns:
+        enquiries: list of enquiry dictionaries, as used by run_enquiry
+    """
+
+    manifest_path = Path(manifest_path)
+    if manifest_path.suffix.lower() == '.json':
+        enquiries = json.loads(manifest_path.read_text())
+    else:
+        enquiries = pd.read_csv(manifest_path, dtype=str, keep_default_na=False).to_dict('records')
+
+    return prepare_enquiries(enquiries, outfolder)
+
+
+def prepare_enquiries(enquiries, outfolder=None):
+    """
+    Checks and completes a list of enquiries, e.g. from a manifest or the search service: splits and checks the
+    search types, fills in the output folder and converts the grid references to eastings and northings.
+
+    Parameters:
+        enquiries: list of enquiry dictionaries
+
+        outfolder: output folder for enquiries which do not specify one
+
+    Returns:
+        enquiries: the list of enquiry dictionaries, as used by run_enquiry
+    """
+
+    for enquiry in enquiries:
+        searches = enquiry.get('searches', [])
+        if isinstance(searches, str):
+            searches = [search.strip() for search in searches.split(';') if search.strip()]
+        unknown = [search for search in searches if search not in SEARCH_LAYERS]
+        if unknown:
+            raise ValueError('enquiry {}: unknown search type {}'.format(enquiry.get('enqno'), ', '.join(unknown)))
+        enquiry['searches'] = searches
+
+        if not enquiry.get('outfolder'):
+            enquiry['outfolder'] = outfolder or '.'
+        enquiry['enqno'] = str(enquiry['enqno'])
+        enquiry['sitename'] = str(enquiry.get('sitename', ''))
+
+    # Convert the grid references of all the point enquiries at once, reporting every invalid grid reference
+    gridref_enquiries = [enquiry for enquiry in enquiries if enquiry.get('gridref')
+                         and (enquiry.get('easting') in [None, ''] or enquiry.get('northing') in [None, ''])]
+    if gridref_enquiries:
+        eastings, northings, errors = gridref_to_osgb36([str(enquiry['gridref']) for enquiry in gridref_enquiries])
+        invalid = ['enquiry {}: not a valid grid reference {} ({})'.format(enquiry['enqno'], enquiry['gridref'], error)
+                   for enquiry, error in zip(gridref_enquiries, errors) if error is not None]
+        if invalid:
+            raise ValueError('\n'.join(invalid))
+        for enquiry, easting, northing in zip(gridref_enquiries, eastings, northings):
+            enquiry['easting'], enquiry['northing'] = float(easting), float(northing)
+
+    return enquiries
+
+
+def init_worker(basemap_path, layer_names, profile_threshold=None, on_demand=False):
+    """
+    Sets up a worker process: creates the worker's layer store and starts loading the layers needed by the
+    manifest in the background, so they are loaded once per worker rather than once per enquiry.
+
+    Parameters:
+        basemap_path: location of the basemap raster
+
+        layer_names: names of the layers needed by the enquiries in the manifest
+
+        profile_threshold: time in seconds above which an enquiry's profile is saved, see EnquiryLogger
+
+        on_demand: read only the records near each enquiry rather than loading the layers, see LayerStore
+    """
+
+    global worker_layers, worker_basemap, worker_log
+    worker_layers = LayerStore(result_cache=ResultCache(), on_demand=on_demand)
+    worker_layers.request(layer_names)
+    worker_basemap = basemap_path
+    # the enquiry records are passed back to the main process to be logged, so only one process writes the log
+    worker_log = EnquiryLogger(log_path=None, profile_threshold=profile_threshold)
+
+
+def run_worker_enquiry(enquiry):
+    """
+    Runs a single enquiry in a worker process, using the worker's layers.
+
+    Parameters:
+        enquiry: enquiry dictionary, as used by run_enquiry
+
+    Returns:
+        enqno: the enquiry number
+
+        outputs: list of the files saved, or the error raised by the enquiry
+
+        record: the enquiry log record, see EnquiryLogger
+    """
+
+    Path(enquiry['outfolder']).mkdir(parents=True, exist_ok=True)
+    try:
+        # the enquiries are already shared between processes, so each enquiry draws its maps in its own process
+        outputs = run_enquiry(enquiry, worker_layers, worker_basemap, progress=lambda message: None,
+                              parallel_maps=False, log=worker_log)
+    except Exception as error:  # the record of the failed enquiry is still returned to be logged
+        outputs = error
+
+    return enquiry['enqno'], outputs, worker_log.last_record
+
+
+def run_batch(enquiries, workers=None, basemap_dir='SampleData/basemaps/', log=None, profile_threshold=None,
+              on_demand=False):
+    """
+    Runs a list of enquiries across a pool of worker processes.
+
+    Parameters:
+        enquiries: list of enquiry dictionaries, as used by run_enquiry
+
+        workers: number of worker processes, defaults to the number of CPUs
+
+        basemap_dir: folder containing the basemap tifs
+
+        log: optional EnquiryLogger to write the record of each enquiry to
+
+        profile_threshold: time in seconds above which an enquiry's profile is saved, see EnquiryLogger
+
+        on_demand: read only the records near each enquiry rather than loading the whole of each layer in every
+        worker, for datasets too large to hold in memory (see LayerStore)
+
+    Returns:
+        results: dictionary of enquiry number: list of files saved, or the error raised by the enquiry
+    """
+
+    basemap_path = build_basemap(basemap_dir)  # built once here so the workers do not all update it
+
+    layer_names = selected_layers(sorted({search for enquiry in enquiries for search in enquiry['searches']}))
+    workers = min(workers or os.cpu_count() or 1, len(enquiries)) or 1
+    if on_demand:  # tiled once here so the workers do not all tile the same layers
+        for name in layer_names:
+            tile_layer(LAYER_FILES[name], columns=LAYER_COLUMNS.get(name), sort_years=name in DATED_LAYERS)
+
+    results = {}
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(basemap_path, layer_names, profile_threshold, on_demand)) as pool:
+        futures = {pool.submit(run_worker_enquiry, enquiry): enquiry['enqno'] for enquiry in enquiries}
+        for future in as_completed(futures):
+            enqno = futures[future]
+            try:
+                enqno, outputs, record = future.result()
+                if log is not None and record is not None:
+                    log.write(record)
+            except Exception as error:  # e.g. the worker process died, carry on with the rest of the batch
+                outputs = error
+            results[enqno] = outputs
+            if isinstance(outputs, Exception):  # report the failed enquiry and carry on with the rest of the batch
+                print('Enquiry {} failed: {}'.format(enqno, outputs))
+            else:
+                print('Enquiry {} completed'.format(enqno))
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run data search enquiries from a CSV or JSON manifest.')
+    parser.add_argument('manifest', help='CSV or JSON manifest of enquiries')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes')
+    parser.add_argument('--outfolder', default=None, help='output folder for enquiries which do not specify one')
+    parser.add_argument('--log', default=str(LOG_PATH), help='log file of the time and memory use of each enquiry')
+    parser.add_argument('--profile-threshold', type=float, default=None,
+                        help='save a cProfile profile of enquiries taking longer than this many seconds')
+    parser.add_argument('--on-demand', action='store_true',
+                        help='read only the records near each enquiry, for layers too large to hold in memory')
+    args = parser.parse_args()
+
+    enquiries = read_manifest(args.manifest, outfolder=args.outfolder)
+
+    start = time.perf_counter()
+    results = run_batch(enquiries, workers=args.workers, log=EnquiryLogger(args.log),
+                        profile_threshold=args.profile_threshold, on_demand=args.on_demand)
+    elapsed = time.perf_counter() - start
+
+    failed = [enqno for enqno, result in results.items() if isinstance(result, Exception)]
+    print('{} enquiries in {:.1f}s ({:.1f} enquiries per minute), {} failed'
+          .format(len(enquiries), elapsed, 60 * len(enquiries) / elapsed, len(failed)))
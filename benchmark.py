@@ -0,0 +1,439 @@
+"""
+Benchmark of the data search enquiry stages on synthetic master layers.
+
+Generates synthetic layers in British National Grid at a given scale (number of protected species records): species
+points, 1km precision species squares, invasive species points and squares, and SBI and BAS site polygons, with the
+same columns as the master layers. Each stage of an enquiry is then timed separately (layer load, buffer creation,
+spatial search in memory and on demand, each search function, species styling, map rendering and results export)
+and the timings are written to a JSON file, which can be compared against an earlier run to catch regressions.
+
+Generated layers are kept in the data folder and reused by later runs with the same scale and seed.
+
+Usage:
+    python benchmark.py --scales 10000 100000 1000000 --output benchmark.json
+    python benchmark.py --scales 10000 --compare benchmark.json
+"""
+import argparse
+import json
+import platform
+import shutil
+import statistics
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+
+import matplotlib
+matplotlib.use('Agg')  # maps are only saved
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import rasterio as rio
+from rasterio.transform import from_bounds
+from shapely.geometry import Point
+
+from enquiry import (MAP_PRODUCTS, MAP_DPI, map_template, render_map, searcharea_frompoint, search_layers,
+                     searchBats, searchGCNs, searchInvasive, searchSites, searchSpecies, sppstyle)
+from export import export_results
+from gridref import GRID_DIGITS, regenerate_gridrefs
+from layers import (DATED_LAYERS, GRID_LAYERS, LAYER_COLUMNS, LayerStore, build_grid_index, build_index, load_layer,
+                    tile_layer)
+
+
+# Folder the synthetic layers are generated in
+DATA_DIR = Path('output/benchmark/data')
+
+# Centre of the synthetic layers and limits of the British National Grid
+CENTRE = (400000, 300000)
+BNG_BOUNDS = (0, 0, 700000, 1300000)
+
+# Species records per square km, the extent of the layers grows with the scale so searches find a similar number
+# of records at every scale
+DENSITY = 40
+
+# Size of each layer as a fraction of the number of species records
+LAYER_FRACTIONS = {'species': 1, 'species1km': 0.1, 'invasive': 0.1, 'invasive1km': 0.01, 'sbi': 0.01, 'bas': 0.01}
+
+# Values used for the generated records
+SPECIES = [('Otter', 'mammal'), ('Water Vole', 'mammal'), ('Eurasian Badger', 'mammal'), ('Hedgehog', 'mammal'),
+           ('Common Pipistrelle', 'mammal - bat'), ('Noctule', 'mammal - bat'), ('Barn Owl', 'bird'),
+           ('Skylark', 'bird'), ('Great Crested Newt', 'amphibian'), ('Common Toad', 'amphibian'),
+           ('Grass Snake', 'reptile'), ('White-clawed Freshwater Crayfish', 'crustacean'),
+           ('Bluebell', 'flowering plant'), ('Bee Orchid', 'flowering plant')]
+INVASIVE = [('Japanese Knotweed', 'flowering plant'), ('Himalayan Balsam', 'flowering plant'),
+            ('Signal Crayfish', 'crustacean'), ('Grey Squirrel', 'mammal')]
+STATUSES = ['SBI', 'Potential SBI', 'Former SBI']
+
+# Search radius used for the benchmark enquiry
+RADIUS = 2000
+
+
+def layer_extent(scale):
+    """
+    Returns the extent of the synthetic layers for a scale, a square around CENTRE within the BNG limits.
+
+    Parameters:
+        scale: number of species records
+
+    Returns:
+        extent: (xmin, ymin, xmax, ymax)
+    """
+
+    half = np.sqrt(scale / DENSITY) * 1000 / 2
+    return (max(CENTRE[0] - half, BNG_BOUNDS[0]), max(CENTRE[1] - half, BNG_BOUNDS[1]),
+            min(CENTRE[0] + half, BNG_BOUNDS[2]), min(CENTRE[1] + half, BNG_BOUNDS[3]))
+
+
+def species_records(rng, count, names, extent, square=False):
+    """
+    Generates species records, as points (100m precision or better) or as 1km grid squares.
+
+    Parameters:
+        rng: numpy random Generator
+
+        count: number of records
+
+        names: list of (CommonName, InformalGr) to pick from
+
+        extent: (xmin, ymin, xmax, ymax) of the records
+
+        square: generate 1km grid squares instead of points
+
+    Returns:
+        records: Geodataframe of the records in EPSG:27700
+    """
+
+    xmin, ymin, xmax, ymax = extent
+    picks = rng.integers(0, len(names), count)
+    if square:  # whole 1km squares, as in the 1km precision layers
+        x = (np.floor(rng.uniform(xmin, xmax, count) / 1000) + 0.5) * 1000
+        y = (np.floor(rng.uniform(ymin, ymax, count) / 1000) + 0.5) * 1000
+        precision = np.full(count, 2)  # digits per axis, i.e. 4 figure references
+    else:
+        x = np.round(rng.uniform(xmin, xmax, count), -1)
+        y = np.round(rng.uniform(ymin, ymax, count), -1)
+        precision = rng.choice([3, 4], count)  # 100m and 10m, 6 and 8 figure references
+    year = rng.integers(1990, 2022, count)
+    dates = pd.to_datetime(year.astype(str), format='%Y') + pd.to_timedelta(rng.integers(0, 365, count), unit='D')
+
+    records = pd.DataFrame({
+        'SciName': ['Species ' + str(p) for p in picks],
+        'CommonName': [names[p][0] for p in picks],
+        'InformalGr': [names[p][1] for p in picks],
+        'Location': 'Synthetic site',
+        'LocDetail': '',
+        'GridRef': '',
+        'Grid1km': '',
+        'Date': dates,
+        'Year': year,
+        'Source': 'Synthetic',
+        'SampleMeth': 'Field observation',
+        'SexStage': '',
+        'RecType': 'Sighting',
+        'EuProt': rng.choice(['', 'Habitats Directive Annex 4'], count),
+        'UKProt': rng.choice(['', 'WCA Schedule 5'], count),
+        'PrincipalS': rng.choice(['', 'Section 41'], count),
+        'RareSpp': '',
+        'StatInvasi': '',
+        'StaffsINNS': '',
+        'RecordStat': 'Accepted',
+        'Confidenti': 'No',
+        'Easting': x.astype(int),
+        'Northing': y.astype(int),
+        'Precision': precision})
+    records = regenerate_gridrefs(records, GRID_DIGITS[-1])  # grid refs at the precision of each record
+
+    geometry = gpd.points_from_xy(x, y)
+    if square:
+        geometry = gpd.GeoSeries(geometry).buffer(500, cap_style=3).values  # square buffer of the square centre
+
+    return gpd.GeoDataFrame(records, geometry=geometry, crs='EPSG:27700')
+
+
+def site_records(rng, count, extent, prefix):
+    """
+    Generates SBI / BAS like site polygons.
+
+    Parameters:
+        rng: numpy random Generator
+
+        count: number of sites
+
+        extent: (xmin, ymin, xmax, ymax) of the sites
+
+        prefix: SiteID prefix, e.g. 'SBI'
+
+    Returns:
+        sites: Geodataframe of the sites in EPSG:27700
+    """
+
+    xmin, ymin, xmax, ymax = extent
+    x = rng.uniform(xmin, xmax, count)
+    y = rng.uniform(ymin, ymax, count)
+    radius = rng.uniform(50, 500, count)
+    shift = rng.uniform(-1, 1, (count, 2)) * radius[:, None]
+
+    # two overlapping circles, so some sites are concave
+    first = gpd.GeoSeries(gpd.points_from_xy(x, y)).buffer(radius, resolution=8)
+    second = gpd.GeoSeries(gpd.points_from_xy(x + shift[:, 0], y + shift[:, 1])).buffer(radius * 0.7, resolution=8)
+    geometry = first.union(second)
+
+    sites = pd.DataFrame({'SiteID': [prefix + str(i) for i in range(count)],
+                          'SiteName': ['Synthetic site ' + str(i) for i in range(count)],
+                          'Status': rng.choice(STATUSES, count),
+                          'Year': rng.integers(1990, 2022, count),
+                          'Abstract': 'Synthetic site for benchmarking'})
+
+    return gpd.GeoDataFrame(sites, geometry=geometry.values, crs='EPSG:27700')
+
+
+def synthetic_basemap(path, extent, size=2000):
+    """
+    Writes a single band greyscale basemap covering the synthetic layers, so the maps can be rendered.
+
+    Parameters:
+        path: filepath of the GeoTIFF to write
+
+        extent: (xmin, ymin, xmax, ymax) of the basemap
+
+        size: width and height of the basemap in pixels
+    """
+
+    rng = np.random.default_rng(0)
+    img = rng.integers(100, 255, (size, size), dtype=np.uint8)
+    with rio.open(path, 'w', driver='GTiff', width=size, height=size, count=1, dtype='uint8', crs='EPSG:27700',
+                  transform=from_bounds(*extent, size, size), tiled=True) as dataset:
+        dataset.write(img, 1)
+
+
+def generate_layers(scale, seed=0, data_dir=DATA_DIR):
+    """
+    Generates the synthetic layers and basemap for a scale, unless they have already been generated.
+
+    Parameters:
+        scale: number of species records
+
+        seed: random seed, the same scale and seed always generate the same layers
+
+        data_dir: folder to generate the layers in
+
+    Returns:
+        layer_files: dictionary of layer name: filepath (as LAYER_FILES)
+
+        basemap_path: filepath of the basemap
+    """
+
+    folder = Path(data_dir) / '{}_{}'.format(scale, seed)
+    folder.mkdir(parents=True, exist_ok=True)
+    extent = layer_extent(scale)
+    rng = np.random.default_rng(seed)
+
+    layer_files = {name: str(folder / (name + '.gpkg')) for name in LAYER_FRACTIONS}
+    for name, fraction in LAYER_FRACTIONS.items():
+        if Path(layer_files[name]).exists():
+            continue
+        count = max(int(scale * fraction), 100)
+        if name in ['sbi', 'bas']:
+            layer = site_records(rng, count, extent, name.upper())
+        else:
+            names = INVASIVE if name.startswith('invasive') else SPECIES
+            layer = species_records(rng, count, names, extent, square=name in GRID_LAYERS)
+        layer.to_file(layer_files[name], driver='GPKG')
+
+    basemap_path = folder / 'basemap.tif'
+    if not basemap_path.exists():
+        synthetic_basemap(basemap_path, extent)
+
+    return layer_files, str(basemap_path)
+
+
+def timed(timings, stage, func, *args, **kwargs):
+    """
+    Runs a function and adds its run time in seconds to the timings of a stage.
+
+    Parameters:
+        timings: dictionary of stage name: list of times
+
+        stage: name of the stage
+
+        func: function to run, with the remaining arguments
+
+    Returns:
+        result: the result of the function
+    """
+
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    timings.setdefault(stage, []).append(time.perf_counter() - start)
+
+    return result
+
+
+def run_benchmark(scale, repeat=3, seed=0, data_dir=DATA_DIR):
+    """
+    Times each stage of an enquiry on the synthetic layers of a scale. The layer load stages are timed from the
+    source files (cold) and from the columnar cache (cached), the other stages use the loaded and indexed layers
+    and are run repeat times.
+
+    Parameters:
+        scale: number of species records
+
+        repeat: number of times each enquiry stage is run
+
+        seed: random seed of the synthetic layers
+
+        data_dir: folder holding the synthetic layers
+
+    Returns:
+        timings: dictionary of stage name: list of times in seconds
+
+        found: dictionary of layer name: number of records found by the benchmark search
+    """
+
+    timings = {}
+    layer_files, basemap_path = timed(timings, 'generate', generate_layers, scale, seed, data_dir)
+    folder = Path(basemap_path).parent
+    cache_dir = folder / 'cache'
+    outfolder = folder / 'output'
+    outfolder.mkdir(exist_ok=True)
+
+    # Layer load, from the source files and then from the cache
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    for name, filepath in layer_files.items():
+        timed(timings, 'load_cold_' + name, load_layer, filepath, cache_dir, LAYER_COLUMNS[name], name in DATED_LAYERS)
+    for name, filepath in layer_files.items():
+        layer = timed(timings, 'load_cached_' + name, load_layer, filepath, cache_dir, LAYER_COLUMNS[name],
+                      name in DATED_LAYERS)
+        timed(timings, 'index_' + name, build_index, layer)
+        if name in GRID_LAYERS:
+            timed(timings, 'grid_index_' + name, build_grid_index, layer)
+        timed(timings, 'tile_' + name, tile_layer, filepath, cache_dir, LAYER_COLUMNS[name], name in DATED_LAYERS)
+
+    layers = LayerStore(layer_files, cache_dir=cache_dir)
+    layers.request(list(layer_files))
+    for name in layer_files:
+        layers.get(name)
+    on_demand = LayerStore(layer_files, cache_dir=cache_dir, on_demand=True)  # reads the tiles near the search
+
+    searches = ['species', 'bats', 'gcn', 'invasive', 'sites']
+    template = map_template()
+    centre = Point(*CENTRE)
+
+    for run in range(repeat):
+        userfeat, userbuffer, buffer_feature, input_handles = timed(timings, 'buffer', searcharea_frompoint,
+                                                                    centre.x, centre.y, RADIUS)
+        found = timed(timings, 'search_layers', search_layers, layers, buffer_feature, searches,
+                      search_geom=centre, radii=[RADIUS], centre=centre)
+        timed(timings, 'search_layers_on_demand', search_layers, on_demand, buffer_feature, searches,
+              search_geom=centre, radii=[RADIUS], centre=centre)
+        timed(timings, 'search_layers_recent', search_layers, layers, buffer_feature, searches,
+              search_geom=centre, radii=[RADIUS], centre=centre, years=(2012, None))
+
+        sppSearch, sppConcat, sppOutput = timed(timings, 'searchSpecies', searchSpecies, found)
+        batSearch, batOutput, bat_labels = timed(timings, 'searchBats', searchBats, found)
+        gcnSearch, gcnOutput, gcn_labels = timed(timings, 'searchGCNs', searchGCNs, found)
+        invSearch, invOutput = timed(timings, 'searchInvasive', searchInvasive, found)
+        sbiIntersect, basIntersect, site_labels, sitesOutput = timed(timings, 'searchSites', searchSites, found)
+        timed(timings, 'regenerate_gridrefs', regenerate_gridrefs, sppOutput, 6)
+
+        fig, ax = template.new_map()
+        try:
+            timed(timings, 'sppstyle', sppstyle, sppSearch, ax)
+        finally:
+            template.clear()
+
+        xmin, ymin, xmax, ymax = buffer_feature.bounds
+        job = {'product': 'sitesspp', 'sitename': 'Benchmark', 'dpi': MAP_DPI,
+               'outpath': str(outfolder / ('map_' + MAP_PRODUCTS['sitesspp']['name'] + '.jpeg')),
+               'basemap_path': basemap_path, 'mapextent': [xmin - 200, xmax + 200, ymin - 200, ymax + 200],
+               'userfeat': userfeat, 'userbuffer': userbuffer, 'area_legend': True, 'handles': site_labels,
+               'records': {'species': sppSearch, 'sbi': sbiIntersect, 'bas': basIntersect}}
+        timed(timings, 'render_map', render_map, job)
+
+        tables = {'Species': sppOutput, 'GCN': gcnOutput, 'Bats': batOutput, 'Invasive': invOutput,
+                  'Sites': sitesOutput}
+        timed(timings, 'export_xlsx', export_results, tables, str(outfolder / 'benchmark'), 'xlsx')
+
+    return timings, {name: len(records) for name, records in found.items()}
+
+
+def summarise(timings):
+    """
+    Summarises the timings of each stage.
+
+    Parameters:
+        timings: dictionary of stage name: list of times in seconds
+
+    Returns:
+        summary: dictionary of stage name: dictionary of min, median and max time, and the number of runs
+    """
+
+    return {stage: {'min': min(times), 'median': statistics.median(times), 'max': max(times), 'runs': len(times)}
+            for stage, times in timings.items()}
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compares benchmark results against an earlier run, using the median time of each stage at each scale.
+
+    Parameters:
+        results: benchmark results, as written by this script
+
+        baseline: earlier benchmark results
+
+        tolerance: allowed slow down as a fraction, e.g. 0.2 for 20%
+
+    Returns:
+        regressions: list of (scale, stage, baseline median, median) of the stages slower than allowed
+    """
+
+    regressions = []
+    for scale, result in results['scales'].items():
+        for stage, summary in result['stages'].items():
+            before = baseline['scales'].get(scale, {}).get('stages', {}).get(stage)
+            if stage == 'generate' or before is None:  # layers are only generated on the first run
+                continue
+            if summary['median'] > before['median'] * (1 + tolerance):
+                regressions.append((scale, stage, before['median'], summary['median']))
+
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the enquiry stages on synthetic layers.')
+    parser.add_argument('--scales', type=int, nargs='+', default=[10000, 100000],
+                        help='numbers of species records to benchmark, e.g. 10000 100000 1000000 10000000')
+    parser.add_argument('--repeat', type=int, default=3, help='number of times each enquiry stage is run')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of the synthetic layers')
+    parser.add_argument('--data-dir', default=str(DATA_DIR), help='folder to generate the synthetic layers in')
+    parser.add_argument('--output', default='output/benchmark/benchmark.json', help='JSON file of the results')
+    parser.add_argument('--compare', default=None, help='JSON results of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slow down when comparing, e.g. 0.2')
+    args = parser.parse_args()
+
+    results = {'created': datetime.now().isoformat(timespec='seconds'),
+               'python': sys.version.split()[0],
+               'platform': platform.platform(),
+               'versions': {'numpy': np.__version__, 'pandas': pd.__version__, 'geopandas': gpd.__version__},
+               'repeat': args.repeat,
+               'seed': args.seed,
+               'scales': {}}
+
+    for scale in args.scales:
+        print('Benchmarking {} records'.format(scale))
+        timings, found = run_benchmark(scale, args.repeat, args.seed, args.data_dir)
+        results['scales'][str(scale)] = {'stages': summarise(timings), 'records_found': found}
+        for stage, summary in results['scales'][str(scale)]['stages'].items():
+            print('  {:<28} {:>10.4f}s'.format(stage, summary['median']))
+
+    Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+    Path(args.output).write_text(json.dumps(results, indent=2))
+    print('Results saved to ' + args.output)
+
+    if args.compare:
+        regressions = compare(results, json.loads(Path(args.compare).read_text()), args.tolerance)
+        for scale, stage, before, after in regressions:
+            print('Regression at {} records: {} {:.4f}s -> {:.4f}s'.format(scale, stage, before, after))
+        if regressions:
+            sys.exit(1)
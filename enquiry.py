@@ -0,0 +1,1391 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import cartopy.crs as ccrs
+from matplotlib.figure import Figure
+import matplotlib.lines as mlines
+import matplotlib.patches as mpatches
+from matplotlib_scalebar.scalebar import ScaleBar
+from shapely.geometry import Point, box
+from shapely.ops import unary_union
+from basemap import load_basemap
+from enquiry_log import EnquiryLogger, StageTimer
+from export import export_results
+from gridref import GRID_DIGITS, gridref_to_osgb36, regenerate_gridrefs
+from layers import SITES_COLUMNS, SPECIES_COLUMNS, concat_records, selected_layers
+
+
+# Setup CRS of the axis
+myCRS = ccrs.epsg(27700)  # Set project CRS to British National Grid, matches the CRS of datafiles
+MAP_DPI = 300  # default resolution of the saved maps, the basemap is read at this resolution
+
+# Formats the maps can be saved in. pdf is a vector map, only the basemap is embedded as an image (at the map dpi)
+MAP_FORMATS = ['jpeg', 'png', 'pdf']
+
+# Map produced for each search type (invasive species are not mapped), in the order they are drawn:
+# name used in the map file name, map title (after the site name), and legend / title options
+MAP_PRODUCTS = {
+    'species': {'name': 'Species', 'title': 'species map', 'title_kwargs': {'fontsize': 16},
+                'legend_kwargs': {'loc': 'lower center', 'bbox_to_anchor': (0.5, 0), 'ncol': 4}},
+    'gcn': {'name': 'GCN', 'title': 'Great Crested Newt map', 'title_kwargs': {},
+            'legend_kwargs': {'loc': 'upper center', 'bbox_to_anchor': (0.5, -0.05), 'ncol': 3}},
+    'bats': {'name': 'Bats', 'title': 'bats map', 'title_kwargs': {},
+             'legend_kwargs': {'loc': 'lower center', 'ncol': 3}},
+    'sites': {'name': 'Sites', 'title': 'nature conservation sites map', 'title_kwargs': {},
+              'legend_kwargs': {'loc': 'lower center', 'ncol': 3}},
+    'sitesspp': {'name': 'SitesSpecies', 'title': 'protected species and nature conservation sites map',
+                 'title_kwargs': {}, 'legend_kwargs': {'loc': 'lower center', 'ncol': 3}},
+}
+
+# Columns added to the outputs of a distance banded search
+BAND_COLUMNS = ['Distance', 'Band']
+
+# Column added to the outputs of a per feature search, identifying the feature of the user's file each record is for
+FEATURE_COLUMN = 'FeatureID'
+
+# Font size of the site labels, in points
+LABEL_SIZE = 8
+# Positions tried for each site label, as offsets in label widths / heights from the label anchor
+LABEL_OFFSETS = [(0, 0), (0, 1), (0, -1), (1, 0), (-1, 0)]
+
+# Species map categories, in plotting and legend order. Each record is matched on either its CommonName or its
+# InformalGr (excluding the CommonNames listed in exclude), species (CommonName) rules take priority.
+SPECIES_STYLES = [
+    {'label': 'Mammal', 'field': 'InformalGr', 'values': ['mammal'],
+     'exclude': ['Otter', 'Water Vole', 'Eurasian Badger'],
+     'marker': '^', 'color': 'none', 'edgecolor': 'red', 'linewidth': 2},
+    {'label': 'Otter', 'field': 'CommonName', 'values': ['Otter'], 'exclude': [],
+     'marker': '^', 'color': 'red', 'edgecolor': 'black', 'linewidth': None},
+    {'label': 'Water Vole', 'field': 'CommonName', 'values': ['Water Vole'], 'exclude': [],
+     'marker': 's', 'color': 'green', 'edgecolor': 'black', 'linewidth': None},
+    {'label': 'Bats', 'field': 'InformalGr', 'values': ['mammal - bat'], 'exclude': [],
+     'marker': 'v', 'color': 'deepskyblue', 'edgecolor': 'black', 'linewidth': None},
+    {'label': 'Birds', 'field': 'InformalGr', 'values': ['bird'], 'exclude': [],
+     'marker': 'o', 'color': 'none', 'edgecolor': 'yellow', 'linewidth': 2},
+    {'label': 'Amphibians and Reptiles', 'field': 'InformalGr', 'values': ['amphibian', 'reptile'],
+     'exclude': ['Great Crested Newt'],
+     'marker': 's', 'color': 'none', 'edgecolor': 'deepskyblue', 'linewidth': 2},
+    {'label': 'Great Crested Newt', 'field': 'CommonName', 'values': ['Great Crested Newt'], 'exclude': [],
+     'marker': 'o', 'color': 'yellow', 'edgecolor': 'black', 'linewidth': None},
+    {'label': 'White-Clawed Crayfish', 'field': 'CommonName', 'values': ['White-clawed Freshwater Crayfish'],
+     'exclude': [], 'marker': 'P', 'color': 'deepskyblue', 'edgecolor': 'black', 'linewidth': None},
+    {'label': 'Plant', 'field': 'InformalGr', 'values': ['flowering plant'], 'exclude': ['Bluebell'],
+     'marker': 'v', 'color': 'none', 'edgecolor': 'green', 'linewidth': 2},
+    {'label': 'Bluebell', 'field': 'CommonName', 'values': ['Bluebell'], 'exclude': [],
+     'marker': 'o', 'color': 'green', 'edgecolor': 'black', 'linewidth': None},
+]
+
+
+def parse_radii(buffer_radius):
+    """
+    Returns the search radii of an enquiry as a sorted list. Several radii can be given for a distance banded
+    search, as a list or as a string separated by commas or semicolons (e.g. '500, 2000, 5000').
+
+    Parameters:
+        buffer_radius: search radius in metres as int, flt or str, or a list of radii
+
+    Returns:
+        radii: sorted list of the search radii as floats
+    """
+
+    if isinstance(buffer_radius, str):
+        buffer_radius = [r for r in buffer_radius.replace(';', ',').split(',') if r.strip()]
+    elif not isinstance(buffer_radius, (list, tuple)):
+        buffer_radius = [buffer_radius]
+
+    return sorted(float(r) for r in buffer_radius)
+
+
+def parse_years(enquiry):
+    """
+    Returns the range of years of the records to search for an enquiry, e.g. the last 10 years for an EIA search.
+
+    Parameters:
+        enquiry: dictionary of the enquiry details, see run_enquiry
+
+    Returns:
+        years: (first year, last year), either None for no limit, or None if the enquiry is not limited by year
+    """
+
+    years = tuple(None if enquiry.get(key) in [None, ''] else int(float(enquiry[key]))
+                  for key in ['year_from', 'year_to'])
+    if years == (None, None):
+        return None
+    if None not in years and years[0] > years[1]:
+        raise ValueError('year_from ({}) is after year_to ({})'.format(*years))
+
+    return years
+
+
+def searcharea_frompoint(xin, yin, buffer_radius, ax=None):
+
+    """
+    Creates a point and buffer based on the user inputted grid reference. Point_x and point_y require pure
+    EPSG:27700 easting and northing, values. Buffer_area value is in metres
+
+    Parameters:
+        xin: easting values as int or flt
+
+        yin: northing values as int or flt
+
+        buffer_radius: required buffer is required in metres, value as either int or flt, or a list of radii for
+        a distance banded search (the search buffer uses the largest radius, each radius is drawn on the map)
+
+        ax: map axis to plot the point and buffer on, not plotted if not given
+
+    Returns:
+        userfeat: Geoseries of the user inputted point
+
+        userbuffer: Geoseries of a user specified buffer around the user defined point
+
+        bufferGeom: Shapely geometry of the user defined buffer
+
+        input_handles: The style information for the point and buffer to add to map legend
+    """
+
+    radii = parse_radii(buffer_radius)
+    userpoint = Point(xin, yin)  # shapely geometry
+    bufferGeom = userpoint.buffer(radii[-1], resolution=50)  # shapely geometry for running search
+
+    # Convert to geoseries for mapping in matplotlib
+    userfeat = gpd.GeoSeries(Point(xin, yin)).set_crs(epsg=27700, inplace=True)
+    userbuffer = gpd.GeoSeries([userpoint.buffer(r, resolution=50) for r in radii]).set_crs(epsg=27700, inplace=True)
+
+    # Plot the point and buffer, and create handles for legend
+    input_handles = plot_search_area(userfeat, userbuffer, ax)
+
+    return userfeat, userbuffer, bufferGeom, input_handles
+
+
+def searcharea_frompoly(user_polypath, buffer_radius, ax=None):
+    """
+    Creates a buffer based on the user inputted polygon.
+
+    buffer_area value is required in metres, value as either int or flt.
+
+    Parameters:
+        user_polypath: the filepath to the selected polygon
+
+        buffer_radius: required buffer is required in metres, value as either int or flt, or a list of radii for
+        a distance banded search (the search buffer uses the largest radius, each radius is drawn on the map)
+
+        ax: map axis to plot the polygon and buffer on, not plotted if not given
+
+    Returns:
+        userfile: A Geodataframe of the file the user selects
+
+        userbuffer: Geoseries of a user specified buffer around the user defined point
+
+        bufferGeom: Shapely geometry of the user defined buffer
+
+        input_handles: The style information for the point and buffer to add to map legend
+
+
+    """
+
+    radii = parse_radii(buffer_radius)
+    userfile = gpd.read_file(user_polypath)  # import user selected file
+    union = unary_union(userfile.geometry)
+    # buffer user file with each user input buffer (for plotting)
+    userbuffer = gpd.GeoSeries(pd.concat([userfile.buffer(r) for r in radii], ignore_index=True))
+    bufferGeom = union.buffer(radii[-1])  # Create shapely geometry to carry out intersects
+
+    # Plot the polygon and buffer, and create handles for legend
+    input_handles = plot_search_area(userfile.geometry, userbuffer, ax)
+
+    return userfile, userbuffer, bufferGeom, input_handles
+
+
+def plot_search_area(userfeat, userbuffer, ax=None):
+    """
+    Plots the user point or polygon and the search buffer on a map axis, and creates the matching legend handles.
+
+    Parameters:
+        userfeat: Geoseries of the user point, or of the user polygon
+
+        userbuffer: Geoseries of the search buffer, one polygon for each radius
+
+        ax: map axis to plot the search area on, only the legend handles are created if not given
+
+    Returns:
+        input_handles: The style information for the point / polygon and buffer to add to map legend
+    """
+
+    is_point = bool((userfeat.geom_type == 'Point').all())
+
+    if ax is not None:
+        if is_point:
+            userbuffer.plot(ax=ax, color='none', edgecolor='red')
+            userfeat.plot(ax=ax, marker='*', color='red', markersize=20)
+        else:
+            userfeat.plot(ax=ax, edgecolor='blue', color='none', hatch='//')
+            userbuffer.plot(ax=ax, color='none', edgecolor='red', linewidth=1.5)
+
+    if is_point:
+        userfeat_handle = mlines.Line2D([], [], linestyle='None', marker='*', color='red', label='User point')
+    else:
+        userfeat_handle = mpatches.Patch(facecolor='None', hatch='//', edgecolor='blue', label='Search area')
+    userbuffer_handle = mpatches.Patch(facecolor='None', edgecolor='red', label='Search buffer')
+
+    # Combine legend items
+    return [userfeat_handle, userbuffer_handle]
+
+
+def add_distance_bands(records, search_geom, radii):
+    """
+    Adds the distance of each record from the search point or search area, and the distance band the record falls
+    in, i.e. the smallest search radius the record is within. Distances are calculated for all records at once.
+
+    Parameters:
+        records: Geodataframe of records found by the search
+
+        search_geom: Shapely geometry of the user point or search area (not buffered)
+
+        radii: sorted list of the search radii
+
+    Returns:
+        records: copy of the records with Distance and Band columns added
+    """
+
+    records = records.copy()
+    distance = records.distance(search_geom).values  # distance in metres, 0 within the search area
+    band = np.minimum(np.searchsorted(radii, distance, side='left'), len(radii) - 1)
+
+    records['Distance'] = distance.round(1)
+    records['Band'] = np.asarray(radii)[band]
+
+    return records
+
+
+def search_features(userfile):
+    """
+    Returns the features of the user's search area file for a per feature search, each with a feature ID. The IDs
+    are taken from a FeatureID column if the file has one, otherwise the features are numbered from 1 in file order.
+
+    Parameters:
+        userfile: Geodataframe of the user's search area file, from searcharea_frompoly
+
+    Returns:
+        features: Geodataframe of the features, with a FeatureID column
+    """
+
+    if FEATURE_COLUMN in userfile.columns:
+        ids = userfile[FEATURE_COLUMN].values
+    else:
+        ids = np.arange(1, len(userfile) + 1)
+
+    return gpd.GeoDataFrame({FEATURE_COLUMN: ids}, geometry=userfile.geometry.values, crs=userfile.crs)
+
+
+def attribute_features(records, features, radii):
+    """
+    Attributes each record to the features of a per feature search whose buffer it falls within. All the records
+    are joined to all the feature buffers in one bulk spatial join (using a spatial index), so the cost grows with
+    the number of matches rather than the number of features times the number of records. A record within the
+    buffers of several features is given once for each feature. Each record is given its distance from its feature
+    and the distance band it falls in.
+
+    Parameters:
+        records: Geodataframe of the records found within the combined buffer of all the features
+
+        features: Geodataframe of the features, from search_features
+
+        radii: sorted list of the search radii
+
+    Returns:
+        records: Geodataframe of the records for each feature, with FeatureID, Distance and Band columns, ordered by
+        feature and then in the order of the layer
+    """
+
+    buffers = gpd.GeoDataFrame({FEATURE_COLUMN: features[FEATURE_COLUMN].values},
+                               geometry=features.buffer(radii[-1]).values, crs=features.crs)
+    records = records.drop(columns=[FEATURE_COLUMN] + BAND_COLUMNS, errors='ignore')
+    records = records.assign(_row=np.arange(len(records)))
+
+    joined = gpd.sjoin(records, buffers, how='inner', predicate='intersects')
+    joined = joined.sort_values([FEATURE_COLUMN, '_row'], kind='stable')
+
+    # distance from each record to its own feature, calculated for all the matches at once
+    feature_geoms = gpd.GeoSeries(features.geometry.values[joined['index_right'].values], index=joined.index)
+    distance = joined.distance(feature_geoms, align=False).values
+    band = np.minimum(np.searchsorted(radii, distance, side='left'), len(radii) - 1)
+
+    joined = joined.drop(columns=['_row', 'index_right'])
+    joined['Distance'] = distance.round(1)
+    joined['Band'] = np.asarray(radii)[band]
+
+    return joined
+
+
+def search_layers(layers, buffer_feature, searches, search_geom=None, radii=None, centre=None, features=None,
+                  years=None):
+    """
+    Runs the spatial search of the enquiry. Each layer needed by the selected searches is queried once with the
+    search buffer, the species, bats, GCN, invasive and sites results are then all taken from these records using
+    attribute filters, so ticking several search types does not repeat the spatial search.
+
+    For a multi-radius search the buffer is created at the largest radius, and if search_geom is given each record
+    is given its distance from the search geometry and the radius band it falls in (see add_distance_bands).
+
+    Parameters:
+        layers: LayerStore holding the search layers
+
+        buffer_feature: Shapely geometry of the search buffer
+
+        searches: list of the searches to run, from 'species', 'bats', 'gcn', 'invasive', 'sites', 'sitesspp'
+
+        search_geom: Shapely geometry of the user point or search area, to measure record distances from
+
+        radii: sorted list of the search radii, used with search_geom
+
+        centre: Shapely Point of the search point for an exact circular search of a point enquiry. Records are
+        found by their distance from the point (up to the largest radius) instead of the buffer polygon, which
+        only approximates the circle
+
+        features: Geodataframe of the features of a per feature search (see search_features). The layers are
+        searched once with the combined buffer of all the features, and the records found are then attributed to
+        each feature (see attribute_features)
+
+        years: (first year, last year) of the species and invasive species records to search (see parse_years).
+        Records outside the range are dropped by the layer query before the spatial search, so the species, bats,
+        GCN and invasive searches only see records within the range
+
+    Returns:
+        found: dictionary of layer name: Geodataframe of the layer records intersecting the search buffer
+    """
+
+    if centre is not None:
+        found = {name: layers.query_circle(name, centre, radii[-1], years) for name in selected_layers(searches)}
+    else:
+        found = {name: layers.query(name, buffer_feature, years) for name in selected_layers(searches)}
+
+    if features is not None:
+        found = {name: attribute_features(records, features, radii) for name, records in found.items()}
+    elif search_geom is not None:
+        found = {name: add_distance_bands(records, search_geom, radii) for name, records in found.items()}
+
+    return found
+
+
+def output_columns(records, columns):
+    """
+    Returns the output columns for a set of search results: the given columns, plus the distance and band columns
+    when the search was distance banded, and the feature ID first for a per feature search.
+
+    Parameters:
+        records: Dataframe of search results
+
+        columns: list of output columns, e.g. SPECIES_COLUMNS
+
+    Returns:
+        columns: list of output columns
+    """
+
+    feature = [FEATURE_COLUMN] if FEATURE_COLUMN in records.columns else []
+
+    return feature + columns + [column for column in BAND_COLUMNS if column in records.columns]
+
+
+def category_mask(column, values):
+    """
+    Returns which records of a column have one of the given values. Categorical columns (see compact_layer) are
+    compared by their integer codes, so each value is only compared once per category rather than once per record.
+
+    Parameters:
+        column: Series of the column, e.g. records['InformalGr']
+
+        values: list of the values to match
+
+    Returns:
+        mask: boolean array, True for the records matching one of the values
+    """
+
+    column = column.astype('category')  # no copy if the column is already categorical
+    codes = np.flatnonzero(column.cat.categories.isin(values))
+
+    return np.isin(column.cat.codes.values, codes)
+
+
+def category_lookup(column, mapping):
+    """
+    Looks up the value of each record of a column in a dictionary. Categorical columns are looked up once per
+    category and the result taken by the integer code of each record.
+
+    Parameters:
+        column: Series of the column, e.g. records['CommonName']
+
+        mapping: dictionary of column value: result
+
+    Returns:
+        results: object array of the result for each record, None where the value is not in the mapping
+    """
+
+    column = column.astype('category')
+    results = np.array([mapping.get(value) for value in column.cat.categories] + [None], dtype=object)
+
+    return results[column.cat.codes.values]  # missing values have code -1, the None at the end
+
+
+def searchSpecies(found):
+    """
+    Carries out a protected species search based on the users input parameters.
+
+    Parameters:
+        found: dictionary of layer records intersecting the search buffer, from search_layers
+
+    Returns:
+        sppSearch: Geodataframe containing the results of an intersection between a dataframe containing protected
+        species data and the buffer geometry created from the searcharea_frompoint or searcharea_frompoly functions.
+        This is used for plotting on the map
+
+        sppConcat: Concatenated results of protected species 100m+ and 1km precision data searches
+
+        sppOutput: Concatenated results of protected species 100m+ and 1km precision data searches with
+        extraneous columns removed.
+
+    """
+
+    # Species records <= 100m precision
+    sppSearch = found['species']
+
+    # 1km data species records
+    spp1kmSearch = found['species1km']
+
+    # Concatenate the 1km and <=100m species records search results
+    sppConcat = concat_records([sppSearch, spp1kmSearch])
+
+    # Remove extraneous columns for GDPR
+    sppOutput = sppConcat[output_columns(sppConcat, SPECIES_COLUMNS)]
+
+    return sppSearch, sppConcat, sppOutput
+
+
+def classify_species(sppSearch):
+    """
+    Assigns each species record to one of the species map categories in SPECIES_STYLES. Species rules (matching
+    CommonName) take priority over group rules (matching InformalGr), and a group rule does not apply to the
+    species it excludes. The classification is a fixed number of vectorised lookups however many categories there
+    are in the table.
+
+    Parameters:
+        sppSearch: Geodataframe of species records
+
+    Returns:
+        categories: pandas Categorical of the style label of each record, missing where no category applies
+    """
+
+    labels = [style['label'] for style in SPECIES_STYLES]
+    species_rules = {value: style['label'] for style in SPECIES_STYLES if style['field'] == 'CommonName'
+                     for value in style['values']}
+    group_rules = {value: style['label'] for style in SPECIES_STYLES if style['field'] == 'InformalGr'
+                   for value in style['values']}
+    exclusions = [(value, excluded) for style in SPECIES_STYLES if style['field'] == 'InformalGr'
+                  for value in style['values'] for excluded in style['exclude']]
+
+    species_category = category_lookup(sppSearch['CommonName'], species_rules)
+    group_category = category_lookup(sppSearch['InformalGr'], group_rules)
+    excluded = pd.MultiIndex.from_arrays([sppSearch['InformalGr'], sppSearch['CommonName']]).isin(exclusions)
+    category = np.where(species_category != None, species_category,  # noqa: E711 (elementwise comparison)
+                        np.where(excluded, None, group_category))
+
+    return pd.Categorical(category, categories=labels)
+
+
+def style_handle(style):
+    """
+    Creates a legend handle (proxy artist) matching a species style from SPECIES_STYLES.
+
+    Parameters:
+        style: dictionary of the species style
+
+    Returns:
+        handle: Line2D legend handle
+    """
+
+    handle_kwargs = {}
+    if style['linewidth'] is not None:
+        handle_kwargs['markeredgewidth'] = style['linewidth']
+
+    return mlines.Line2D([], [], marker=style['marker'], color=style['color'], markeredgecolor=style['edgecolor'],
+                         linestyle='None', label=style['label'], **handle_kwargs)
+
+
+def sppstyle(sppSearch, ax):
+    """
+    Styles and plots the results of the protected species search on a map axis, creates label handles which match
+    the species styles. The records are classified using the SPECIES_STYLES table, then each category with records
+    is plotted in a single scatter.
+
+    Parameters:
+        sppSearch: Geodataframe of the species search results to plot
+
+        ax: map axis to plot the species on
+
+    Returns:
+        spptypes: a list of the scatter plots of each species category found in the search results
+
+        spplegend: a list of legend handles matching the style of the axis plots (proxy artist)
+
+    """
+
+    categories = classify_species(sppSearch)
+    xs = sppSearch.geometry.x.values
+    ys = sppSearch.geometry.y.values
+
+    # Plot each category with records as one scatter, in the order of the style table
+    spptypes = []
+    rows_by_category = pd.Series(categories.codes).groupby(categories.codes).indices
+    for code, style in enumerate(SPECIES_STYLES):
+        if code not in rows_by_category:
+            continue
+        rows = rows_by_category[code]
+        scatter_kwargs = {}
+        if style['linewidth'] is not None:
+            scatter_kwargs['linewidths'] = style['linewidth']
+        spptypes.append(ax.scatter(xs[rows], ys[rows], marker=style['marker'], facecolors=style['color'],
+                                   edgecolors=style['edgecolor'], **scatter_kwargs))
+
+    # Create proxy artist entries to create legend list
+    spplegend = [style_handle(style) for style in SPECIES_STYLES]
+
+# TODO: add in way of catching zero result species + 'other' species
+
+    return spptypes, spplegend
+
+
+def searchBats(found):
+    """
+    Carries out a bat species search based on the users input parameters.
+
+    Parameters:
+        found: dictionary of layer records intersecting the search buffer, from search_layers
+
+    Returns:
+        batSearch:Geodataframe containing the results of an intersection between a dataframe containing protected
+        species data and the buffer geometry created from the searcharea_frompoint or searcharea_frompoly functions,
+        filtered to contain only bat records.
+
+        batOutput:  Concatenated results of bat species 100m+ and 1km precision data searches
+
+        bats_handle: Concatenated results of bat species 100m+ and 1km precision data searches with
+        extraneous columns removed.
+
+    """
+    # Filter spp records <= 100m precision
+    batrecs = found['species']
+    batSearch = batrecs[category_mask(batrecs['InformalGr'], ['mammal - bat'])]  # Filter where informal group = bats
+
+    # Filter 1km data species records
+    batrecs1km = found['species1km']
+    batsearch1km = batrecs1km[category_mask(batrecs1km['InformalGr'], ['mammal - bat'])]  # informal group = bats
+
+    # Concatenate the 1km and <=100m species records search results
+    batConcat = concat_records([batSearch, batsearch1km])
+
+    # Remove extraneous columns for GDPR
+    batOutput = batConcat[output_columns(batConcat, SPECIES_COLUMNS)]
+
+    bats_handle = mlines.Line2D([], [], marker='v', color='deepskyblue', markeredgecolor='black',
+                                linestyle='None', label='Bats')
+
+    bats_handle = [bats_handle]
+
+    return batSearch, batOutput, bats_handle
+
+
+def searchGCNs(found):
+    """
+    Carries out a Great Crested Newt (GCN) species search based on the users input parameters.
+
+    Parameters:
+        found: dictionary of layer records intersecting the search buffer, from search_layers
+
+    Returns:
+        gcnSearch:Geodataframe containing the results of an intersection between a dataframe containing protected
+        species data and the buffer geometry created from the searcharea_frompoint or searcharea_frompoly functions,
+        filtered to contain only GCN records.
+
+        gcnOutput:  Concatenated results of gcn species 100m+ and 1km precision data searches
+
+        gcn_handle: Concatenated results of gcn species 100m+ and 1km precision data searches with
+        extraneous columns removed.
+
+    """
+    # Filter spp records <= 100m precision
+    gcnrecs = found['species']
+    gcnSearch = gcnrecs[category_mask(gcnrecs['CommonName'], ['Great Crested Newt'])]  # Filter where Common Name = GCN
+
+    # Filter 1km data species records
+    gcnrecs1km = found['species1km']
+    gcnsearch1km = gcnrecs1km[category_mask(gcnrecs1km['CommonName'], ['Great Crested Newt'])]  # Common Name = GCN
+
+    # Concatenate the 1km and <=100m species records search results
+    gcnConcat = concat_records([gcnSearch, gcnsearch1km])
+
+    # Remove extraneous columns for GDPR
+    gcnOutput = gcnConcat[output_columns(gcnConcat, SPECIES_COLUMNS)]
+
+    gcn_handle = mlines.Line2D([], [], marker='o', color='yellow', markeredgecolor='black',
+                               linestyle='None', label='Great Crested Newt')
+
+    gcn_handle = [gcn_handle]
+
+    return gcnSearch, gcnOutput, gcn_handle
+
+
+def searchInvasive(found):
+    """
+    Carries out an invasive species search based on the users input parameters.
+
+    Parameters:
+        found: dictionary of layer records intersecting the search buffer, from search_layers
+
+    Returns:
+        invSearch:Geodataframe containing the results of an intersection between a dataframe containing protected
+        species data and the buffer geometry created from the searcharea_frompoint or searcharea_frompoly functions,
+        filtered to contain only invasive species records.
+
+        invOutput:  Concatenated results of invasive species 100m+ and 1km precision data searches
+
+    """
+
+    # Invasive species records <= 100m precision
+    invSearch = found['invasive']
+
+    # 1km data invasive species records
+    inv1kmSearch = found['invasive1km']
+
+    # Concatenate the 1km and <=100m invasive species records search results
+    invConcat = concat_records([invSearch, inv1kmSearch])
+
+    # Prepare output for excel export
+    invOutput = invConcat[output_columns(invConcat, SPECIES_COLUMNS)]
+
+    return invSearch, invOutput
+
+
+def place_labels(anchors, widths, height):
+    """
+    Places labels so they do not overlap. Each label is tried at its anchor, then above, below, right and left of
+    it (LABEL_OFFSETS), and is placed at the first position which does not overlap a label already placed. Labels
+    are placed in order, so the most important labels should be first.
+
+    Parameters:
+        anchors: (n, 2) array of the x, y anchor point of each label
+
+        widths: array of the width of each label, in map units
+
+        height: height of the labels, in map units
+
+    Returns:
+        positions: (n, 2) array of the x, y centre of each label, NaN for labels with no free position
+    """
+
+    positions = np.full((len(anchors), 2), np.nan)
+    placed = np.empty((len(anchors), 4))  # xmin, ymin, xmax, ymax of the labels placed so far
+    count = 0
+
+    for i, ((x, y), width) in enumerate(zip(anchors, widths)):
+        for dx, dy in LABEL_OFFSETS:
+            cx, cy = x + dx * width, y + dy * height
+            xmin, ymin, xmax, ymax = cx - width / 2, cy - height / 2, cx + width / 2, cy + height / 2
+            boxes = placed[:count]
+            overlaps = (boxes[:, 0] < xmax) & (boxes[:, 2] > xmin) & (boxes[:, 1] < ymax) & (boxes[:, 3] > ymin)
+            if not overlaps.any():
+                positions[i] = cx, cy
+                placed[count] = xmin, ymin, xmax, ymax
+                count += 1
+                break
+
+    return positions
+
+
+def label_sites(ax, sites):
+    """
+    Labels sites on the map with their SiteID. Label anchors are found for all the sites at once, as a point inside
+    the part of each site visible on the map, so labels stay inside concave sites. Labels are then placed without
+    overlapping, largest sites first. Labels with no free position near their site are left off the map (the sites
+    are still listed in the results).
+
+    Must be called after the map extent is set.
+
+    Parameters:
+        ax: map axis the sites are plotted on
+
+        sites: list of (Geodataframe of sites, label colour)
+    """
+
+    sites = [(frame, colour) for frame, colour in sites if len(frame)]
+    if not sites:
+        return
+
+    geometry = gpd.GeoSeries(pd.concat([frame.geometry for frame, colour in sites], ignore_index=True))
+    labels = pd.concat([frame['SiteID'] for frame, colour in sites], ignore_index=True).astype(str).values
+    colours = np.repeat([colour for frame, colour in sites], [len(frame) for frame, colour in sites])
+
+    # Part of each site within the map extent
+    xmin, xmax, ymin, ymax = ax.get_extent(crs=myCRS)
+    visible = geometry.intersection(box(xmin, ymin, xmax, ymax))
+    order = np.argsort(-visible.area.values, kind='stable')  # largest sites are labelled first
+    order = order[~visible.is_empty.values[order]]
+    if not len(order):
+        return
+
+    anchors = visible.iloc[order].representative_point()
+    anchors = np.column_stack([anchors.x.values, anchors.y.values])
+
+    # Size of the labels in map units, from the size of the map on the page (equal aspect, so the larger scale)
+    width_pt, height_pt = ax.get_position().size * ax.figure.get_size_inches() * 72
+    scale = max((xmax - xmin) / width_pt, (ymax - ymin) / height_pt)  # map units per point
+    widths = np.array([len(label) for label in labels[order]]) * 0.6 * LABEL_SIZE * scale
+    positions = place_labels(anchors, widths, 1.2 * LABEL_SIZE * scale)
+
+    for i, (x, y) in zip(order, positions):
+        if not np.isnan(x):
+            ax.text(x, y, labels[i], size=LABEL_SIZE, color=colours[i], weight='bold', ha='center', va='center')
+
+
+def searchSites(found):
+    """
+    Carries out a Nature Conservation Site search based on the users input parameters.
+
+    Parameters:
+        found: dictionary of layer records intersecting the search buffer, from search_layers
+
+    Returns:
+        sbiIntersect: Geodataframe containing the list of Site of Biological Importance (SBI) intersecting the
+        users buffer radius.
+
+        basIntersect: Geodataframe containing the list of Biodiversity Alert Sites (BAS) intersecting the
+        users buffer radius.
+
+        site_handles: a list of legend handles matching the style of the search plots (proxy artist)
+
+        sitesOutput: Concatenation of sbiIntersect and basIntersect
+
+
+    """
+
+    # Sites which intersect the buffer area
+    sbiIntersect = found['sbi']
+    basIntersect = found['bas']
+
+    # Concatenate the two search results
+    sitesConcat = concat_records([sbiIntersect, basIntersect])
+
+    # Remove extraneous columns for GDPR
+    sitesOutput = sitesConcat[output_columns(sitesConcat, SITES_COLUMNS)]
+
+    # create legend items
+    sbi_handle = mpatches.Patch(facecolor='None', hatch='.....', edgecolor='green',
+                                label='Site of Biological Importance')
+    bas_handle = mpatches.Patch(facecolor='None', hatch='.....', edgecolor='deepskyblue',
+                                label='Biodiversity Alert Site')
+
+    # list legend items to plot
+    site_handles = [sbi_handle, bas_handle]
+
+    return sbiIntersect, basIntersect, site_handles, sitesOutput
+
+
+def plot_sites(sbiIntersect, basIntersect, ax):
+    """
+    Plots and labels the results of the sites search on a map axis. Must be called after the map extent is set.
+
+    Parameters:
+        sbiIntersect: Geodataframe of the SBIs found, from searchSites
+
+        basIntersect: Geodataframe of the BASs found, from searchSites
+
+        ax: map axis to plot the sites on
+    """
+
+    sbiIntersect.plot(ax=ax, color='None', hatch='.....', edgecolor='green')
+    basIntersect.plot(ax=ax, color='None', hatch='.....', edgecolor='deepskyblue')
+
+    # Add site labels, placed together so SBI and BAS labels do not overlap each other
+    label_sites(ax, [(sbiIntersect, 'green'), (basIntersect, 'deepskyblue')])
+
+
+def plot_basemap(filepath, mapextent, fig, ax, dpi=MAP_DPI):
+    """
+    Adds the part of the basemap covering the map extent to the axis plot, read at the resolution of the saved map.
+
+    Parameters:
+        filepath: location of the raster dataset
+
+        mapextent: [xmin, xmax, ymin, ymax] extent of the map in EPSG:27700, as used by ax.set_extent
+
+        fig: map figure, used to work out the resolution the basemap is shown at
+
+        ax: map axis to plot the basemap on
+
+        dpi: resolution the map is saved at
+    """
+
+    xmin, xmax, ymin, ymax = mapextent
+    bmxmin, bmymin, bmxmax, bmymax, basemap = load_basemap(filepath, bounds=(xmin, ymin, xmax, ymax),
+                                                           out_size=fig.get_size_inches() * dpi)
+    if basemap is None:  # the map extent is outside the basemap
+        return
+    # plot basemap using extents
+    basemap_kwargs = {'extent': [bmxmin, bmxmax, bmymin, bmymax], 'transform': myCRS}
+    ax.imshow(basemap, **basemap_kwargs, cmap='gray')  # add basemap with grayscale colourmap
+
+
+def add_gridlines(ax):
+    """
+    Adds labelled gridlines to a map axis. Cartopy only creates the gridline and label artists the first time the
+    map is drawn, for the extent of the map at that time.
+
+    Parameters:
+        ax: the map axis, in EPSG:27700
+
+    Returns:
+        gridliner: the cartopy Gridliner of the gridlines
+    """
+
+    # NOTE: currently epsg:27700 axis labels not supported in cartopy 0.18.
+    gridliner = ax.gridlines(draw_labels=True)
+    gridliner.right_labels = False
+    gridliner.bottom_labels = False
+
+    return gridliner
+
+
+def create_map(gridlines=True):
+    """
+    Creates an empty A4 map figure with the map furniture (scalebar, gridlines and north arrow). The figure is not
+    registered with pyplot, so it can be drawn off the GUI thread and is freed once it is no longer referenced.
+
+    Parameters:
+        gridlines: add the gridlines, see add_gridlines
+
+    Returns:
+        fig: the map figure
+
+        ax: the map axis, in EPSG:27700
+    """
+
+    # create empy axis
+    cm = 1/2.54  # convert inches to cm to create A4 plot size
+    # Create figure & plot
+    fig = Figure(figsize=(21*cm, 29.7*cm))
+    ax = fig.add_subplot(1, 1, 1, projection=myCRS)
+    ax.add_artist(ScaleBar(1))  # Add scalebar
+    if gridlines:
+        add_gridlines(ax)
+
+    # Create north arrow
+    # (source: https://stackoverflow.com/questions/58088841/how-to-add-a-north-arrow-on-a-geopandas-map)
+    x, y, arrow_length = 0.03, 0.98, 0.05  # specify arrow size & location
+    ax.annotate('N', xy=(x, y), xytext=(x, y - arrow_length),
+                arrowprops=dict(facecolor='black', width=5, headwidth=15),
+                ha='center', va='center', fontsize=15,
+                xycoords=ax.transAxes)
+    fig.tight_layout()  # tight layout to put elements closer together on figure.
+
+    return fig, ax
+
+
+class MapTemplate:
+    """
+    A reusable A4 map. The figure and map furniture (scalebar and north arrow) are created once, and each enquiry is
+    drawn on the same figure. The gridlines are added for each enquiry, as cartopy only lays them out the first time
+    they are drawn. Once the map is saved everything the enquiry added (basemap, search area, records, gridlines,
+    legend and title) is removed again, so memory does not grow with the number of enquiries run.
+
+    A figure can only be drawn by one enquiry at a time, use map_template to get the template of the current thread.
+    """
+
+    def __init__(self):
+        self.fig, self.ax = create_map(gridlines=False)
+        self._baseline = None  # artists on the map before the current enquiry
+        self._gridliner = None  # gridlines of the current enquiry
+
+    def new_map(self):
+        """
+        Starts a new enquiry map, clearing the previous enquiry if it was not cleared.
+
+        Returns:
+            fig: the map figure
+
+            ax: the map axis, in EPSG:27700
+        """
+
+        self.clear()
+        self._baseline = set(self.ax.get_children())
+        self._gridliner = add_gridlines(self.ax)
+
+        return self.fig, self.ax
+
+    def savefig(self, outpath, **kwargs):
+        """
+        Saves the enquiry map. Takes the same keyword arguments as Figure.savefig.
+
+        Parameters:
+            outpath: filepath of the map to save
+        """
+
+        self.fig.savefig(outpath, **kwargs)
+
+    def enquiry_artists(self):
+        """
+        Returns the artists added to the map axis since new_map, including the gridline artists created when the map
+        was drawn.
+        """
+
+        return [artist for artist in self.ax.get_children() if artist not in self._baseline]
+
+    def clear(self):
+        """
+        Removes everything the enquiry added to the map, leaving only the map furniture.
+        """
+
+        if self._baseline is None:
+            return
+
+        # newer cartopy versions add the gridliner to the map as an artist, so it is removed with the others
+        for artist in self.enquiry_artists():
+            artist.remove()
+        # older versions (e.g. 0.18) instead keep the gridliners to draw in a list on the axis
+        gridliners = getattr(self.ax, '_gridliners', None)
+        if gridliners is not None and self._gridliner in gridliners:
+            gridliners.remove(self._gridliner)
+        for legend in list(self.fig.legends):
+            legend.remove()
+        self.fig.suptitle('')
+
+        self._baseline = None
+        self._gridliner = None
+
+
+# Map template of each thread running enquiries, see map_template
+_map_templates = threading.local()
+
+
+def map_template():
+    """
+    Returns the map template of the current thread, creating it the first time it is needed.
+
+    Returns:
+        template: MapTemplate
+    """
+
+    if not hasattr(_map_templates, 'template'):
+        _map_templates.template = MapTemplate()
+
+    return _map_templates.template
+
+
+def search_location(enquiry):
+    """
+    Returns the easting and northing of a point enquiry, converting the grid reference if needed.
+
+    Parameters:
+        enquiry: dictionary of the enquiry details, see run_enquiry
+
+    Returns:
+        easting: easting of the search point, None if the enquiry is not a point search
+
+        northing: northing of the search point, None if the enquiry is not a point search
+    """
+
+    if enquiry.get('easting') not in [None, ''] and enquiry.get('northing') not in [None, '']:
+        return float(enquiry['easting']), float(enquiry['northing'])
+
+    if enquiry.get('gridref'):
+        # convert the grid ref to easting & northing values
+        easting, northing, errors = gridref_to_osgb36(str(enquiry['gridref']))
+        if errors[0] is not None:
+            raise ValueError('not a valid grid reference: ' + errors[0])
+        return float(easting[0]), float(northing[0])
+
+    return None, None
+
+
+# Process pool the maps of an enquiry are drawn in, see map_pool
+_map_pool = None
+_map_pool_lock = threading.Lock()
+
+
+def map_pool():
+    """
+    Returns the process pool used to draw the maps of an enquiry in parallel, creating it the first time it is
+    needed. The pool is kept for the whole session, so each worker process creates its map template once.
+
+    Worker processes are spawned rather than forked on every platform, as forking the GUI (which runs enquiries on
+    threads) can copy locks held by other threads into the workers and deadlock them. Spawned workers import the
+    script which started them, so the script must only start the GUI under an if __name__ == '__main__' guard.
+
+    Returns:
+        pool: ProcessPoolExecutor
+    """
+
+    global _map_pool
+    with _map_pool_lock:
+        if _map_pool is None:
+            _map_pool = ProcessPoolExecutor(max_workers=min(len(MAP_PRODUCTS), os.cpu_count() or 1),
+                                            mp_context=multiprocessing.get_context('spawn'))
+
+    return _map_pool
+
+
+def reset_map_pool(pool):
+    """
+    Discards a map pool which can no longer be used (a worker process died), so the next enquiry starts a new one.
+
+    Parameters:
+        pool: the broken ProcessPoolExecutor, from map_pool
+    """
+
+    global _map_pool
+    with _map_pool_lock:
+        if _map_pool is pool:
+            _map_pool = None
+    pool.shutdown(wait=False)
+
+
+def draw_map(fig, ax, job, timer):
+    """
+    Draws the search area, records, legend and title of one map product on an enquiry map. Must be called after
+    the map extent is set.
+
+    Parameters:
+        fig: the map figure
+
+        ax: the map axis
+
+        job: dictionary describing the map, see render_map
+
+        timer: StageTimer to record the plotting and legend stages
+    """
+
+    product = MAP_PRODUCTS[job['product']]
+    # a per feature search gives a record once for each feature it is near, only plot it once
+    records = {name: plotted[~plotted.index.duplicated()] for name, plotted in job['records'].items()}
+
+    with timer.stage('plot') as stage:
+        input_handles = plot_search_area(job['userfeat'], job['userbuffer'], ax)
+        handles = (input_handles if job['area_legend'] else []) + job['handles']
+
+        if 'species' in records:
+            spptypes, spplabels = sppstyle(records['species'], ax)  # plot spp, style and return labels
+            handles += spplabels
+        if 'gcn' in records:
+            records['gcn'].plot(ax=ax, marker='o', color='yellow', edgecolor='black')
+        if 'bats' in records:
+            records['bats'].plot(ax=ax, marker='^', color='deepskyblue', edgecolor='black')
+        if 'sbi' in records:
+            plot_sites(records['sbi'], records['bas'], ax)
+        stage['rows'] = sum(len(plotted) for plotted in records.values())
+
+    with timer.stage('legend'):
+        fig.legend(handles=handles, title='Legend', title_fontsize=14, fontsize=10, frameon=True, framealpha=1,
+                   **product['legend_kwargs'])
+        fig.suptitle(job['sitename'] + ' ' + product['title'], **product['title_kwargs'])
+
+
+def render_map(job):
+    """
+    Draws and saves one map of an enquiry, on the map template of the current thread. Used to draw the maps in the
+    map pool worker processes, so everything needed to draw the map is passed in the job.
+
+    Parameters:
+        job: dictionary describing the map, with keys:
+            product: the search type the map shows, one of MAP_PRODUCTS
+            sitename: search area name, used in the map title
+            outpath: filepath of the map to save, the extension sets the format
+            dpi: resolution of the map
+            basemap_path: location of the basemap raster
+            mapextent: [xmin, xmax, ymin, ymax] extent of the map in EPSG:27700
+            userfeat, userbuffer: Geoseries of the user point / polygon and search buffer
+            area_legend: True to add the search area to the legend
+            handles: legend handles of the records (species handles are added when the species are plotted)
+            records: dictionary of the records to plot: species, gcn, bats and / or sbi and bas
+
+    Returns:
+        outpath: filepath of the saved map
+
+        stages: list of the stage records of drawing the map (see StageTimer), each with the map product
+    """
+
+    timer = StageTimer()
+    template = map_template()
+    fig, ax = template.new_map()
+    try:
+        with timer.stage('basemap'):
+            plot_basemap(job['basemap_path'], job['mapextent'], fig, ax, dpi=job['dpi'])  # basemap for the extent
+            ax.set_extent(job['mapextent'], crs=myCRS)
+            ax.set_autoscale_on(False)  # keep the extent as the records are plotted
+        draw_map(fig, ax, job, timer)
+        with timer.stage('savefig'):
+            template.savefig(job['outpath'], bbox_inches='tight', dpi=job['dpi'])
+    finally:
+        template.clear()  # always release the enquiry map, including when drawing the map fails
+
+    return job['outpath'], [dict(stage, map=job['product']) for stage in timer.stages]
+
+
+def render_maps(jobs, parallel=True):
+    """
+    Draws and saves the maps of an enquiry. With several maps and parallel set, each map is drawn in a worker
+    process of the map pool, so the maps take about as long as the slowest map.
+
+    Parameters:
+        jobs: list of dictionaries describing each map, see render_map
+
+        parallel: draw the maps in the map pool, otherwise they are drawn one after another in this thread
+
+    Returns:
+        results: list of (filepath of the map saved, stage records of drawing the map), see render_map
+    """
+
+    if not parallel or len(jobs) < 2:
+        return [render_map(job) for job in jobs]
+
+    pool = map_pool()
+    try:
+        return list(pool.map(render_map, jobs))
+    except BrokenProcessPool:
+        # a worker died (e.g. out of memory), the maps are drawn here instead and a new pool is started next time
+        reset_map_pool(pool)
+        return [render_map(job) for job in jobs]
+
+
+class EnquiryCancelled(Exception):
+    """
+    Raised when an enquiry is cancelled by the user before it is complete.
+    """
+
+
+def run_enquiry(enquiry, layers, basemap_path, progress=None, cancel=None, parallel_maps=True, log=None):
+    """
+    Runs a full data search enquiry: builds the search area, runs each of the selected searches, saves the results,
+    then draws and saves a map for each of the selected searches to the output folder. This is the same process
+    used by the GUI when the user clicks proceed, and by the batch enquiry runner.
+
+    Parameters:
+        enquiry: dictionary of the enquiry details, with keys:
+            enqno: enquiry number, used to name the output files
+            sitename: search area name, used in the map title
+            outfolder: folder to save the outputs to
+            easting, northing: search point in EPSG:27700 -OR-
+            gridref: BNG grid reference of the search point -OR-
+            bdyfile: filepath of a SHP or TAB file of the search area
+            radius: search radius in metres, or several radii for a distance banded search (see parse_radii)
+            searches: list of the searches to run, from 'species', 'bats', 'gcn', 'invasive', 'sites', 'sitesspp'
+            format: optional output format for the results, 'xlsx' (default), 'csv' or 'parquet'
+            map_format: optional format of the maps, one of MAP_FORMATS (default 'jpeg')
+            map_dpi: optional resolution of the maps (default MAP_DPI)
+            exact: optional, False to search a point enquiry with the buffer polygon instead of the exact circle
+            per_feature: optional, True to search each feature of a bdyfile separately (see attribute_features),
+            the results gain a FeatureID column
+            year_from, year_to: optional first and last year of the species and invasive species records searched,
+            e.g. the last 10 years for an EIA search (records without a year are then left out)
+            gridref_digits: optional precision of the GridRef column of the species results, one of GRID_DIGITS (never
+            more precise than the record itself), GridRef is left as recorded if not given. Grid1km is also
+            regenerated
+
+        layers: LayerStore holding the search layers
+
+        basemap_path: location of the basemap raster (e.g. the VRT from build_basemap)
+
+        progress: optional function called with a status message as each stage of the enquiry is started or
+        completed, prints the message if not given
+
+        cancel: optional threading.Event, the enquiry stops with EnquiryCancelled at the next stage once it is set
+
+        parallel_maps: draw the maps in parallel worker processes (see render_maps), e.g. False when the enquiry
+        is already running in a worker process
+
+        log: optional EnquiryLogger, the time, memory and row counts of each stage of the enquiry are written to it
+
+    Returns:
+        outputs: list of the files saved
+    """
+
+    if progress is None:
+        progress = print
+    if log is None:
+        log = EnquiryLogger(log_path=None)
+
+    with log.enquiry(enquiry) as timer:
+        return process_enquiry(enquiry, layers, basemap_path, progress, cancel, parallel_maps, timer)
+
+
+def process_enquiry(enquiry, layers, basemap_path, progress, cancel, parallel_maps, timer):
+    """
+    Runs the stages of an enquiry, see run_enquiry.
+
+    Parameters:
+        enquiry: dictionary of the enquiry details, see run_enquiry
+
+        layers: LayerStore holding the search layers
+
+        basemap_path: location of the basemap raster
+
+        progress: function called with a status message as each stage of the enquiry is started or completed
+
+        cancel: threading.Event to cancel the enquiry, or None
+
+        parallel_maps: draw the maps in parallel worker processes
+
+        timer: StageTimer recording each stage
+
+    Returns:
+        outputs: list of the files saved
+    """
+
+    def stage(message):
+        # report progress, then stop if the user has cancelled the enquiry
+        progress(message)
+        if cancel is not None and cancel.is_set():
+            raise EnquiryCancelled('enquiry {} cancelled'.format(enquiry['enqno']))
+
+    searches = enquiry['searches']
+    buffer_radius = parse_radii(enquiry['radius'])  # transform user buffer radius values into a list of floats
+    outprefix = str(enquiry['outfolder']) + '/' + str(enquiry['enqno'])
+    map_format = enquiry.get('map_format') or 'jpeg'
+    map_dpi = int(enquiry.get('map_dpi') or MAP_DPI)
+    if map_format not in MAP_FORMATS:
+        raise ValueError('unknown map format {}, expected one of {}'.format(map_format, ', '.join(MAP_FORMATS)))
+    years = parse_years(enquiry)
+    gridref_digits = int(enquiry['gridref_digits']) if enquiry.get('gridref_digits') not in [None, ''] else None
+    if gridref_digits is not None and gridref_digits not in GRID_DIGITS:
+        raise ValueError('grid reference precision must be one of {}'.format(', '.join(map(str, GRID_DIGITS))))
+    outputs = []
+    tables = {}  # output name: results table, exported together once all the searches are run
+    maps = {}  # search type: records to plot and legend handles of the map of each search
+
+    stage('Creating search area')
+
+    # Create buffer from user specified point / grid reference, or from the user specified polygon
+    features = None  # features of the user's file, for a per feature search
+    with timer.stage('search_area'):
+        easting, northing = search_location(enquiry)
+        if easting is not None:
+            userfeat, userbuffer, buffer_feature, input_handles = searcharea_frompoint(easting, northing,
+                                                                                       buffer_radius)
+            search_geom = Point(easting, northing)
+            # search exactly within the radius of the point, unless the enquiry asks to use the buffer polygon
+            centre = search_geom if enquiry.get('exact', True) else None
+        elif enquiry.get('bdyfile'):
+            userpoly, userbuffer, buffer_feature, input_handles = searcharea_frompoly(enquiry['bdyfile'],
+                                                                                      buffer_radius)
+            userfeat = userpoly.geometry
+            search_geom = unary_union(userpoly.geometry)
+            centre = None
+            if str(enquiry.get('per_feature', '')).lower() in ['true', '1', 'yes']:
+                features = search_features(userpoly)
+        else:
+            raise ValueError('no search area specified')
+
+    xmin, ymin, xmax, ymax = buffer_feature.bounds  # get bounds of the buffer
+    # set the extent of the frame on the buffer with a 200m buffer to edge of axis
+    mapextent = [(xmin-200), (xmax+200), (ymin-200), (ymax+200)]
+
+    stage('Searching layers')
+
+    # Run one spatial search per layer, the selected searches below are all taken from these records
+    # (records are given their distance from the search point / area and their radius band)
+    with timer.stage('search_layers') as record:
+        found = search_layers(layers, buffer_feature, searches, search_geom=search_geom, radii=buffer_radius,
+                              centre=centre, features=features, years=years)
+        record['rows'] = {name: len(records) for name, records in found.items()}
+
+    # Search for all protected species in user created buffer
+    if 'species' in searches:
+        with timer.stage('searchSpecies') as record:
+            sppSearch, sppConcat, sppOutput = searchSpecies(found)  # Call species search function
+            record['rows'] = len(sppOutput)
+        maps['species'] = {'records': {'species': sppSearch}, 'handles': [], 'area_legend': True}
+        # Add output to the results to export
+        tables['Species'] = sppOutput
+        stage('Species search completed')
+
+    # Search for GCN only
+    if 'gcn' in searches:
+        with timer.stage('searchGCNs') as record:
+            gcnSearch, gcnOutput, gcn_labels = searchGCNs(found)  # Call GCN search function
+            record['rows'] = len(gcnOutput)
+        maps['gcn'] = {'records': {'gcn': gcnSearch}, 'handles': gcn_labels, 'area_legend': True}
+        # Add output to the results to export
+        tables['GCN'] = gcnOutput
+        stage('GCN search completed')
+
+    # Search for Bats only
+    if 'bats' in searches:
+        with timer.stage('searchBats') as record:
+            batSearch, batOutput, bat_labels = searchBats(found)  # Call bats search function
+            record['rows'] = len(batOutput)
+        maps['bats'] = {'records': {'bats': batSearch}, 'handles': bat_labels, 'area_legend': False}
+        # Add output to the results to export
+        tables['Bats'] = batOutput
+        stage('Bat search completed')
+
+    # Search for invasive species only - note these are not supposed to plot to map
+    if 'invasive' in searches:
+        with timer.stage('searchInvasive') as record:
+            invSearch, invOutput = searchInvasive(found)
+            record['rows'] = len(invOutput)
+        # Add output to the results to export
+        tables['Invasive'] = invOutput
+        stage('Invasive species search completed')
+
+    # Search for sites only
+    if 'sites' in searches:
+        with timer.stage('searchSites') as record:
+            sbiIntersect, basIntersect, site_labels, sitesOutput = searchSites(found)
+            record['rows'] = len(sitesOutput)
+        maps['sites'] = {'records': {'sbi': sbiIntersect, 'bas': basIntersect}, 'handles': site_labels,
+                         'area_legend': True}
+        # Add output to the results to export
+        tables['Sites'] = sitesOutput
+        stage('Sites search completed')
+
+    # Search for sites and species
+    if 'sitesspp' in searches:
+        with timer.stage('searchSitesSpecies') as record:
+            sppSearch, sppConcat, sppOutput = searchSpecies(found)  # run spp search
+            sbiIntersect, basIntersect, sites_labels, sitesOutput = searchSites(found)
+            record['rows'] = len(sppOutput) + len(sitesOutput)
+        maps['sitesspp'] = {'records': {'species': sppSearch, 'sbi': sbiIntersect, 'bas': basIntersect},
+                            'handles': sites_labels, 'area_legend': True}
+        # Add output to the results to export
+        tables['Species'] = sppOutput
+        tables['Sites'] = sitesOutput
+        stage('Sites and species search completed')
+
+    # Regenerate the grid references of the species results at the requested precision
+    if gridref_digits is not None:
+        with timer.stage('regenerate_gridrefs') as record:
+            tables = {name: regenerate_gridrefs(table, gridref_digits) for name, table in tables.items()}
+            record['rows'] = sum(len(table) for table in tables.values())
+
+    # Save all the outputs to one workbook (or csv/parquet files) in the user specified folder
+    stage('Exporting results')
+    with timer.stage('export') as record:
+        outputs += export_results(tables, outprefix, enquiry.get('format') or 'xlsx')
+        record['rows'] = sum(len(table) for table in tables.values())
+
+    # Draw and save a map of each search to the user specified folder
+    stage('Drawing maps')
+    jobs = [dict(maps[product], product=product, sitename=enquiry['sitename'], dpi=map_dpi,
+                 outpath=outprefix + '_' + MAP_PRODUCTS[product]['name'] + 'Map.' + map_format,
+                 basemap_path=basemap_path, mapextent=mapextent, userfeat=userfeat, userbuffer=userbuffer)
+            for product in MAP_PRODUCTS if product in maps]
+    with timer.stage('maps') as record:
+        for outpath, map_stages in render_maps(jobs, parallel=parallel_maps):
+            outputs.append(outpath)
+            timer.stages += map_stages  # stages of drawing each map, timed where the map was drawn
+        record['rows'] = len(jobs)
+
+    progress('Enquiry {} completed'.format(enquiry['enqno']))
+
+    return outputs
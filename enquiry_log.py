@@ -0,0 +1,235 @@
+import cProfile
+import json
+import logging
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from logging.handlers import RotatingFileHandler
+from pathlib import Path
+
+try:
+    import psutil
+except ImportError:  # memory is then taken from resource, where available
+    psutil = None
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+# Log of the enquiries run, one JSON record per line, and folder for the profiles of slow enquiries
+LOG_PATH = Path('output/logs/enquiries.log')
+PROFILE_DIR = Path('output/logs/profiles')
+LOG_BYTES = 5 * 1024 * 1024  # size the log is rotated at
+LOG_BACKUPS = 5  # number of rotated logs kept
+
+MB = 1024 * 1024
+
+# Interval the memory of the process is sampled at during each stage, in seconds (see MemorySampler)
+MEMORY_SAMPLE_INTERVAL = 0.05
+
+
+def memory_usage():
+    """
+    Returns the memory used by this process.
+
+    Returns:
+        current: resident memory in MB, None if not available
+
+        peak: highest resident memory of the process so far in MB, None if not available
+    """
+
+    current = peak = None
+    if psutil is not None:
+        info = psutil.Process().memory_info()
+        current = info.rss / MB
+        if getattr(info, 'peak_wset', None):  # Windows
+            peak = info.peak_wset / MB
+    if current is None and resource is not None:
+        try:  # Linux without psutil
+            with open('/proc/self/statm') as statm:
+                current = int(statm.read().split()[1]) * resource.getpagesize() / MB
+        except OSError:
+            pass
+    if peak is None and resource is not None:
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak = maxrss / MB if sys.platform == 'darwin' else maxrss / 1024  # bytes on macOS, KB on Linux
+
+    return current, peak
+
+
+class MemorySampler:
+    """
+    Samples the resident memory of the process on a background thread, to find the peak memory of one stage. The
+    operating system only reports the peak of the whole process, which never falls after the first large enquiry.
+    Peaks shorter than the sampling interval can be missed.
+
+    Parameters:
+        interval: time in seconds between samples
+    """
+
+    def __init__(self, interval=MEMORY_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.peak = memory_usage()[0]
+        self._stop = threading.Event()
+        self._thread = None
+        if self.peak is not None:
+            self._thread = threading.Thread(target=self._run, name='memory-sampler', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def _sample(self):
+        current = memory_usage()[0]
+        if current is not None and current > self.peak:
+            self.peak = current
+
+    def stop(self):
+        """
+        Stops sampling.
+
+        Returns:
+            peak: highest resident memory sampled in MB, None if not available
+        """
+
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._sample()
+
+        return self.peak
+
+
+class StageTimer:
+    """
+    Records the wall time, memory and row counts of each stage of an enquiry. The memory recorded is the resident
+    memory at the end of the stage, the peak during the stage and the peak of the process so far.
+    """
+
+    def __init__(self):
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Times a stage of the enquiry. The stage record is yielded, so row counts can be added to it, e.g.
+        record['rows'] = len(output).
+
+        Parameters:
+            name: name of the stage
+        """
+
+        record = {'stage': name}
+        sampler = MemorySampler()
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['seconds'] = round(time.perf_counter() - start, 4)
+            stage_peak = sampler.stop()
+            current, peak = memory_usage()
+            record['rss_mb'] = None if current is None else round(current, 1)
+            record['peak_rss_mb'] = None if stage_peak is None else round(stage_peak, 1)
+            record['process_peak_rss_mb'] = None if peak is None else round(peak, 1)
+            self.stages.append(record)
+
+
+class EnquiryLogger:
+    """
+    Writes a structured record of each enquiry, one JSON record per line, to a rotating log file. The record holds
+    the enquiry details, its outcome, total time and the time, memory and row counts of each stage.
+
+    If a profile threshold is given each enquiry is run under cProfile, and the profile of any enquiry taking longer
+    than the threshold is saved to the profile folder (open with e.g. snakeviz or pstats).
+
+    Parameters:
+        log_path: filepath of the log, the records are only kept in last_record if None (e.g. in worker processes
+        which pass the record back to be logged)
+
+        profile_threshold: time in seconds above which the enquiry profile is saved, enquiries are not profiled if
+        None
+
+        profile_dir: folder to save profiles to
+
+        max_bytes: size the log is rotated at
+
+        backups: number of rotated logs kept
+    """
+
+    def __init__(self, log_path=LOG_PATH, profile_threshold=None, profile_dir=PROFILE_DIR, max_bytes=LOG_BYTES,
+                 backups=LOG_BACKUPS):
+        self.profile_threshold = profile_threshold
+        self.profile_dir = Path(profile_dir)
+        self.last_record = None
+        self.logger = None
+
+        if log_path is not None:
+            log_path = Path(log_path)
+            log_path.parent.mkdir(parents=True, exist_ok=True)
+            self.logger = logging.getLogger('enquiry.' + str(log_path.resolve()))
+            self.logger.setLevel(logging.INFO)
+            self.logger.propagate = False
+            if not self.logger.handlers:  # one handler per log file, however many loggers are created
+                handler = RotatingFileHandler(log_path, maxBytes=max_bytes, backupCount=backups, encoding='utf-8')
+                handler.setFormatter(logging.Formatter('%(message)s'))
+                self.logger.addHandler(handler)
+
+    @contextmanager
+    def enquiry(self, enquiry):
+        """
+        Records an enquiry. Yields a StageTimer to time the stages of the enquiry, the record is written when the
+        enquiry completes, fails or is cancelled.
+
+        Parameters:
+            enquiry: dictionary of the enquiry details, see run_enquiry
+        """
+
+        timer = StageTimer()
+        record = {'enqno': str(enquiry.get('enqno')),
+                  'started': datetime.now().isoformat(timespec='seconds'),
+                  'searches': list(enquiry.get('searches', [])),
+                  'radius': str(enquiry.get('radius')),
+                  'search_area': 'polygon' if enquiry.get('bdyfile') else 'point',
+                  'status': 'completed'}
+
+        profiler = cProfile.Profile() if self.profile_threshold is not None else None
+        start = time.perf_counter()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield timer
+        except Exception as error:
+            record['status'] = type(error).__name__  # e.g. EnquiryCancelled
+            record['error'] = str(error)
+            raise
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            record['seconds'] = round(time.perf_counter() - start, 4)
+            record['stages'] = timer.stages
+
+            if profiler is not None and record['seconds'] >= self.profile_threshold:
+                self.profile_dir.mkdir(parents=True, exist_ok=True)
+                profile_path = self.profile_dir / '{}_{}.prof'.format(record['enqno'].replace('/', '-'),
+                                                                      datetime.now().strftime('%Y%m%d%H%M%S'))
+                profiler.dump_stats(str(profile_path))
+                record['profile'] = str(profile_path)
+
+            self.write(record)
+
+    def write(self, record):
+        """
+        Writes an enquiry record to the log.
+
+        Parameters:
+            record: dictionary of the enquiry record
+        """
+
+        self.last_record = record
+        if self.logger is not None:
+            self.logger.info(json.dumps(record, default=str))
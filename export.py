@@ -0,0 +1,115 @@
+import pandas as pd
+import xlsxwriter
+
+
+# Output formats which can be written by export_results
+EXPORT_FORMATS = ['xlsx', 'csv', 'parquet']
+
+# Number of rows converted at a time when streaming a table into the workbook
+CHUNK_ROWS = 10000
+
+# Fields the results of each output are summarised by on the summary sheet
+SUMMARY_FIELDS = ['FeatureID', 'InformalGr', 'Status', 'Band']
+
+
+def summarise_results(tables):
+    """
+    Creates a summary of the search results: the number of records of each output, and the number of records by
+    feature (per feature searches), informal group (species outputs), status (sites output) and distance band
+    (banded searches).
+
+    Parameters:
+        tables: dictionary of output name: Dataframe of the output
+
+    Returns:
+        summary: Dataframe with columns Output, Field, Value and Records
+    """
+
+    rows = []
+    for name, table in tables.items():
+        rows.append({'Output': name, 'Field': 'All records', 'Value': '', 'Records': len(table)})
+        for field in SUMMARY_FIELDS:
+            if field in table.columns:
+                counts = table[field].value_counts(sort=False, dropna=False).sort_index()
+                counts = counts[counts > 0]  # categorical fields also count the categories with no records
+                rows += [{'Output': name, 'Field': field, 'Value': str(value), 'Records': int(count)}
+                         for value, count in counts.items()]
+
+    return pd.DataFrame(rows, columns=['Output', 'Field', 'Value', 'Records'])
+
+
+def write_sheet(workbook, name, table):
+    """
+    Writes a table to a new sheet of a streaming (constant memory) xlsxwriter workbook. Rows are written in order
+    and converted to python values in chunks, so the whole table is never held as cell objects in memory.
+
+    Parameters:
+        workbook: xlsxwriter Workbook opened with constant_memory
+
+        name: name of the sheet
+
+        table: Dataframe to write
+    """
+
+    worksheet = workbook.add_worksheet(name)
+    date_format = workbook.add_format({'num_format': 'dd/mm/yyyy'})
+    worksheet.write_row(0, 0, [str(column) for column in table.columns])
+
+    # dates need a cell format, otherwise they are shown as numbers
+    date_columns = [i for i, dtype in enumerate(table.dtypes) if pd.api.types.is_datetime64_any_dtype(dtype)]
+
+    for start in range(0, len(table), CHUNK_ROWS):
+        chunk = table.iloc[start:start + CHUNK_ROWS]
+        values = chunk.astype(object).where(chunk.notna(), None).values.tolist()  # missing values as blank cells
+        for offset, row in enumerate(values):
+            worksheet.write_row(start + offset + 1, 0, row)
+            for column in date_columns:
+                if row[column] is not None:
+                    worksheet.write_datetime(start + offset + 1, column, row[column].to_pydatetime(), date_format)
+
+
+def export_results(tables, outprefix, fmt='xlsx'):
+    """
+    Exports the results of an enquiry. For xlsx a single workbook is written with one sheet for each output and a
+    summary sheet, using xlsxwriter in constant memory mode so export time and memory stay flat as the number of
+    records grows. For csv and parquet (e.g. for downstream automation) one file is written per output, plus the
+    summary.
+
+    Parameters:
+        tables: dictionary of output name (e.g. 'Species', 'Sites'): Dataframe of the output
+
+        outprefix: output folder and enquiry number the output file names start with
+
+        fmt: output format, one of EXPORT_FORMATS
+
+    Returns:
+        outputs: list of the files saved
+    """
+
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError('unknown output format {}, expected one of {}'.format(fmt, ', '.join(EXPORT_FORMATS)))
+
+    summary = summarise_results(tables)
+
+    if fmt == 'xlsx':
+        outpath = outprefix + '_SearchResults.xlsx'
+        workbook = xlsxwriter.Workbook(outpath, {'constant_memory': True})
+        write_sheet(workbook, 'Summary', summary)
+        for name, table in tables.items():
+            write_sheet(workbook, name, table)
+        workbook.close()
+
+        return [outpath]
+
+    outputs = []
+    outpaths = {name: outprefix + '_' + name + 'SearchResults.' + fmt for name in tables}
+    outpaths['Summary'] = outprefix + '_SearchSummary.' + fmt
+    for name, table in list(tables.items()) + [('Summary', summary)]:
+        outpath = outpaths[name]
+        if fmt == 'csv':
+            table.to_csv(outpath, index=False, chunksize=CHUNK_ROWS)
+        else:
+            pd.DataFrame(table).to_parquet(outpath, index=False)
+        outputs.append(outpath)
+
+    return outputs
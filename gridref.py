@@ -0,0 +1,191 @@
+import numpy as np
+import pandas as pd
+
+
+# Precisions supported, as the total number of digits in a grid reference (e.g. SJ8765 has 4 digits, a 1km square)
+GRID_DIGITS = [2, 4, 6, 8, 10]
+
+# Extent of the National Grid in 100km squares
+GRID_SQUARES_E = 7
+GRID_SQUARES_N = 13
+
+_A = ord('A')
+_I = ord('I') - _A
+_ZERO = ord('0')
+
+
+def letter_index(codes):
+    """
+    Returns the position of grid letters in the 5x5 letter grid (A-Z without I), -1 for characters which are not
+    grid letters.
+
+    Parameters:
+        codes: array of unicode code points
+
+    Returns:
+        index: array of letter positions
+    """
+
+    index = codes.astype(np.int64) - _A
+    valid = (index >= 0) & (index < 26) & (index != _I)
+    index = np.where(index > _I, index - 1, index)
+
+    return np.where(valid, index, -1)
+
+
+def gridref_to_osgb36(gridrefs, centre=False):
+    """
+    Converts BNG grid references to easting and northing, for a whole array of references at once. References can
+    have any precision from 2 to 10 digits and may contain spaces and lower case letters, e.g. 'SJ8765',
+    'sj 87654 65432'. Invalid references are reported for each row rather than raising an error.
+
+    The conversion works on the character codes of the references as a numpy array, so no python code runs per
+    reference.
+
+    Parameters:
+        gridrefs: grid reference as a string, or a list / array of grid references
+
+        centre: return the centre of each grid square rather than its south west corner
+
+    Returns:
+        easting: array of eastings, NaN for invalid references
+
+        northing: array of northings, NaN for invalid references
+
+        errors: array of the error for each reference, None for valid references
+    """
+
+    refs = np.atleast_1d(np.asarray(gridrefs, dtype=str))
+    count = len(refs)
+    width = max(refs.dtype.itemsize // 4, 1)
+    codes = np.ascontiguousarray(refs.astype('U{}'.format(width))).view(np.uint32).reshape(count, width)
+
+    # upper case, then move the spaces to the end of each reference, keeping the order of the other characters
+    codes = np.where((codes >= ord('a')) & (codes <= ord('z')), codes - 32, codes)
+    blank = (codes == ord(' ')) | (codes == 0)
+    codes = np.take_along_axis(codes, np.argsort(blank, axis=1, kind='stable'), axis=1)
+    codes = np.where(np.sort(blank, axis=1), 0, codes)
+    length = (codes != 0).sum(axis=1)
+
+    easting = np.full(count, np.nan)
+    northing = np.full(count, np.nan)
+    errors = np.full(count, None, dtype=object)
+
+    if width < 2:
+        codes = np.pad(codes, ((0, 0), (0, 2 - width)))
+    first = letter_index(codes[:, 0])
+    second = letter_index(codes[:, 1])
+    digits = length - 2
+
+    errors[(first < 0) | (second < 0)] = 'grid reference must start with two grid letters'
+    errors[(errors == None) & ((digits < GRID_DIGITS[0]) | (digits > GRID_DIGITS[-1]))] = \
+        'grid reference must have between 2 and 10 digits'  # noqa: E711 (elementwise comparison)
+    errors[(errors == None) & (digits % 2 == 1)] = 'grid reference must have an even number of digits'  # noqa: E711
+
+    # 100km square of the letters
+    e100 = ((first - 2) % 5) * 5 + second % 5
+    n100 = (19 - (first // 5) * 5) - second // 5
+    errors[(errors == None) & ((e100 < 0) | (e100 >= GRID_SQUARES_E) | (n100 < 0) | (n100 >= GRID_SQUARES_N))] = \
+        'grid letters are outside the National Grid'  # noqa: E711
+
+    # digits of each precision are converted together
+    for ndigits in GRID_DIGITS:
+        rows = np.flatnonzero((errors == None) & (digits == ndigits))  # noqa: E711
+        if not len(rows):
+            continue
+        half = ndigits // 2
+        values = codes[rows, 2:2 + ndigits].astype(np.int64) - _ZERO
+        bad = ((values < 0) | (values > 9)).any(axis=1)
+        errors[rows[bad]] = 'grid reference digits must be numbers'
+        rows, values = rows[~bad], values[~bad]
+
+        powers = 10 ** np.arange(half - 1, -1, -1)
+        size = 10 ** (5 - half)  # size of the grid square in metres
+        offset = size / 2 if centre else 0
+        easting[rows] = e100[rows] * 100000 + (values[:, :half] @ powers) * size + offset
+        northing[rows] = n100[rows] * 100000 + (values[:, half:] @ powers) * size + offset
+
+    return easting, northing, errors
+
+
+def osgb36_to_gridref(easting, northing, digits=10):
+    """
+    Converts eastings and northings to BNG grid references at the given precision, for whole arrays at once. The
+    reference is of the grid square containing each point, e.g. 387654, 365432 is SJ8765 at 4 digits.
+
+    Parameters:
+        easting: easting, or list / array of eastings
+
+        northing: northing, or list / array of northings
+
+        digits: precision of the grid references, one of GRID_DIGITS
+
+    Returns:
+        gridrefs: array of grid references, '' where the point is outside the National Grid
+    """
+
+    if digits not in GRID_DIGITS:
+        raise ValueError('grid reference precision must be one of {}'.format(', '.join(map(str, GRID_DIGITS))))
+
+    easting = np.atleast_1d(np.asarray(easting, dtype=float))
+    northing = np.atleast_1d(np.asarray(northing, dtype=float))
+    valid = ((easting >= 0) & (easting < GRID_SQUARES_E * 100000) & (northing >= 0)
+             & (northing < GRID_SQUARES_N * 100000))
+    e = np.where(valid, easting, 0).astype(np.int64)
+    n = np.where(valid, northing, 0).astype(np.int64)
+
+    # letters of the 100km square, skipping I
+    e100, n100 = e // 100000, n // 100000
+    first = (19 - n100) - (19 - n100) % 5 + (e100 + 10) // 5
+    second = ((19 - n100) * 5) % 25 + e100 % 5
+    first = np.where(first >= _I, first + 1, first)
+    second = np.where(second >= _I, second + 1, second)
+
+    # digits of the easting and northing within the 100km square
+    half = digits // 2
+    powers = 10 ** np.arange(half - 1, -1, -1)
+    e_digits = ((e % 100000) // 10 ** (5 - half))[:, None] // powers % 10
+    n_digits = ((n % 100000) // 10 ** (5 - half))[:, None] // powers % 10
+
+    codes = np.column_stack([first + _A, second + _A, e_digits + _ZERO, n_digits + _ZERO]).astype(np.uint32)
+    gridrefs = np.ascontiguousarray(codes).view('U{}'.format(2 + digits)).ravel()
+
+    return np.where(valid, gridrefs, '')
+
+
+def regenerate_gridrefs(records, digits=None):
+    """
+    Regenerates the GridRef column of a set of records at a given precision, and the Grid1km column (the 4 digit,
+    1km square reference), from the Easting and Northing columns of the records. References are not made more
+    precise than the record itself, e.g. a 1km record keeps a 4 digit GridRef when 8 digits are requested.
+
+    Parameters:
+        records: Dataframe of records with Easting and Northing columns (and optionally Precision, the number of
+        digits of each axis the record was made at, e.g. 2 for a 1km record)
+
+        digits: precision of the GridRef column, one of GRID_DIGITS, GridRef is not changed if None
+
+    Returns:
+        records: copy of the records with the regenerated columns
+    """
+
+    if 'Easting' not in records.columns or 'Northing' not in records.columns:
+        return records
+
+    records = records.copy()
+    easting = pd.to_numeric(records['Easting'], errors='coerce').values.astype(float)
+    northing = pd.to_numeric(records['Northing'], errors='coerce').values.astype(float)
+    records['Grid1km'] = osgb36_to_gridref(easting, northing, 4)
+
+    if digits is not None:
+        gridref = osgb36_to_gridref(easting, northing, digits)
+        if 'Precision' in records.columns:
+            # digits each record's precision supports, e.g. a precision of 3 (100m) supports 6 digits
+            supported = 2 * pd.to_numeric(records['Precision'], errors='coerce').values.astype(float)
+            for ndigits in GRID_DIGITS:
+                rows = (supported == ndigits) & (ndigits < digits)
+                if rows.any():
+                    gridref[rows] = osgb36_to_gridref(easting[rows], northing[rows], ndigits)
+        records['GridRef'] = gridref
+
+    return records
@@ -0,0 +1,1099 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from shapely.geometry import LineString, box
+from shapely.prepared import prep
+
+
+# Folder used to hold the columnar copies of the master layers
+CACHE_DIR = Path('output/cache')
+
+# Master layers used by the searches
+LAYER_FILES = {'species': 'SampleData/SHP/ProtSpp_font_point.shp',  # species 100m+ layer
+               'species1km': 'SampleData/SHP/ProtSpp1km_region.shp',  # species 1km layer
+               'sbi': 'SampleData/SHP/SBI_region.shp',  # SBI layer
+               'bas': 'SampleData/SHP/BAS_region.shp',  # BAS layer
+               'invasive': 'SampleData/SHP/InvasiveSpp_font_point.shp',  # invasive species 100m+ layer
+               'invasive1km': 'SampleData/SHP/InvasiveSpp1km_region.shp'}  # invasive species 1km layer
+
+# Columns of the species and invasive species layers used by the searches and kept in the outputs (extraneous
+# columns removed for GDPR)
+SPECIES_COLUMNS = ['SciName', 'CommonName', 'InformalGr', 'Location', 'LocDetail', 'GridRef', 'Grid1km',
+                   'Date', 'Year', 'Source', 'SampleMeth', 'SexStage', 'RecType', 'EuProt',
+                   'UKProt', 'PrincipalS', 'RareSpp', 'StatInvasi', 'StaffsINNS', 'RecordStat', 'Confidenti',
+                   'Easting', 'Northing', 'Precision']
+
+# Columns of the sites layers used by the searches and kept in the outputs (extraneous columns removed for GDPR)
+SITES_COLUMNS = ['SiteID', 'SiteName', 'Status', 'Year', 'Abstract']
+
+# Columns read from each master layer (with the geometry), all other columns are dropped when the layer is loaded
+LAYER_COLUMNS = {'species': SPECIES_COLUMNS,
+                 'species1km': SPECIES_COLUMNS,
+                 'sbi': SITES_COLUMNS,
+                 'bas': SITES_COLUMNS,
+                 'invasive': SPECIES_COLUMNS,
+                 'invasive1km': SPECIES_COLUMNS}
+
+# Low cardinality text columns, held as categoricals (one integer code per record plus one copy of each value)
+CATEGORY_COLUMNS = ['InformalGr', 'CommonName', 'Source', 'UKProt', 'EuProt', 'RecordStat', 'Status']
+
+# Numeric columns, read as numbers rather than text
+NUMERIC_COLUMNS = ['Easting', 'Northing', 'Precision', 'Year']
+
+# Record layers which can be limited to a range of years (the Year of the sites layers is their designation year)
+DATED_LAYERS = ['species', 'species1km', 'invasive', 'invasive1km']
+
+# Column added to each compacted layer holding the position of each record in the source, so search results of
+# layers sorted by year can be put back in the order of the source (see source_order)
+ROW_COLUMN = 'SourceRow'
+
+# Version of the compacted layers, the cached copies are rebuilt when this changes (e.g. when compact_layer changes)
+LAYER_VERSION = 4
+
+# Size of the square tiles the on demand copies of the layers are split into, in metres (see tile_layer)
+TILE_SIZE = 10000
+TILE_CHUNK_ROWS = 500000  # records read from the source at a time when tiling, so the layer is never held whole
+
+# 1km precision record layers, searched by grid square (see build_grid_index)
+GRID_LAYERS = ['species1km', 'invasive1km']
+GRID_KEY = 10000  # grid square key multiplier, larger than the number of 1km squares north of the BNG origin
+GRID_TOLERANCE = 1  # distance in metres the corners of a square record can be from the grid lines
+GRID_AREA_TOLERANCE = 0.01  # relative difference from 1km2 the area of a square record can have
+GRID_MIN_SQUARES = 0.5  # fraction of the records which must be 1km squares for the grid index to be used
+
+# Search types, keyed by the search type checkboxes in the GUI
+SEARCH_TYPES = {'-SPP-': 'species',
+                '-BATS-': 'bats',
+                '-GCN-': 'gcn',
+                '-INV-': 'invasive',
+                '-SITES-': 'sites',
+                '-SITESSPP-': 'sitesspp'}
+
+# Layers needed by each of the search types
+SEARCH_LAYERS = {'species': ['species', 'species1km'],
+                 'bats': ['species', 'species1km'],
+                 'gcn': ['species', 'species1km'],
+                 'invasive': ['invasive', 'invasive1km'],
+                 'sites': ['sbi', 'bas'],
+                 'sitesspp': ['species', 'species1km', 'sbi', 'bas']}
+
+# Files which make up a shapefile / MapInfo TAB / GeoPackage, any change to these invalidates the cached copy
+SOURCE_SUFFIXES = ['.shp', '.shx', '.dbf', '.prj', '.cpg', '.tab', '.dat', '.map', '.id', '.ind', '.gpkg']
+
+
+def source_files(filepath):
+    """
+    Lists the files on disk which make up a layer, e.g. the .shp, .shx, .dbf and .prj files of a shapefile.
+
+    Parameters:
+        filepath: the filepath to the layer (SHP, TAB or GPKG)
+
+    Returns:
+        files: sorted list of Paths of the files making up the layer
+    """
+
+    filepath = Path(filepath)
+    files = [f for f in filepath.parent.glob(filepath.stem + '.*') if f.suffix.lower() in SOURCE_SUFFIXES]
+
+    return sorted(files)
+
+
+def source_signature(filepath):
+    """
+    Returns the modified time and size of each file making up a layer. This is cheap to check on every start up and
+    is used to decide if the cached copy of a layer is still up to date.
+
+    Parameters:
+        filepath: the filepath to the layer (SHP, TAB or GPKG)
+
+    Returns:
+        signature: dictionary of file name: [modified time in ns, size in bytes]
+    """
+
+    return {f.name: [f.stat().st_mtime_ns, f.stat().st_size] for f in source_files(filepath)}
+
+
+def source_hash(filepath):
+    """
+    Returns an md5 hash of the contents of the files making up a layer. Only used when the modified times of the
+    source have changed, so that a copied or touched file with the same contents does not force a re-read.
+
+    Parameters:
+        filepath: the filepath to the layer (SHP, TAB or GPKG)
+
+    Returns:
+        digest: hex string of the md5 hash
+    """
+
+    md5 = hashlib.md5()
+    for f in source_files(filepath):
+        md5.update(f.name.encode())
+        with open(f, 'rb') as src:
+            for block in iter(lambda: src.read(1 << 20), b''):  # read in 1MB blocks to keep memory low
+                md5.update(block)
+
+    return md5.hexdigest()
+
+
+def parse_dates(values):
+    """
+    Parses record dates, written either as ISO dates (YYYY-MM-DD, as read from a DBF date field), UK dates
+    (DD/MM/YYYY) or years only. Each format is parsed for the whole column at once.
+
+    Parameters:
+        values: Series of the dates
+
+    Returns:
+        dates: datetime64 Series of the dates, NaT where the date is missing or not recognised
+    """
+
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values
+
+    dates = pd.to_datetime(values, errors='coerce', format='%Y-%m-%d')
+    for date_format in ['%d/%m/%Y', '%Y']:
+        missing = dates.isna()
+        if missing.any():
+            dates[missing] = pd.to_datetime(values[missing], errors='coerce', format=date_format)
+
+    return dates
+
+
+def read_source(filepath, columns=None, **kwargs):
+    """
+    Reads a master layer from its source file, parsing only the given columns (and the geometry), so the fields
+    the searches do not use are never read from the DBF. Columns missing from the source are ignored.
+
+    Parameters:
+        filepath: the filepath to the layer (SHP, TAB or GPKG)
+
+        columns: list of the columns to read, all columns are read if None
+
+        kwargs: other arguments of gpd.read_file, e.g. bbox or rows
+
+    Returns:
+        layer: Geodataframe of the layer
+    """
+
+    if columns is None:
+        return gpd.read_file(filepath, **kwargs)
+
+    try:
+        return gpd.read_file(filepath, columns=columns, **kwargs)
+    except TypeError:  # geopandas too old to select columns, they are dropped by compact_layer instead
+        return gpd.read_file(filepath, **kwargs)
+
+
+def compact_layer(layer, columns=None, sort_years=False):
+    """
+    Reduces the memory held by a layer: keeps only the given columns (and the geometry), converts the low
+    cardinality text columns (CATEGORY_COLUMNS) to categoricals and the numeric columns (NUMERIC_COLUMNS) to
+    numbers. Filters on the categorical columns then compare integer codes rather than strings. The position of
+    each record in the source is kept in ROW_COLUMN.
+
+    The record layers (sort_years) are sorted by year (records without a year last, filling the Year from the Date
+    where it is missing), so the records of a range of years can be found by binary search, see year_slice. The
+    Date is kept as written in the source, it is only parsed to fill the Year.
+
+    Parameters:
+        layer: Geodataframe of the layer
+
+        columns: list of the columns to keep, all columns are kept if None
+
+        sort_years: sort the records by year, for the DATED_LAYERS
+
+    Returns:
+        layer: compacted copy of the layer
+    """
+
+    keep = [column for column in layer.columns if column != layer.geometry.name]
+    if columns is not None:
+        keep = [column for column in columns if column in layer.columns]
+    layer = layer[keep + [layer.geometry.name]].copy()
+    layer[ROW_COLUMN] = np.arange(len(layer), dtype=np.int32 if len(layer) < 2 ** 31 else np.int64)
+
+    for column in layer.columns.intersection(CATEGORY_COLUMNS):
+        layer[column] = layer[column].astype('category')
+    for column in layer.columns.intersection(NUMERIC_COLUMNS):
+        # whole numbers are held in the smallest integer type, anything else (or missing values) as floats
+        layer[column] = pd.to_numeric(layer[column], errors='coerce', downcast='integer')
+
+    if sort_years and 'Year' in layer.columns:
+        if 'Date' in layer.columns:
+            # free text dates which are not recognised are left as they are, the record just has no year
+            layer['Year'] = layer['Year'].fillna(parse_dates(layer['Date']).dt.year)
+        layer = layer.sort_values('Year', kind='mergesort', na_position='last').reset_index(drop=True)
+
+    return layer
+
+
+def concat_records(frames):
+    """
+    Concatenates search results or layer tiles, e.g. the 100m+ and 1km precision records. Categorical columns stay
+    categorical, with the categories of all the results (pd.concat only keeps them when the categories are the same).
+
+    Parameters:
+        frames: list of Geodataframes of search results or layer tiles
+
+    Returns:
+        records: Geodataframe of the concatenated results
+    """
+
+    for column in frames[0].columns:
+        if all(column in frame.columns and isinstance(frame[column].dtype, pd.CategoricalDtype) for frame in frames):
+            categories = frames[0][column].cat.categories
+            for frame in frames[1:]:
+                categories = categories.union(frame[column].cat.categories)
+            frames = [frame.assign(**{column: frame[column].cat.set_categories(categories)}) for frame in frames]
+
+    return pd.concat(frames)
+
+
+def source_order(records):
+    """
+    Puts search results back in the order of the records in the source layer (see ROW_COLUMN), so the results of a
+    layer sorted by year are reported in the same order as a search of the source.
+
+    Parameters:
+        records: Geodataframe of search results
+
+    Returns:
+        records: Geodataframe of the results in source order
+    """
+
+    if ROW_COLUMN not in records.columns:
+        return records
+
+    return records.sort_values(ROW_COLUMN, kind='mergesort')
+
+
+def current_meta(meta_path, filepath, signature, columns, sort_years=False):
+    """
+    Returns the metadata of a cached copy of a layer if the copy is up to date: made from the same source, with the
+    same columns, and the source has not been modified since (the modified time and size are the same, or the
+    contents hash still matches, in which case the stored signature is updated).
+
+    Parameters:
+        meta_path: filepath of the metadata saved with the cached copy
+
+        filepath: the filepath to the layer (SHP, TAB or GPKG)
+
+        signature: current signature of the source, from source_signature
+
+        columns: list of the columns kept in the cached copy, None for all columns
+
+        sort_years: whether the records of the cached copy are sorted by year
+
+    Returns:
+        meta: dictionary of the metadata, or None if there is no up to date cached copy (or it was made by an earlier
+        LAYER_VERSION)
+    """
+
+    if not meta_path.exists():
+        return None
+
+    meta = json.loads(meta_path.read_text())
+
+    if meta['source'] == str(filepath) and meta['signature'] != signature:
+        # the modified time has changed, only re-read the source if the contents have also changed
+        if meta['hash'] == source_hash(filepath):
+            meta['signature'] = signature
+            meta_path.write_text(json.dumps(meta))
+
+    if (meta['source'] == str(filepath) and meta['signature'] == signature and meta.get('columns') == columns
+            and meta.get('sort_years', False) == sort_years and meta.get('version') == LAYER_VERSION):
+        return meta
+
+    return None
+
+
+def load_layer(filepath, cache_dir=CACHE_DIR, columns=None, sort_years=False):
+    """
+    Loads a master layer, using a GeoParquet copy of the layer held in the cache folder where possible. The first
+    time a layer is loaded it is read from the source file, compacted (see compact_layer) and written to the cache,
+    later loads read the cached copy, which is much faster than parsing the DBF. If the source has been modified
+    (the modified time or size has changed and the contents hash no longer matches), or different columns are
+    needed, the layer is read from the source again and the cache is rewritten.
+
+    If pyarrow is not installed the layer is read from the source file every time.
+
+    Parameters:
+        filepath: the filepath to the layer (SHP, TAB or GPKG)
+
+        cache_dir: folder to hold the cached copies of layers
+
+        columns: list of the columns to keep (e.g. from LAYER_COLUMNS), all columns are kept if None
+
+        sort_years: sort the records by year, see compact_layer
+
+    Returns:
+        layer: Geodataframe of the layer
+    """
+
+    filepath = Path(filepath)
+    cache_dir = Path(cache_dir)
+    cache_path = cache_dir / (filepath.stem + '.parquet')  # columnar copy of the layer, geometry stored as WKB
+    meta_path = cache_dir / (filepath.stem + '.json')  # signature of the source the cached copy was made from
+
+    signature = source_signature(filepath)
+
+    if cache_path.exists() and current_meta(meta_path, filepath, signature, columns, sort_years) is not None:
+        try:
+            return gpd.read_parquet(cache_path)
+        except ImportError:  # pyarrow not available, fall back to the source
+            return compact_layer(read_source(filepath, columns), columns, sort_years)
+
+    layer = compact_layer(read_source(filepath, columns), columns, sort_years)  # cold read of the source
+
+    # Write to temporary files first and then replace the cached copy, so that several processes loading the same
+    # layer (e.g. batch enquiry workers) never read a partly written cache. The temporary names keep the full file
+    # name, as the copy and its metadata only differ by suffix
+    tmp_suffix = '.{}.tmp'.format(os.getpid())
+    tmp_cache_path = cache_path.with_name(cache_path.name + tmp_suffix)
+    tmp_meta_path = meta_path.with_name(meta_path.name + tmp_suffix)
+    try:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        layer.to_parquet(tmp_cache_path)
+    except ImportError:  # pyarrow not available, use the source without caching
+        return layer
+
+    meta = {'source': str(filepath), 'signature': signature, 'hash': source_hash(filepath), 'columns': columns,
+            'sort_years': sort_years, 'version': LAYER_VERSION}
+    tmp_meta_path.write_text(json.dumps(meta))
+    os.replace(tmp_cache_path, cache_path)
+    os.replace(tmp_meta_path, meta_path)
+
+    return layer
+
+
+def tile_layer(filepath, cache_dir=CACHE_DIR, columns=None, sort_years=False):
+    """
+    Builds the on demand copy of a layer, used to search datasets too large to hold in memory (see read_window).
+    The source is read TILE_CHUNK_ROWS records at a time, and each piece is compacted (see compact_layer) and split
+    into TILE_SIZE square tiles by the south west corner of each record's bounds, so only one piece of the layer is
+    held in memory at once. The pieces of each tile are then joined into one GeoParquet file, one tile at a time,
+    and a sidecar index lists the tiles with records and the largest record width and height. This is done once,
+    the copy is rebuilt only when the source changes (as for load_layer).
+
+    Parameters:
+        filepath: the filepath to the layer (SHP, TAB or GPKG)
+
+        cache_dir: folder to hold the on demand copies of layers
+
+        columns: list of the columns to keep (e.g. from LAYER_COLUMNS), all columns are kept if None
+
+        sort_years: sort the records by year, see compact_layer
+
+    Returns:
+        tiles: dictionary of the tile index, with the folder of the tiles, the tiles with records ([tx, ty] tile
+        numbers) and margin, the largest record [width, height]. None if pyarrow is not installed
+    """
+
+    filepath = Path(filepath)
+    tile_dir = Path(cache_dir) / (filepath.stem + '_tiles')
+    meta_path = tile_dir / 'index.json'
+    signature = source_signature(filepath)
+
+    meta = current_meta(meta_path, filepath, signature, columns, sort_years)
+    if meta is not None and meta['tile_size'] == TILE_SIZE:
+        meta['folder'] = str(tile_dir)
+        return meta
+
+    # Write to a temporary folder first and then replace the tiles, so that several processes tiling the same layer
+    # never read a partly written copy
+    tmp_dir = tile_dir.with_name(tile_dir.name + '.{}.tmp'.format(os.getpid()))
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir(parents=True)
+
+    parts = {}  # (tx, ty): number of pieces of the tile written
+    margin = [0.0, 0.0]
+    start = 0
+    while True:
+        chunk = compact_layer(read_source(filepath, columns, rows=slice(start, start + TILE_CHUNK_ROWS)), columns,
+                              sort_years)
+        chunk[ROW_COLUMN] = chunk[ROW_COLUMN].astype(np.int64) + start  # position in the whole source
+
+        if start == 0:
+            try:
+                chunk.iloc[:0].to_parquet(tmp_dir / 'empty.parquet')  # columns and CRS of a window with no records
+            except ImportError:  # pyarrow not available, read_window reads from the source instead
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                return None
+
+        bounds = chunk.bounds
+        tx = np.floor(bounds['minx'].values / TILE_SIZE).astype(np.int64)
+        ty = np.floor(bounds['miny'].values / TILE_SIZE).astype(np.int64)
+        for (x, y), rows in pd.Series(np.arange(len(chunk))).groupby([tx, ty]).indices.items():
+            part = parts.get((x, y), 0)
+            chunk.iloc[rows].to_parquet(tmp_dir / '{}_{}.{}.part'.format(x, y, part))
+            parts[(x, y)] = part + 1
+        if len(chunk):
+            margin = [max(margin[0], float((bounds['maxx'] - bounds['minx']).max())),
+                      max(margin[1], float((bounds['maxy'] - bounds['miny']).max()))]
+
+        start += TILE_CHUNK_ROWS
+        if len(chunk) < TILE_CHUNK_ROWS:
+            break
+        del chunk, bounds  # freed before the next piece is read
+
+    # join the pieces of each tile, one tile at a time
+    tiles = []
+    for (x, y), count in parts.items():
+        piece_paths = [tmp_dir / '{}_{}.{}.part'.format(x, y, part) for part in range(count)]
+        tile_path = tmp_dir / '{}_{}.parquet'.format(x, y)
+        if count == 1:
+            os.replace(piece_paths[0], tile_path)
+        else:
+            concat_records([gpd.read_parquet(piece) for piece in piece_paths]).to_parquet(tile_path)
+            for piece in piece_paths:
+                piece.unlink()
+        tiles.append([int(x), int(y)])
+
+    meta = {'source': str(filepath), 'signature': signature, 'hash': source_hash(filepath), 'columns': columns,
+            'sort_years': sort_years, 'version': LAYER_VERSION, 'tile_size': TILE_SIZE, 'tiles': tiles,
+            'margin': margin}
+    (tmp_dir / 'index.json').write_text(json.dumps(meta))
+
+    shutil.rmtree(tile_dir, ignore_errors=True)
+    try:
+        os.replace(tmp_dir, tile_dir)
+    except OSError:  # another process has just replaced the tiles, use those
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    meta['folder'] = str(tile_dir)
+    return meta
+
+
+def read_window(filepath, bounds, tiles=None, columns=None, sort_years=False):
+    """
+    Reads the records of a layer near a search area, for on demand searches of datasets too large to hold in
+    memory. Only the tiles of the on demand copy (see tile_layer) overlapping the bounds are read, so the time taken
+    depends on the number of records near the search area rather than the size of the layer. Without tiles (pyarrow
+    not installed) the bounds are passed to the reader as a bbox filter, which uses the file's own spatial index
+    where it has one (a GeoPackage, or a shapefile with a .qix or .sbn index).
+
+    Parameters:
+        filepath: the filepath to the layer (SHP, TAB or GPKG)
+
+        bounds: (xmin, ymin, xmax, ymax) of the search area, including the search radius
+
+        tiles: tile index of the layer, from tile_layer
+
+        columns: list of the columns to keep, all columns are kept if None
+
+        sort_years: sort the records by year, see compact_layer
+
+    Returns:
+        layer: Geodataframe of the records whose bounds may overlap the search area, in the same order as the layer
+    """
+
+    xmin, ymin, xmax, ymax = bounds
+    if tiles is None:
+        return compact_layer(read_source(filepath, columns, bbox=(xmin - 1, ymin - 1, xmax + 1, ymax + 1)),
+                             columns, sort_years)
+
+    # records belong to the tile of their south west corner, so records starting up to the largest record size
+    # outside the bounds are also read (plus 1m, matching the squares touching the bounds in grid_query)
+    size = tiles['tile_size']
+    x0, x1 = np.floor((xmin - tiles['margin'][0] - 1) / size), np.floor((xmax + 1) / size)
+    y0, y1 = np.floor((ymin - tiles['margin'][1] - 1) / size), np.floor((ymax + 1) / size)
+
+    tile_dir = Path(tiles['folder'])
+    frames = [gpd.read_parquet(tile_dir / '{}_{}.parquet'.format(x, y)) for x, y in tiles['tiles']
+              if x0 <= x <= x1 and y0 <= y <= y1]
+    if not frames:
+        return gpd.read_parquet(tile_dir / 'empty.parquet')
+
+    # the tiles were written a piece of the source at a time, so the window is put back in source order (and then
+    # by year, as the whole layer would be)
+    layer = source_order(concat_records(frames))
+    if sort_years and 'Year' in layer.columns:
+        layer = layer.sort_values('Year', kind='mergesort', na_position='last')
+
+    return layer.reset_index(drop=True)
+
+
+def build_index(layer):
+    """
+    Builds the spatial index (STRtree) for a search layer. Geopandas caches the index on the GeoDataFrame once it
+    has been created, so building it when the layer is loaded means every later search reuses the same index rather
+    than scanning the whole layer.
+
+    Parameters:
+        layer: Geodataframe of a search layer
+
+    Returns:
+        layer: the same Geodataframe, with its spatial index built
+
+    """
+
+    layer.sindex  # accessing sindex builds the STRtree and stores it on the layer
+    return layer
+
+
+def year_slice(layer, years=None):
+    """
+    Returns the range of row positions of the records of a layer within a range of years. The record layers are
+    sorted by year when they are loaded (see compact_layer), so the range is found by binary search of the Year
+    column rather than by testing every record. Records without a year are outside any range.
+
+    Parameters:
+        layer: Geodataframe of a search layer, sorted by year
+
+        years: (first year, last year) of the range, either can be None for no limit. None for all the records
+
+    Returns:
+        rows: (start, stop) row positions of the records within the range
+    """
+
+    if years is None or 'Year' not in layer.columns:
+        return 0, len(layer)
+
+    first, last = years
+    year = layer['Year'].values
+    start = 0 if first is None else int(np.searchsorted(year, first, side='left'))
+    stop = int(np.searchsorted(year, np.inf if last is None else last, side='right'))  # missing years sort last
+
+    return start, stop
+
+
+def in_rows(positions, rows):
+    """
+    Returns the sorted row positions which are within a range of rows (e.g. from year_slice), by binary search.
+
+    Parameters:
+        positions: sorted numpy array of row positions
+
+        rows: (start, stop) row positions, or None for all the rows
+
+    Returns:
+        positions: the row positions within the range
+    """
+
+    if rows is None:
+        return positions
+
+    return positions[np.searchsorted(positions, rows[0]):np.searchsorted(positions, rows[1])]
+
+
+def spatial_query(layer, search_geom, rows=None):
+    """
+    Returns the records of an indexed layer which intersect the search geometry. The spatial index is used to find
+    the records whose bounding box overlaps the search geometry, the exact intersects test is then only run on these
+    candidates.
+
+    Parameters:
+        layer: Geodataframe of a search layer, indexed using build_index
+
+        search_geom: Shapely geometry to search with, e.g. the buffer from searcharea_frompoint or searcharea_frompoly
+
+        rows: optional (start, stop) range of row positions to search, e.g. the records of a range of years from
+        year_slice. Records outside the range are never tested against the search geometry
+
+    Returns:
+        layer_search: Geodataframe of the records intersecting the search geometry, in the same order as the layer
+
+    """
+
+    return layer.iloc[query_positions(layer, search_geom, rows)]
+
+
+def query_positions(layer, search_geom, rows=None):
+    """
+    Returns the row positions of the records of an indexed layer which intersect the search geometry, using the
+    spatial index to find candidates and then the exact intersects test on the candidates only.
+
+    Parameters:
+        layer: Geodataframe of a search layer, indexed using build_index
+
+        search_geom: Shapely geometry to search with
+
+        rows: optional (start, stop) range of row positions to search, see spatial_query
+
+    Returns:
+        positions: sorted numpy array of the row positions of the intersecting records
+    """
+
+    candidates = np.sort(layer.sindex.query(search_geom))  # bbox query, sorted to keep the original row order
+    candidates = in_rows(candidates, rows)
+    matches = layer.geometry.iloc[candidates].intersects(search_geom).values  # exact test on the candidates only
+
+    return candidates[matches]
+
+
+def build_grid_index(layer):
+    """
+    Builds an index of a 1km precision record layer keyed by the 1km grid square of each record, i.e.
+    (easting // 1000, northing // 1000) of the south west corner of the square. A record is taken to be a grid
+    square when its bounds are on the 1km grid lines (within GRID_TOLERANCE, as squares digitised or reprojected
+    from other data are rarely exact) and its area is close to 1km2. Records whose geometry is not a single 1km grid
+    square are kept separately (with their own spatial index) and searched in the usual way.
+
+    Parameters:
+        layer: Geodataframe of 1km square records
+
+    Returns:
+        grid_index: dictionary with
+            squares: dictionary of grid square key (kx * GRID_KEY + ky): array of row positions in the square
+            other: array of row positions of the records which are not 1km squares
+            other_layer: indexed Geodataframe of the records which are not 1km squares
+        or None if fewer than GRID_MIN_SQUARES of the records are 1km squares, the layer is then searched with its
+        spatial index rather than holding a second copy of most of it
+    """
+
+    bounds = layer.bounds
+    kx = np.round(bounds['minx'].values / 1000)  # grid square of the south west corner
+    ky = np.round(bounds['miny'].values / 1000)
+
+    # Only records which are one whole 1km grid square can be matched by grid square
+    is_square = ((np.abs(bounds['minx'].values - kx * 1000) <= GRID_TOLERANCE)
+                 & (np.abs(bounds['miny'].values - ky * 1000) <= GRID_TOLERANCE)
+                 & (np.abs(bounds['maxx'].values - (kx + 1) * 1000) <= GRID_TOLERANCE)
+                 & (np.abs(bounds['maxy'].values - (ky + 1) * 1000) <= GRID_TOLERANCE)
+                 & (np.abs(layer.geometry.area.values / 1e6 - 1) <= GRID_AREA_TOLERANCE))
+
+    if len(layer) and is_square.mean() < GRID_MIN_SQUARES:
+        return None
+
+    positions = np.arange(len(layer))
+    keys = (kx * GRID_KEY + ky)[is_square].astype(np.int64)
+    squares = pd.Series(positions[is_square]).groupby(keys).indices
+    squares = {key: positions[is_square][rows] for key, rows in squares.items()}
+
+    other = positions[~is_square]
+    grid_index = {'squares': squares, 'other': other, 'other_layer': build_index(layer.iloc[other])}
+
+    return grid_index
+
+
+def point_coords(layer):
+    """
+    Returns the coordinate arrays of a point layer, used for exact circular searches.
+
+    Parameters:
+        layer: Geodataframe of a search layer
+
+    Returns:
+        coords: tuple of (x, y) numpy arrays, or None if the layer is not made up of points
+    """
+
+    if len(layer) == 0 or not (layer.geom_type == 'Point').all():
+        return None
+
+    return layer.geometry.x.values, layer.geometry.y.values
+
+
+def circle_query(layer, centre, radius, coords=None, rows=None):
+    """
+    Returns the records of an indexed layer within the search radius of a point, exactly at the radius rather than
+    using a buffer polygon. The spatial index finds the records within the bounding box of the circle, for point
+    layers the candidates are then tested with a squared distance test on the coordinate arrays, for other layers
+    the geometric distance to the point is tested.
+
+    Parameters:
+        layer: Geodataframe of a search layer, indexed using build_index
+
+        centre: Shapely Point of the search point
+
+        radius: search radius in metres
+
+        coords: (x, y) coordinate arrays of the layer from point_coords, if the layer is made up of points
+
+        rows: optional (start, stop) range of row positions to search, see spatial_query
+
+    Returns:
+        layer_search: Geodataframe of the records within the radius, in the same order as the layer
+    """
+
+    return layer.iloc[circle_positions(layer, centre, radius, coords, rows)]
+
+
+def circle_positions(layer, centre, radius, coords=None, rows=None):
+    """
+    Returns the row positions of the records of an indexed layer within the search radius of a point, see
+    circle_query.
+
+    Returns:
+        positions: sorted numpy array of the row positions of the records within the radius
+    """
+
+    cx, cy = centre.x, centre.y
+    candidates = np.sort(layer.sindex.query(box(cx - radius, cy - radius, cx + radius, cy + radius)))
+    candidates = in_rows(candidates, rows)
+
+    if coords is not None:
+        dx = coords[0][candidates] - cx
+        dy = coords[1][candidates] - cy
+        matches = dx * dx + dy * dy <= radius * radius
+    else:
+        matches = layer.geometry.iloc[candidates].distance(centre).values <= radius
+
+    return candidates[matches]
+
+
+def grid_circle_query(layer, grid_index, centre, radius, rows=None):
+    """
+    Returns the records of a 1km precision record layer within the search radius of a point, using the grid index
+    from build_grid_index. The distance from the point to each 1km square touched is worked out arithmetically
+    from the square's corner coordinates, so no geometry is tested for the squares.
+
+    Parameters:
+        layer: Geodataframe of 1km square records
+
+        grid_index: grid index of the layer, from build_grid_index
+
+        centre: Shapely Point of the search point
+
+        radius: search radius in metres
+
+        rows: optional (start, stop) range of row positions to search, see spatial_query
+
+    Returns:
+        layer_search: Geodataframe of the records within the radius, in the same order as the layer
+    """
+
+    cx, cy = centre.x, centre.y
+    squares = grid_index['squares']
+
+    matches = []
+    for kx in range(int(np.floor((cx - radius) / 1000)) - 1, int(np.floor((cx + radius) / 1000)) + 1):
+        # distance along x from the point to the square (0 if the point is within the square's columns)
+        dx = max(kx * 1000 - cx, 0, cx - (kx + 1) * 1000)
+        for ky in range(int(np.floor((cy - radius) / 1000)) - 1, int(np.floor((cy + radius) / 1000)) + 1):
+            square = squares.get(kx * GRID_KEY + ky)
+            dy = max(ky * 1000 - cy, 0, cy - (ky + 1) * 1000)
+            if square is not None and dx * dx + dy * dy <= radius * radius:
+                matches.append(in_rows(square, rows))
+
+    # records which are not 1km squares are searched using their spatial index
+    if len(grid_index['other']):
+        matches.append(in_rows(grid_index['other'][circle_positions(grid_index['other_layer'], centre, radius)], rows))
+
+    positions = np.sort(np.concatenate(matches)) if matches else np.array([], dtype=np.int64)
+
+    return layer.iloc[positions]
+
+
+def interior_spans(geom, y):
+    """
+    Returns the spans of a horizontal line within a geometry, used to find the grid squares inside a search area.
+
+    Parameters:
+        geom: Shapely polygon or multipolygon, may be empty
+
+        y: northing of the line
+
+    Returns:
+        spans: list of (x start, x end) of the parts of the line within the geometry
+    """
+
+    if geom.is_empty:
+        return []
+
+    xmin, ymin, xmax, ymax = geom.bounds
+    if not ymin <= y <= ymax:
+        return []
+
+    crossing = geom.intersection(LineString([(xmin - 1, y), (xmax + 1, y)]))
+    # a single line, or several (with a point where the line only touches the geometry)
+    parts = crossing.geoms if crossing.geom_type.startswith('Multi') or crossing.geom_type == 'GeometryCollection' \
+        else [crossing]
+
+    return [(part.bounds[0], part.bounds[2]) for part in parts if not part.is_empty]
+
+
+def grid_query(layer, grid_index, search_geom, rows=None):
+    """
+    Returns the records of a 1km precision record layer which intersect the search geometry, using the grid index
+    from build_grid_index. The grid squares touched by the bounds of the search geometry are worked out
+    arithmetically and looked up in the index, so the cost depends on the number of squares touched rather than the
+    number of records. Squares well inside the search geometry are accepted without a geometry test: the search
+    geometry is shrunk once by the distance from the centre of a square to its corners, and each row of squares is
+    crossed with the shrunk geometry once, so the squares whose centre lies on the crossing are inside. Only the
+    remaining squares with records, along the edge of the search geometry, are tested against it, once per square,
+    which is exact (to within GRID_TOLERANCE) for all the records in the square as their geometry is the square.
+
+    Parameters:
+        layer: Geodataframe of 1km square records
+
+        grid_index: grid index of the layer, from build_grid_index
+
+        search_geom: Shapely geometry to search with
+
+        rows: optional (start, stop) range of row positions to search, see spatial_query. Squares with no records in
+        the range are not tested
+
+    Returns:
+        layer_search: Geodataframe of the records intersecting the search geometry, in the same order as the layer
+    """
+
+    xmin, ymin, xmax, ymax = search_geom.bounds
+    prepared = prep(search_geom)  # prepared geometry for repeated intersects tests
+    squares = grid_index['squares']
+    # a square whose centre is within the shrunk geometry is entirely within the search geometry
+    inner = search_geom.buffer(-(500 + GRID_TOLERANCE) * np.sqrt(2))
+
+    matches = []
+    # squares touching the bounds, including squares whose edge lies on the bounds
+    for ky in range(int(np.floor(ymin / 1000)) - 1, int(np.floor(ymax / 1000)) + 1):
+        inside = interior_spans(inner, (ky + 0.5) * 1000)
+        for kx in range(int(np.floor(xmin / 1000)) - 1, int(np.floor(xmax / 1000)) + 1):
+            square = in_rows(squares.get(kx * GRID_KEY + ky, []), rows)
+            if not len(square):
+                continue
+            cx = (kx + 0.5) * 1000
+            if (any(x0 <= cx <= x1 for x0, x1 in inside)
+                    or prepared.intersects(box(kx * 1000, ky * 1000, (kx + 1) * 1000, (ky + 1) * 1000))):
+                matches.append(square)
+
+    # records which are not 1km squares are searched using their spatial index
+    if len(grid_index['other']):
+        matches.append(in_rows(grid_index['other'][query_positions(grid_index['other_layer'], search_geom)], rows))
+
+    positions = np.sort(np.concatenate(matches)) if matches else np.array([], dtype=np.int64)
+
+    return layer.iloc[positions]
+
+
+def selected_searches(values):
+    """
+    Returns the search types ticked in the GUI.
+
+    Parameters:
+        values: dictionary of GUI values returned by window.read()
+
+    Returns:
+        searches: list of search types (values of SEARCH_TYPES)
+    """
+
+    return [search for key, search in SEARCH_TYPES.items() if values.get(key)]
+
+
+def selected_layers(searches):
+    """
+    Returns the names of the layers needed for a list of search types.
+
+    Parameters:
+        searches: list of search types (keys of SEARCH_LAYERS)
+
+    Returns:
+        names: list of layer names (keys of LAYER_FILES), without duplicates
+    """
+
+    names = []
+    for search in searches:
+        names += [name for name in SEARCH_LAYERS[search] if name not in names]
+
+    return names
+
+
+class LayerStore:
+    """
+    Loads the master layers as they are needed on a background thread. Layers are only loaded once requested, so
+    an enquiry only pays to load the layers for the search types selected. Each layer is loaded (and indexed) once
+    and then kept for later enquiries. The 1km precision layers (GRID_LAYERS) are also given a grid square index.
+
+    For datasets too large to hold in memory (e.g. national records) the store can instead read only the records
+    near each search area (on_demand). Each layer is then tiled once (see tile_layer) and every query reads just the
+    tiles around the search area (see read_window), so nothing is kept in memory between enquiries.
+
+    If a result cache is given, the records found by each query are cached, and a query already in the cache is
+    answered from the cache without searching (or loading) the layer.
+
+    Parameters:
+        layer_files: dictionary of layer name: filepath, defaults to LAYER_FILES
+
+        result_cache: optional ResultCache of query results
+
+        cache_dir: folder to hold the cached copies of the layers, see load_layer
+
+        on_demand: read only the records near each search area rather than loading the whole of each layer
+    """
+
+    def __init__(self, layer_files=None, result_cache=None, cache_dir=CACHE_DIR, on_demand=False):
+        self.layer_files = dict(LAYER_FILES if layer_files is None else layer_files)
+        self.cache_dir = cache_dir
+        self.result_cache = result_cache
+        self.on_demand = on_demand
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='layerloader')  # background loader
+        self._futures = {}  # layer name: Future of the loaded layer
+        self._tiles = {}  # layer name: Future of the tile index of the layer, for on demand searches
+        self._grid_indexes = {}  # layer name: grid index of the 1km precision layers
+        self._coords = {}  # layer name: coordinate arrays of the point layers
+        self._versions = {}  # layer name: source signature of the layer when it was requested
+        self._lock = threading.Lock()
+
+    def _load(self, name):
+        layer = build_index(load_layer(self.layer_files[name], self.cache_dir, LAYER_COLUMNS.get(name),
+                                       name in DATED_LAYERS))
+        if name in GRID_LAYERS:
+            self._grid_indexes[name] = build_grid_index(layer)
+        self._coords[name] = point_coords(layer)
+        return layer
+
+    def _tile(self, name):
+        return tile_layer(self.layer_files[name], self.cache_dir, LAYER_COLUMNS.get(name), name in DATED_LAYERS)
+
+    def _start(self, futures, task, name):
+        # Starts a loading task for a layer on the background thread, unless it is already started (lock held)
+        if name not in futures:
+            self._versions[name] = source_signature(self.layer_files[name])
+            futures[name] = self._executor.submit(task, name)
+
+    def submit(self, func, *args):
+        """
+        Runs another loading task (e.g. the basemap) on the background loading thread.
+
+        Returns:
+            future: Future of the task result
+        """
+
+        return self._executor.submit(func, *args)
+
+    def request(self, names):
+        """
+        Starts loading the named layers in the background, if they are not already loaded or loading. When
+        searching on demand the layers are tiled instead, if they have not been already.
+
+        Parameters:
+            names: list of layer names (keys of layer_files)
+        """
+
+        with self._lock:
+            for name in names:
+                if self.on_demand:
+                    self._start(self._tiles, self._tile, name)
+                else:
+                    self._start(self._futures, self._load, name)
+
+    def get(self, name):
+        """
+        Returns a loaded layer, waiting for it to finish loading if needed.
+
+        Parameters:
+            name: layer name (key of layer_files)
+
+        Returns:
+            layer: indexed Geodataframe of the layer
+        """
+
+        with self._lock:
+            self._start(self._futures, self._load, name)
+        return self._futures[name].result()
+
+    def _layer(self, name, bounds):
+        # Returns the indexed layer, its grid index (1km precision layers) and its point coordinates. When searching
+        # on demand only the records near the bounds are read, and indexed for this query only.
+        if not self.on_demand:
+            layer = self.get(name)
+            return layer, self._grid_indexes.get(name), self._coords.get(name)
+
+        self.request([name])
+        tiles = self._tiles[name].result()
+        layer = build_index(read_window(self.layer_files[name], bounds, tiles, LAYER_COLUMNS.get(name),
+                                        name in DATED_LAYERS))
+        grid_index = build_grid_index(layer) if name in GRID_LAYERS else None
+
+        return layer, grid_index, point_coords(layer)
+
+    def query(self, name, search_geom, years=None):
+        """
+        Returns the records of a layer which intersect the search geometry, using the grid square index for the
+        1km precision layers and the spatial index for the other layers.
+
+        Parameters:
+            name: layer name (key of layer_files)
+
+            search_geom: Shapely geometry to search with
+
+            years: optional (first year, last year) of the records to search, for the DATED_LAYERS. Records outside
+            the range are dropped before the spatial search (see year_slice)
+
+        Returns:
+            layer_search: Geodataframe of the records intersecting the search geometry, in the same order as the
+            source layer (see source_order)
+        """
+
+        return self._cached(name, search_geom, None, self._years(name, years), self._query)
+
+    def _query(self, name, search_geom, radius, years):
+        layer, grid_index, coords = self._layer(name, search_geom.bounds)
+        rows = None if years is None else year_slice(layer, years)
+        if grid_index is not None:
+            return source_order(grid_query(layer, grid_index, search_geom, rows))
+
+        return source_order(spatial_query(layer, search_geom, rows))
+
+    def query_circle(self, name, centre, radius, years=None):
+        """
+        Returns the records of a layer within the search radius of a point, exact at the radius (see circle_query).
+        Point layers are tested with their coordinate arrays, the 1km precision layers with grid square arithmetic
+        and the other layers (e.g. sites) with a geometric distance test.
+
+        Parameters:
+            name: layer name (key of layer_files)
+
+            centre: Shapely Point of the search point
+
+            radius: search radius in metres
+
+            years: optional (first year, last year) of the records to search, see query
+
+        Returns:
+            layer_search: Geodataframe of the records within the radius, in the same order as the source layer
+        """
+
+        return self._cached(name, centre, radius, self._years(name, years), self._query_circle)
+
+    def _query_circle(self, name, centre, radius, years):
+        layer, grid_index, coords = self._layer(name, (centre.x - radius, centre.y - radius, centre.x + radius,
+                                                      centre.y + radius))
+        rows = None if years is None else year_slice(layer, years)
+        if grid_index is not None:
+            return source_order(grid_circle_query(layer, grid_index, centre, radius, rows))
+
+        return source_order(circle_query(layer, centre, radius, coords=coords, rows=rows))
+
+    @staticmethod
+    def _years(name, years):
+        # only the record layers are limited by year, the sites are always searched in full
+        if name not in DATED_LAYERS or years is None or years == (None, None):
+            return None
+        return tuple(years)
+
+    def _cached(self, name, search_geom, radius, years, query):
+        # Runs a query, or returns its records from the result cache. The key includes the version of the layer
+        # loaded, so results from an earlier version of the source are never used.
+        if self.result_cache is None:
+            return query(name, search_geom, radius, years)
+
+        with self._lock:
+            if name not in self._versions:
+                self._versions[name] = source_signature(self.layer_files[name])
+            version = self._versions[name]
+
+        # results held before the layer's columns (or the way layers are compacted) were changed are not used either
+        key = self.result_cache.key(name, [version, LAYER_COLUMNS.get(name), LAYER_VERSION, years], search_geom,
+                                    radius)
+        records = self.result_cache.get(key)
+        if records is None:
+            records = query(name, search_geom, radius, years)
+            self.result_cache.put(key, records)
+
+        return records
+
+    def is_loaded(self, name):
+        """
+        Returns True if the named layer has finished loading (or tiling, when searching on demand).
+        """
+
+        futures = self._tiles if self.on_demand else self._futures
+        return name in futures and futures[name].done()
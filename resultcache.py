@@ -0,0 +1,125 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import geopandas as gpd
+
+
+# Folder used to hold the cached search results
+RESULT_CACHE_DIR = Path('output/cache/results')
+
+# Total size of the cached search results, the least recently used results are removed above this size
+RESULT_CACHE_BYTES = 500 * 1024 * 1024
+
+
+class ResultCache:
+    """
+    On-disk cache of the records found by each layer search, so rerunning a site (e.g. for another search type or
+    map) does not repeat the spatial search. Each result is keyed by a hash of the search geometry, the search
+    radius, the layer and the version of the layer's source files, so a change to a source layer invalidates its
+    results. Results are kept as GeoParquet files and the least recently used are removed once the cache is larger
+    than max_bytes.
+
+    If pyarrow is not installed nothing is cached.
+
+    Parameters:
+        cache_dir: folder to hold the cached results
+
+        max_bytes: size limit of the cache in bytes
+    """
+
+    def __init__(self, cache_dir=RESULT_CACHE_DIR, max_bytes=RESULT_CACHE_BYTES):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+
+    def key(self, name, version, search_geom, radius=None):
+        """
+        Returns the cache key of a layer search.
+
+        Parameters:
+            name: layer name
+
+            version: version of the layer's source files, e.g. its source_signature
+
+            search_geom: Shapely geometry searched with, the search buffer or the search point of a circular search
+
+            radius: search radius of a circular search
+
+        Returns:
+            key: hex string of the key
+        """
+
+        sha = hashlib.sha256()
+        sha.update(json.dumps([name, version, radius], sort_keys=True).encode())
+        if hasattr(search_geom, 'normalize'):  # shapely 1.8+, same key for the same geometry in any vertex order
+            search_geom = search_geom.normalize()
+        sha.update(search_geom.wkb)
+
+        return name + '_' + sha.hexdigest()
+
+    def get(self, key):
+        """
+        Returns the cached records of a layer search, or None if the search is not cached.
+
+        Parameters:
+            key: cache key, from key
+
+        Returns:
+            records: Geodataframe of the records found, or None
+        """
+
+        path = self.cache_dir / (key + '.parquet')
+        try:
+            records = gpd.read_parquet(path)
+            os.utime(path)  # mark as recently used
+        except (OSError, ImportError):  # not cached, removed by another process, or pyarrow not available
+            return None
+
+        return records
+
+    def put(self, key, records):
+        """
+        Adds the records of a layer search to the cache, then removes the least recently used results if the cache
+        is over its size limit.
+
+        Parameters:
+            key: cache key, from key
+
+            records: Geodataframe of the records found
+        """
+
+        path = self.cache_dir / (key + '.parquet')
+        # Write to a temporary file first and then replace, so other processes never read a partly written result
+        tmp_path = path.with_suffix('.{}.tmp'.format(os.getpid()))
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            records.to_parquet(tmp_path)
+        except ImportError:  # pyarrow not available, do not cache
+            return
+        os.replace(tmp_path, path)
+
+        self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used results until the cache is no larger than max_bytes.
+        """
+
+        entries = []
+        for path in self.cache_dir.glob('*.parquet'):
+            try:
+                stat = path.stat()
+            except OSError:  # removed by another process
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, path))
+
+        total = sum(size for mtime, size, path in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                path.unlink()
+            except OSError:
+                pass
+            total -= size
@@ -0,0 +1,336 @@
+"""
+Local search service.
+
+Keeps the search layers and basemap loaded and runs data search enquiries sent to it over HTTP, so the load cost
+is paid once when the service starts rather than by every GUI session, and several users (or several GUIs, see
+SERVICE_URL in the GUI script) share one warm copy of the layers. Enquiries run on a pool of worker processes, each
+of which loads the layers once and keeps them for every enquiry it runs (as the batch runner), so at most one
+enquiry per worker runs at a time and further enquiries wait for a free worker.
+
+Endpoints:
+    POST /enquiries
+        JSON enquiry with the keys used by run_enquiry: enqno, sitename, radius, searches, and easting and northing
+        -OR- gridref -OR- boundary, a GeoJSON FeatureCollection of the search area in British National Grid
+        (EPSG:27700) coordinates, and optionally format, map_format, map_dpi, per_feature, gridref_digits, exact,
+        year_from and year_to.
+        Returns a zip of the results and maps, or with ?output=json the list of files saved on the server.
+
+    GET /status
+        JSON of the number of workers and the enquiries running.
+
+Usage:
+    python search_service.py --workers 4 --port 8765
+"""
+import argparse
+import io
+import json
+import os
+import shutil
+import threading
+import uuid
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.error import HTTPError
+from urllib.parse import parse_qs, urlparse
+from urllib.request import Request, urlopen
+
+import matplotlib
+matplotlib.use('Agg')  # no GUI is used to draw the maps
+
+import geopandas as gpd
+from basemap import build_basemap
+from batch_enquiry import init_worker, prepare_enquiries, run_worker_enquiry
+from enquiry_log import LOG_PATH, EnquiryLogger
+from layers import DATED_LAYERS, LAYER_COLUMNS, LAYER_FILES, SEARCH_LAYERS, selected_layers, tile_layer
+
+
+# Address the service listens on, only local connections are accepted by default
+SERVICE_HOST = '127.0.0.1'
+SERVICE_PORT = 8765
+
+# Folder the outputs of each enquiry are saved in, one sub folder per enquiry
+SERVICE_DIR = Path('output/service')
+
+# Largest enquiry accepted, in bytes (most of this is the GeoJSON of a boundary)
+MAX_REQUEST_BYTES = 50 * 1024 * 1024
+
+
+class SearchService:
+    """
+    Runs enquiries on a pool of worker processes which keep the layers and basemap loaded, see init_worker.
+
+    Parameters:
+        workers: number of worker processes, i.e. the number of enquiries run at once, defaults to the number of CPUs
+
+        basemap_dir: folder containing the basemap tifs
+
+        outfolder: folder the outputs of each enquiry are saved in
+
+        log: optional EnquiryLogger to write the record of each enquiry to
+
+        profile_threshold: time in seconds above which an enquiry's profile is saved, see EnquiryLogger
+
+        on_demand: read only the records near each enquiry rather than loading the whole of each layer in every
+        worker, see LayerStore
+    """
+
+    def __init__(self, workers=None, basemap_dir='SampleData/basemaps/', outfolder=SERVICE_DIR, log=None,
+                 profile_threshold=None, on_demand=False):
+        self.workers = workers or os.cpu_count() or 1
+        self.outfolder = Path(outfolder)
+        self.log = log
+        self.running = {}  # output folder name: enquiry number, of each enquiry running or waiting for a worker
+        self._lock = threading.Lock()
+
+        basemap_path = build_basemap(basemap_dir)  # built once here so the workers do not all update it
+        layer_names = selected_layers(list(SEARCH_LAYERS))
+        if on_demand:  # tiled once here so the workers do not all tile the same layers
+            for name in layer_names:
+                tile_layer(LAYER_FILES[name], columns=LAYER_COLUMNS.get(name), sort_years=name in DATED_LAYERS)
+
+        self._initargs = (basemap_path, layer_names, profile_threshold, on_demand)
+        self._pool_lock = threading.Lock()
+        self.pool = self._new_pool()
+
+    def _new_pool(self):
+        return ProcessPoolExecutor(max_workers=self.workers, initializer=init_worker, initargs=self._initargs)
+
+    def _reset_pool(self, pool):
+        # Replaces a pool which can no longer be used (a worker process died, e.g. out of memory), unless another
+        # request has already replaced it
+        with self._pool_lock:
+            if self.pool is pool:
+                self.pool = self._new_pool()
+        pool.shutdown(wait=False)
+
+    def _submit(self, enquiry):
+        # Runs an enquiry on the pool, on a new pool if a worker dies, retrying the enquiry once
+        for _ in range(2):
+            pool = self.pool
+            try:
+                return pool.submit(run_worker_enquiry, enquiry).result()
+            except BrokenProcessPool:
+                self._reset_pool(pool)
+
+        raise RuntimeError('the worker running enquiry {} stopped unexpectedly'.format(enquiry['enqno']))
+
+    def run(self, enquiry):
+        """
+        Runs an enquiry on the next free worker, waiting for it to complete. The outputs are saved in a new folder
+        for the enquiry, a boundary sent with the enquiry is saved there as the enquiry's search area.
+
+        Parameters:
+            enquiry: dictionary of the enquiry, see the POST /enquiries endpoint
+
+        Returns:
+            folder: folder the outputs were saved in
+
+            outputs: list of the files saved
+
+        Raises:
+            ValueError: the enquiry is not valid, or the error raised by the enquiry
+
+            RuntimeError: the worker running the enquiry stopped (e.g. ran out of memory), on a second worker too
+        """
+
+        enquiry = dict(enquiry)
+        folder = self.outfolder / uuid.uuid4().hex
+        folder.mkdir(parents=True)
+        enquiry['outfolder'] = str(folder)  # clients cannot choose where files are saved on the server
+        enquiry['enqno'] = str(enquiry.get('enqno') or folder.name)
+        enquiry.pop('bdyfile', None)  # nor name files on the server to search with
+
+        with self._lock:
+            self.running[folder.name] = enquiry['enqno']
+        try:
+            boundary = enquiry.pop('boundary', None)
+            if boundary is not None:
+                try:
+                    userpoly = gpd.GeoDataFrame.from_features(boundary['features'], crs='EPSG:27700')
+                except (KeyError, TypeError, AttributeError, ValueError):
+                    raise ValueError('boundary must be a GeoJSON FeatureCollection')
+                enquiry['bdyfile'] = str(folder / 'boundary.gpkg')
+                userpoly.to_file(enquiry['bdyfile'], driver='GPKG')
+
+            enquiry = prepare_enquiries([enquiry])[0]
+            enqno, outputs, record = self._submit(enquiry)
+            if self.log is not None and record is not None:
+                self.log.write(record)
+            if isinstance(outputs, Exception):
+                raise outputs
+        except Exception:
+            shutil.rmtree(folder, ignore_errors=True)
+            raise
+        finally:
+            with self._lock:
+                self.running.pop(folder.name, None)
+
+        return folder, outputs
+
+    def status(self):
+        """
+        Returns the status of the service.
+
+        Returns:
+            status: dictionary of the number of workers and the enquiries running (or waiting for a worker)
+        """
+
+        with self._lock:
+            return {'workers': self.workers, 'running': sorted(self.running.values())}
+
+    def shutdown(self):
+        """
+        Stops the worker processes, once the enquiries running have completed.
+        """
+
+        self.pool.shutdown(wait=True)
+
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    """
+    Handles the HTTP requests of the search service, see the module docstring for the endpoints. Each request is
+    handled on its own thread, the enquiries themselves are limited by the service's worker pool.
+    """
+
+    service = None  # SearchService the requests are run on, set by serve
+
+    def do_GET(self):
+        if urlparse(self.path).path != '/status':
+            return self.send_json(404, {'error': 'not found'})
+
+        self.send_json(200, self.service.status())
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/enquiries':
+            return self.send_json(404, {'error': 'not found'})
+
+        length = int(self.headers.get('Content-Length') or 0)
+        if length > MAX_REQUEST_BYTES:
+            return self.send_json(413, {'error': 'enquiry larger than {} bytes'.format(MAX_REQUEST_BYTES)})
+        try:
+            enquiry = json.loads(self.rfile.read(length))
+            if not isinstance(enquiry, dict):
+                raise ValueError('enquiry must be a JSON object')
+        except ValueError as error:
+            return self.send_json(400, {'error': 'not a valid enquiry: ' + str(error)})
+
+        try:
+            folder, outputs = self.service.run(enquiry)
+        except ValueError as error:  # invalid enquiry details, e.g. an unknown search type or grid reference
+            return self.send_json(400, {'error': str(error)})
+        except Exception as error:  # report the error to the client rather than dropping the connection
+            return self.send_json(500, {'error': '{}: {}'.format(type(error).__name__, error)})
+
+        if parse_qs(url.query).get('output', ['zip'])[0] == 'json':
+            return self.send_json(200, {'outputs': outputs})
+
+        # Zip the results and maps in memory, the enquiry's folder is then no longer needed
+        data = io.BytesIO()
+        with zipfile.ZipFile(data, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for output in outputs:
+                archive.write(output, Path(output).name)
+        shutil.rmtree(folder, ignore_errors=True)
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/zip')
+        self.send_header('Content-Disposition', 'attachment; filename="{}.zip"'.format(Path(folder).name))
+        self.send_header('Content-Length', str(len(data.getvalue())))
+        self.end_headers()
+        self.wfile.write(data.getvalue())
+
+    def send_json(self, status, data):
+        body = json.dumps(data, default=str).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(service, host=SERVICE_HOST, port=SERVICE_PORT):
+    """
+    Serves enquiries to the search service until interrupted (Ctrl+C).
+
+    Parameters:
+        service: SearchService to run the enquiries on
+
+        host: address to listen on
+
+        port: port to listen on
+    """
+
+    ServiceHandler.service = service
+    server = ThreadingHTTPServer((host, port), ServiceHandler)
+    print('Search service listening on http://{}:{}'.format(host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.shutdown()
+
+
+def submit_enquiry(url, enquiry, timeout=None):
+    """
+    Sends an enquiry to a running search service and saves the results and maps it returns in the enquiry's output
+    folder, e.g. so the GUI can act as a thin client of a shared service. A bdyfile is read here and sent to the
+    service as GeoJSON.
+
+    Parameters:
+        url: address of the service, e.g. 'http://127.0.0.1:8765'
+
+        enquiry: dictionary of the enquiry details, see run_enquiry
+
+        timeout: optional time in seconds to wait for the enquiry
+
+    Returns:
+        outputs: list of the files saved
+    """
+
+    payload = {key: value for key, value in enquiry.items() if key not in ['outfolder', 'bdyfile']}
+    if enquiry.get('bdyfile'):
+        userpoly = gpd.read_file(enquiry['bdyfile'])
+        if userpoly.crs is not None:
+            userpoly = userpoly.to_crs('EPSG:27700')
+        payload['boundary'] = json.loads(userpoly.to_json())
+
+    request = Request(url.rstrip('/') + '/enquiries', data=json.dumps(payload, default=str).encode(),
+                      headers={'Content-Type': 'application/json'})
+    try:
+        with urlopen(request, timeout=timeout) as response:
+            data = response.read()
+    except HTTPError as error:  # pass the service's error message on
+        try:
+            message = json.loads(error.read())['error']
+        except (ValueError, KeyError):
+            message = str(error)
+        raise ValueError(message) if error.code == 400 else RuntimeError(message)
+
+    outfolder = Path(enquiry['outfolder'])
+    outfolder.mkdir(parents=True, exist_ok=True)
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        archive.extractall(outfolder)
+        return [str(outfolder / name) for name in archive.namelist()]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a local data search service.')
+    parser.add_argument('--host', default=SERVICE_HOST, help='address to listen on')
+    parser.add_argument('--port', type=int, default=SERVICE_PORT, help='port to listen on')
+    parser.add_argument('--workers', type=int, default=None, help='number of enquiries run at once')
+    parser.add_argument('--outfolder', default=str(SERVICE_DIR), help='folder the enquiry outputs are saved in')
+    parser.add_argument('--log', default=str(LOG_PATH), help='log file of the time and memory use of each enquiry')
+    parser.add_argument('--profile-threshold', type=float, default=None,
+                        help='save a cProfile profile of enquiries taking longer than this many seconds')
+    parser.add_argument('--on-demand', action='store_true',
+                        help='read only the records near each enquiry, for layers too large to hold in memory')
+    args = parser.parse_args()
+
+    serve(SearchService(workers=args.workers, outfolder=args.outfolder, log=EnquiryLogger(args.log),
+                        profile_threshold=args.profile_threshold, on_demand=args.on_demand),
+          host=args.host, port=args.port)
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# The tool's modules sit at the top of the repository rather than in a package
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
@@ -0,0 +1,42 @@
+import enquiry_log
+from enquiry_log import MemorySampler, StageTimer
+
+
+def fake_memory(monkeypatch, rss, peak=None):
+    # resident memory reported to the sampler, changed by the test rather than by allocating memory
+    memory = {'rss': rss, 'peak': peak}
+    monkeypatch.setattr(enquiry_log, 'memory_usage', lambda: (memory['rss'], memory['peak']))
+    return memory
+
+
+def test_memory_sampler_keeps_peak(monkeypatch):
+    memory = fake_memory(monkeypatch, 100)
+    sampler = MemorySampler(interval=3600)  # sampled by hand below
+
+    memory['rss'] = 300
+    sampler._sample()
+    memory['rss'] = 150
+
+    assert sampler.stop() == 300
+
+
+def test_memory_sampler_without_memory(monkeypatch):
+    fake_memory(monkeypatch, None)
+
+    assert MemorySampler(interval=3600).stop() is None
+
+
+def test_stage_peak_is_per_stage(monkeypatch):
+    memory = fake_memory(monkeypatch, 100, peak=100)
+    timer = StageTimer()
+
+    with timer.stage('allocate'):
+        memory.update(rss=400, peak=400)
+    memory['rss'] = 120
+    with timer.stage('idle'):
+        pass
+
+    allocate, idle = timer.stages
+    assert (allocate['rss_mb'], allocate['peak_rss_mb'], allocate['process_peak_rss_mb']) == (400, 400, 400)
+    # the process peak stays high, the peak of a later stage does not
+    assert (idle['rss_mb'], idle['peak_rss_mb'], idle['process_peak_rss_mb']) == (120, 120, 400)
@@ -0,0 +1,91 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+pd = pytest.importorskip('pandas')
+
+from gridref import GRID_DIGITS, gridref_to_osgb36, osgb36_to_gridref, regenerate_gridrefs  # noqa: E402
+
+
+@pytest.mark.parametrize('gridref, easting, northing', [
+    ('SV0000', 0, 0),
+    ('SJ8765', 387000, 365000),
+    ('HP0000', 400000, 1200000),
+    ('TG0000', 600000, 300000),
+])
+def test_gridref_letters(gridref, easting, northing):
+    e, n, errors = gridref_to_osgb36(gridref)
+
+    assert e.tolist() == [easting]
+    assert n.tolist() == [northing]
+    assert errors.tolist() == [None]
+
+
+def test_gridref_precisions():
+    refs = ['SJ86', 'SJ8765', 'SJ876654', 'SJ87656543', 'SJ8765465432', 'sj 87654 65432']
+
+    e, n, errors = gridref_to_osgb36(refs)
+
+    assert e.tolist() == [380000, 387000, 387600, 387650, 387654, 387654]
+    assert n.tolist() == [360000, 365000, 365400, 365430, 365432, 365432]
+    assert errors.tolist() == [None] * len(refs)
+
+
+def test_gridref_centre():
+    e, n, errors = gridref_to_osgb36(['SJ8765', 'SJ8765465432'], centre=True)
+
+    assert e.tolist() == [387500, 387654.5]
+    assert n.tolist() == [365500, 365432.5]
+
+
+def test_gridref_errors_per_row():
+    refs = ['SJ876', 'SI8765', 'SJ87a5', 'SJ', 'ZZ1234', 'SJ8765']
+
+    e, n, errors = gridref_to_osgb36(refs)
+
+    assert errors.tolist() == ['grid reference must have an even number of digits',
+                               'grid reference must start with two grid letters',
+                               'grid reference digits must be numbers',
+                               'grid reference must have between 2 and 10 digits',
+                               'grid letters are outside the National Grid',
+                               None]
+    assert np.isnan(e[:-1]).all() and np.isnan(n[:-1]).all()
+    assert (e[-1], n[-1]) == (387000, 365000)
+
+
+def test_osgb36_to_gridref():
+    assert osgb36_to_gridref(387654, 365432, 4).tolist() == ['SJ8765']
+    assert osgb36_to_gridref(387654, 365432).tolist() == ['SJ8765465432']
+    assert osgb36_to_gridref([-1, 387654], [0, 1400000], 4).tolist() == ['', '']
+
+    with pytest.raises(ValueError):
+        osgb36_to_gridref(387654, 365432, 3)
+
+
+@pytest.mark.parametrize('digits', GRID_DIGITS)
+def test_gridref_round_trip(digits):
+    easting = np.array([0, 387654, 651234, 465432])
+    northing = np.array([0, 365432, 312345, 1212345])
+    size = 10 ** (5 - digits // 2)
+
+    e, n, errors = gridref_to_osgb36(osgb36_to_gridref(easting, northing, digits))
+
+    assert errors.tolist() == [None] * len(easting)
+    assert e.tolist() == (easting // size * size).tolist()
+    assert n.tolist() == (northing // size * size).tolist()
+
+
+def test_regenerate_gridrefs_capped_by_precision():
+    records = pd.DataFrame({'Easting': [387654] * 5,
+                            'Northing': [365432] * 5,
+                            'Precision': [2, 3, 4, 5, None],
+                            'GridRef': [''] * 5})
+
+    regenerated = regenerate_gridrefs(records, 8)
+
+    # Precision is the number of digits of each axis, so a record is never given more figures than it was made at
+    assert regenerated['GridRef'].tolist() == ['SJ8765', 'SJ876654', 'SJ87656543', 'SJ87656543', 'SJ87656543']
+    assert regenerated['Grid1km'].tolist() == ['SJ8765'] * 5
+    assert records['GridRef'].tolist() == [''] * 5
+
+    assert regenerate_gridrefs(records)['GridRef'].tolist() == [''] * 5
+    assert 'Grid1km' not in regenerate_gridrefs(records.drop(columns='Easting')).columns
@@ -0,0 +1,142 @@
+import json
+
+import pytest
+
+gpd = pytest.importorskip('geopandas')
+pytest.importorskip('pyarrow')
+import pandas as pd  # noqa: E402
+from shapely.geometry import Point, box  # noqa: E402
+
+import layers  # noqa: E402
+from layers import load_layer  # noqa: E402
+
+
+def write_layer(path):
+    records = gpd.GeoDataFrame({'CommonName': ['Otter', 'Water Vole', 'Otter'],
+                                'InformalGr': ['mammal', 'mammal', 'mammal'],
+                                'Year': ['2015', '2018', '2001'],
+                                'Other': ['a', 'b', 'c']},
+                               geometry=[Point(380000, 330000), Point(381000, 331000), Point(382000, 332000)],
+                               crs='EPSG:27700')
+    records.to_file(str(path), driver='GPKG')
+
+
+def test_load_layer_cache_round_trip(tmp_path, monkeypatch):
+    source = tmp_path / 'records.gpkg'
+    cache_dir = tmp_path / 'cache'
+    write_layer(source)
+    columns = ['CommonName', 'InformalGr', 'Year']
+
+    written = load_layer(source, cache_dir, columns)
+
+    # the cached copy is a parquet file and its metadata a JSON file, with no temporary files left behind
+    assert sorted(f.name for f in cache_dir.iterdir()) == ['records.json', 'records.parquet']
+    assert json.loads((cache_dir / 'records.json').read_text())['columns'] == columns
+    assert len(gpd.read_parquet(cache_dir / 'records.parquet')) == 3
+
+    def no_source_read(*args, **kwargs):
+        raise AssertionError('the source was read again instead of the cached copy')
+
+    monkeypatch.setattr(layers.gpd, 'read_file', no_source_read)
+    cached = load_layer(source, cache_dir, columns)
+
+    assert list(cached.columns) == list(written.columns)
+    assert cached['CommonName'].tolist() == written['CommonName'].tolist()
+    assert cached['Year'].tolist() == written['Year'].tolist()
+    assert cached.geometry.equals(written.geometry)
+
+
+def test_compact_layer_keeps_date_text():
+    records = gpd.GeoDataFrame({'Date': ['2015-06-01', 'Spring 2012', '03/04/2009', '1998'],
+                                'Year': [None, None, None, None]},
+                               geometry=[Point(380000, 330000)] * 4, crs='EPSG:27700')
+
+    compacted = layers.compact_layer(records, sort_years=True)
+
+    # the dates are reported as written, only the Year is filled from those that can be read
+    assert compacted['Date'].tolist() == ['1998', '03/04/2009', '2015-06-01', 'Spring 2012']
+    assert compacted['Year'].tolist()[:3] == [1998, 2009, 2015]
+    assert pd.isna(compacted['Year'].iloc[3])
+
+
+def test_build_grid_index_tolerates_inexact_squares():
+    squares = [box(380000, 330000, 381000, 331000),
+               box(380999.6, 330000.3, 382000.4, 330999.8),  # digitised square, off the grid lines
+               box(380000, 330000, 381000, 331000).buffer(-400),  # record inside a square, not the square
+               Point(380500, 330500)]
+    layer = layers.build_index(gpd.GeoDataFrame({'Year': [2000, 2001, 2002, 2003]}, geometry=squares,
+                                                crs='EPSG:27700'))
+
+    grid_index = layers.build_grid_index(layer)
+
+    assert grid_index['squares'][380 * layers.GRID_KEY + 330].tolist() == [0]
+    assert grid_index['squares'][381 * layers.GRID_KEY + 330].tolist() == [1]
+    assert grid_index['other'].tolist() == [2, 3]
+
+    # most records are not squares, so the layer is searched with its spatial index instead
+    assert layers.build_grid_index(layer.iloc[[0, 2, 3]]) is None
+
+
+def test_compact_layer_keeps_source_order():
+    records = gpd.GeoDataFrame({'SiteName': ['b', 'a', 'c'], 'Year': [2010, 1990, 2000]},
+                               geometry=[Point(380000, 330000)] * 3, crs='EPSG:27700')
+
+    # only the record layers are sorted by year, the position in the source is kept to put results back in order
+    sites = layers.compact_layer(records)
+    assert sites['SiteName'].tolist() == ['b', 'a', 'c']
+
+    dated = layers.compact_layer(records, sort_years=True)
+    assert dated['SiteName'].tolist() == ['a', 'c', 'b']
+    assert layers.source_order(dated.iloc[[0, 2]])['SiteName'].tolist() == ['b', 'a']
+
+
+def test_tile_layer_in_pieces(tmp_path, monkeypatch):
+    source = tmp_path / 'records.gpkg'
+    records = gpd.GeoDataFrame({'CommonName': ['Otter', 'Water Vole', 'Badger', 'Otter', 'Bat'],
+                                'Year': [2015, 2001, 2018, 2001, 2010]},
+                               geometry=[Point(380500, 330500), Point(395000, 330500), Point(381500, 331500),
+                                         Point(380600, 330600), Point(396000, 331000)], crs='EPSG:27700')
+    records.to_file(str(source), driver='GPKG')
+    monkeypatch.setattr(layers, 'TILE_CHUNK_ROWS', 2)  # the source is read in three pieces
+
+    tiles = layers.tile_layer(source, tmp_path / 'cache', ['CommonName', 'Year'], sort_years=True)
+    window = layers.read_window(source, (370000, 320000, 400000, 340000), tiles, ['CommonName', 'Year'],
+                                sort_years=True)
+    whole = layers.load_layer(source, tmp_path / 'cache', ['CommonName', 'Year'], sort_years=True)
+
+    assert sorted(tiles['tiles']) == [[38, 33], [39, 33]]
+    assert not list((tmp_path / 'cache' / 'records_tiles').glob('*.part'))
+    # the window is in the same order as the whole layer, sorted by year and then by source position
+    assert window['CommonName'].tolist() == whole['CommonName'].tolist()
+    assert window[layers.ROW_COLUMN].tolist() == whole[layers.ROW_COLUMN].tolist() == [1, 3, 4, 0, 2]
+
+
+def test_grid_query_matches_intersects():
+    squares = [box(x, y, x + 1000, y + 1000) for x in range(370000, 390000, 1000) for y in range(320000, 340000, 1000)]
+    layer = layers.build_index(gpd.GeoDataFrame({'Year': range(len(squares))}, geometry=squares, crs='EPSG:27700'))
+    grid_index = layers.build_grid_index(layer)
+    search = Point(380250, 330700).buffer(5000)
+
+    found = layers.grid_query(layer, grid_index, search)
+
+    assert found.index.tolist() == layer.index[layer.intersects(search)].tolist()
+    # the squares inside the search area are found without testing them against it
+    inside = layers.interior_spans(search.buffer(-(500 + layers.GRID_TOLERANCE) * 2 ** 0.5), 330500)
+    assert len(inside) == 1 and inside[0][0] < 377000 and inside[0][1] > 383000
+
+
+def test_cold_read_only_parses_layer_columns(tmp_path, monkeypatch):
+    source = tmp_path / 'records.gpkg'
+    write_layer(source)
+    read_file = gpd.read_file
+    reads = []
+
+    def recording_read(*args, **kwargs):
+        reads.append(kwargs.get('columns'))
+        return read_file(*args, **kwargs)
+
+    monkeypatch.setattr(layers.gpd, 'read_file', recording_read)
+    layer = load_layer(source, tmp_path / 'cache', ['CommonName', 'Year'])
+
+    assert reads == [['CommonName', 'Year']]
+    assert 'Other' not in layer.columns